@@ -0,0 +1,627 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Daily Research Agent
+
+Runs research_agent.py against a local mock of the Perplexity and Anthropic
+APIs (tunable latency, error rate and response size) and measures:
+  1. get_all_eligible_files() on synthetic trees of 100 → 100k files
+  2. Plan prompt construction (_plan_request), plus the relevance prefilter
+     and sharding for trees large enough to be planned hierarchically
+  3. Phase 1 research against the mock endpoints
+  4. Phase 4 throughput (update_all_files) at different worker counts,
+     optionally against per-minute request/token limits enforced by the
+     mock with rate-limit headers and 429s (--rate-limit, --token-limit)
+  5. Phases 4-5 as one Message Batch (batch_update_and_create) against the
+     mock's batch routes
+  6. Process startup per subcommand (`<command> --help`, and a real `scan`)
+
+Results are written as JSON with a fixed schema and sorted keys, so runs on
+different commits can be diffed or compared by a script. No credentials or
+network access are needed.
+
+Usage:
+  python scripts/benchmark_research_agent.py --output bench.json
+  python scripts/benchmark_research_agent.py --sizes 100,1000 --workers 1,4 --latency 0.5
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+SCHEMA_VERSION = 1
+
+WORDS = (
+    "claude opus sonnet haiku prompt caching tools agents hooks skills mcp server "
+    "context window tokens pricing batch streaming subagent plugin workflow review "
+    "typescript python react nextjs prisma playwright vitest tailwind vercel"
+).split()
+
+
+def log(msg: str) -> None:
+    # Progress goes to stderr so stdout stays pure JSON
+    print(msg, file=sys.stderr, flush=True)
+
+
+# ─── Mock API server ─────────────────────────────────────────────────────────
+
+class MockAPI(ThreadingHTTPServer):
+    """
+    One local server answering both APIs: POST /chat/completions like
+    Perplexity and POST /v1/messages (plain or streamed) like Anthropic,
+    plus the Message Batches routes (create, retrieve, results) used by
+    --batch. Every request waits `latency` seconds before responding and
+    fails with `error_rate` probability (429 for Anthropic, 503 for
+    Perplexity); a batch ends `latency` seconds after it is created, each
+    request in it errored with `error_rate` probability.
+    Responses carry `response_bytes` of text; streams spread their deltas
+    over `stream_seconds`. Non-zero `rate_limit` / `token_limit` enforce
+    requests and input tokens per minute as token buckets, report them in
+    each API's rate-limit headers and answer 429 with retry-after when
+    exceeded.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency: float,
+        error_rate: float,
+        response_bytes: int,
+        stream_seconds: float,
+        rate_limit: int = 0,
+        token_limit: int = 0,
+    ):
+        super().__init__(("127.0.0.1", 0), _MockHandler)
+        self.latency        = latency
+        self.error_rate     = error_rate
+        self.response_bytes = response_bytes
+        self.stream_seconds = stream_seconds
+        self.limits         = {"requests": rate_limit, "tokens": token_limit}
+        self.levels         = {kind: float(limit) for kind, limit in self.limits.items()}
+        self.requests       = 0
+        self.errors         = 0
+        self.throttled      = 0
+        self.batches: dict[str, dict] = {}
+        self._stamp         = time.monotonic()
+        self._lock          = threading.Lock()
+        self._random        = random.Random(0)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_outcome(self) -> bool:
+        """Count a request; True if it should fail."""
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            self.errors += fail
+            return fail
+
+    def admit(self, tokens: int) -> tuple[dict, int | None]:
+        """
+        Charge one request of `tokens` input tokens against the limits.
+        Returns ({"requests"|"tokens": (limit, remaining)}, retry-after
+        seconds if the request is over a limit, else None).
+        """
+        with self._lock:
+            now = time.monotonic()
+            need, short = {"requests": 1, "tokens": tokens}, 0.0
+            for kind, limit in self.limits.items():
+                if limit:
+                    self.levels[kind] = min(limit, self.levels[kind] + (now - self._stamp) * limit / 60)
+                    short = max(short, (min(need[kind], limit) - self.levels[kind]) * 60 / limit)
+            self._stamp = now
+            if short > 0:
+                self.throttled += 1
+            else:
+                for kind, limit in self.limits.items():
+                    if limit:
+                        self.levels[kind] -= need[kind]
+            state = {kind: (limit, max(int(self.levels[kind]), 0))
+                     for kind, limit in self.limits.items() if limit}
+            return state, (math.ceil(short) if short > 0 else None)
+
+    def message(self, request: dict) -> dict:
+        """A complete Messages API response to `request`."""
+        text = self.text()
+        return {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": request["model"],
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": len(json.dumps(request)) // 4, "output_tokens": len(text) // 4},
+        }
+
+    def create_batch(self, requests: list[dict]) -> str:
+        with self._lock:
+            batch_id = f"msgbatch_mock{len(self.batches)}"
+            self.batches[batch_id] = {"created": time.monotonic(), "requests": requests, "results": None}
+        return batch_id
+
+    def batch(self, batch_id: str, base_url: str) -> dict | None:
+        """The MessageBatch object for `batch_id`, its results drawn once it has ended."""
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            ended = time.monotonic() - batch["created"] >= self.latency
+            if ended and batch["results"] is None:
+                batch["results"] = []
+                for entry in batch["requests"]:
+                    self.requests += 1
+                    fail = self._random.random() < self.error_rate
+                    self.errors += fail
+                    batch["results"].append({"custom_id": entry["custom_id"], "result": (
+                        {"type": "errored", "error": {"type": "error",
+                                                      "error": {"type": "api_error", "message": "mock"}}}
+                        if fail else {"type": "succeeded", "message": self.message(entry["params"])}
+                    )})
+        total     = len(batch["requests"])
+        errored   = sum(r["result"]["type"] == "errored" for r in batch["results"] or [])
+        stamp     = "2026-01-01T00:00:00Z"
+        return {
+            "id": batch_id, "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else total, "succeeded": total - errored if ended else 0,
+                "errored": errored, "canceled": 0, "expired": 0,
+            },
+            "created_at": stamp, "expires_at": stamp, "ended_at": stamp if ended else None,
+            "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"{base_url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def text(self) -> str:
+        words = []
+        size  = 0
+        while size < self.response_bytes:
+            word = WORDS[(len(words) * 7) % len(WORDS)]
+            words.append(word)
+            size += len(word) + 1
+        return "# Updated\n\n" + " ".join(words) + "\n"
+
+
+# (limit, remaining) header names each API reports its limits in
+ANTHROPIC_LIMIT_HEADERS = {
+    "requests": ("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining"),
+    "tokens":   ("anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-input-tokens-remaining"),
+}
+PERPLEXITY_LIMIT_HEADERS = {
+    "requests": ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests"),
+    "tokens":   ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens"),
+}
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockAPI
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # GET /v1/messages/batches/{id} and /v1/messages/batches/{id}/results
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) < 4:
+            return self._json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+        batch = self.server.batch(parts[3], self.server.url)
+        if batch is None:
+            return self._json(404, {"type": "error", "error": {"type": "not_found_error", "message": parts[3]}})
+        if parts[4:] != ["results"]:
+            return self._json(200, batch)
+        if batch["processing_status"] != "ended":
+            return self._json(400, {"type": "error", "error": {"type": "invalid_request_error",
+                                                               "message": "batch still processing"}})
+        body = "".join(
+            json.dumps(result) + "\n" for result in self.server.batches[parts[3]]["results"]
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/binary")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body    = self.rfile.read(int(self.headers["content-length"]))
+        request = json.loads(body)
+        if self.path.split("?", 1)[0].rstrip("/").endswith("/v1/messages/batches"):
+            return self._json(200, self.server.batch(self.server.create_batch(request["requests"]), self.server.url))
+        perplexity = self.path.endswith("/chat/completions")
+        state, retry_after = self.server.admit(len(body) // 4)
+        names = PERPLEXITY_LIMIT_HEADERS if perplexity else ANTHROPIC_LIMIT_HEADERS
+        limit_headers = {}
+        for kind, (limit, remaining) in state.items():
+            limit_headers[names[kind][0]] = str(limit)
+            limit_headers[names[kind][1]] = str(remaining)
+        if retry_after is not None:
+            limit_headers["retry-after"] = str(retry_after)
+            if perplexity:
+                return self._json(429, {"error": "mock rate limit"}, limit_headers)
+            return self._json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "mock limit"}},
+                              limit_headers)
+
+        time.sleep(self.server.latency)
+        fail = self.server.next_outcome()
+        if perplexity:
+            if fail:
+                return self._json(503, {"error": "mock overloaded"})
+            return self._json(200, {
+                "choices":   [{"message": {"content": "Claude Opus 4.6 is the latest model.\n" + self.server.text()}}],
+                "citations": ["https://example.com/mock"],
+                "usage":     {"prompt_tokens": 50, "completion_tokens": self.server.response_bytes // 4},
+            }, limit_headers)
+        if fail:
+            return self._json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "mock"}},
+                              {"retry-after": "0"})
+
+        message = self.server.message(request)
+        if not request.get("stream"):
+            return self._json(200, message, limit_headers)
+        text = message["content"][0]["text"]
+        message.update(content=[], stop_reason=None)
+        message["usage"]["output_tokens"] = 0
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        for name, value in limit_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def event(kind: str, data: dict) -> None:
+            self.wfile.write(f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        pieces = [text[i:i + 64] for i in range(0, len(text), 64)]
+        try:
+            event("message_start", {"type": "message_start", "message": message})
+            event("content_block_start", {"type": "content_block_start", "index": 0,
+                                          "content_block": {"type": "text", "text": ""}})
+            for piece in pieces:
+                time.sleep(self.server.stream_seconds / len(pieces))
+                event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                              "delta": {"type": "text_delta", "text": piece}})
+            event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            event("message_delta", {"type": "message_delta",
+                                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": len(text) // 4}})
+            event("message_stop", {"type": "message_stop"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the agent stopped reading early
+        self.close_connection = True
+
+
+# ─── Synthetic trees ─────────────────────────────────────────────────────────
+
+def build_tree(root: Path, n_files: int, seed: int = 0) -> None:
+    """
+    `n_files` small markdown/yaml files under docs/, skills/ and templates/,
+    about 50 per directory and two levels deep, plus a node_modules/ and a
+    .git/ full of files the walker must prune.
+    """
+    rng = random.Random(seed)
+    for i in range(n_files):
+        top  = ("docs", "skills", "templates")[i % 3]
+        path = root / top / f"area-{i // 500}" / f"group-{(i // 50) % 10}" / (
+            f"file-{i}.md" if i % 10 else f"file-{i}.yml"
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        body = " ".join(rng.choice(WORDS) for _ in range(40))
+        path.write_text(
+            f"---\nname: file-{i}\ncompatibility: Claude Opus 4.{i % 7}\nupdated: 2025-01-01\n---\n"
+            f"# File {i}\n\n{body}\n",
+            encoding="utf-8",
+        )
+    for skipped in ("node_modules/pkg", ".git/objects"):
+        (root / skipped).mkdir(parents=True, exist_ok=True)
+        for i in range(max(n_files // 10, 10)):
+            (root / skipped / f"skip-{i}.md").write_text("ignored\n", encoding="utf-8")
+
+
+def timed(fn, repeat: int) -> tuple[float, list[float], object]:
+    """(best seconds, every run's seconds, last result) of `repeat` calls to fn()."""
+    runs   = []
+    result = None
+    for _ in range(repeat):
+        start  = time.perf_counter()
+        result = fn()
+        runs.append(round(time.perf_counter() - start, 4))
+    return min(runs), runs, result
+
+
+# ─── Benchmarks ──────────────────────────────────────────────────────────────
+
+def bench_scan_and_plan(ra, sizes: list[int], repeat: int, workdir: Path) -> tuple[list[dict], list[dict]]:
+    research = " ".join(random.Random(1).choice(WORDS) for _ in range(1500))
+    scan, plan = [], []
+    for n in sizes:
+        root = workdir / f"tree-{n}"
+        log(f"  building {n}-file tree...")
+        build_tree(root, n)
+        ra.REPO_ROOT = root
+
+        best, runs, files = timed(ra.get_all_eligible_files, repeat)
+        scan.append({"files": n, "eligible": len(files), "seconds": best, "runs": runs})
+        log(f"  scan {n:>7} files: {best:.3f}s")
+
+        with redirect_stdout(io.StringIO()):
+            best, runs, request = timed(
+                lambda: ra._plan_request(research, "Claude Opus 4.6", files, None), repeat
+            )
+            entry = {
+                "files":         n,
+                "prompt_chars":  len(request["messages"][0]["content"]),
+                "seconds":       best,
+                "runs":          runs,
+                "sharded":       len(files) > ra.PLAN_SHARD_THRESHOLD,
+            }
+            if entry["sharded"]:
+                best, runs, candidates = timed(
+                    lambda: ra.relevance_prefilter(research, "Claude Opus 4.6", files, None), repeat
+                )
+                shards = ra.plan_shards(candidates)
+                entry.update({
+                    "prefilter_seconds": best,
+                    "candidates":        len(candidates),
+                    "shards":            len(shards),
+                    "max_shard_prompt_chars": max(
+                        len(ra._plan_request(research, "Claude Opus 4.6", members, None, shard=name)
+                            ["messages"][0]["content"])
+                        for name, members in shards
+                    ),
+                })
+        plan.append(entry)
+        log(f"  plan prompt {n:>7} files: {entry['seconds']:.3f}s, {entry['prompt_chars']} chars"
+            + (f", {entry['shards']} shards" if entry["sharded"] else ""))
+        shutil.rmtree(root, ignore_errors=True)
+    return scan, plan
+
+
+def bench_startup(repeat: int, workdir: Path) -> list[dict]:
+    """Wall time of fresh processes, with no API secrets in the environment."""
+    script = Path(__file__).parent / "research_agent.py"
+    env    = {k: v for k, v in os.environ.items()
+              if k not in ("ANTHROPIC_API_KEY", "PERPLEXITY_API_KEY", "GH_TOKEN")}
+    cases  = [("import", [sys.executable, "-c", f"import runpy; runpy.run_path({str(script)!r})"])]
+    cases += [
+        (f"{command} --help", [sys.executable, str(script), command, "--help"])
+        for command in ("scan", "research", "plan", "update", "pr")
+    ]
+    cases.append(("scan", [sys.executable, str(script), "scan",
+                           "--cache-dir", str(workdir / "startup-cache"),
+                           "--report", str(workdir / "startup-report.json")]))
+    results = []
+    for name, cmd in cases:
+        def run():
+            subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best, runs, _ = timed(run, repeat)
+        results.append({"command": name, "seconds": best, "runs": runs})
+        log(f"  startup {name:<16} {best:.3f}s")
+    return results
+
+
+def _fresh_limiters(ra) -> None:
+    """Forget the limits and window learned by earlier runs."""
+    ra.claude_limiters.clear()
+    old = ra.perplexity_limiter
+    ra.perplexity_limiter = ra.RateLimiter(old.name, old.header_names, ra.PERPLEXITY_RPM or None)
+
+
+def bench_research(ra, mock: MockAPI) -> dict:
+    ra.run_report = ra.RunReport()
+    _fresh_limiters(ra)
+    before, errors, throttled = mock.requests, mock.errors, mock.throttled
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        research, _ = ra.gather_research()
+        seconds = time.perf_counter() - start
+    totals = ra.run_report.as_dict()["totals"]
+    log(f"  research: {seconds:.3f}s, {mock.requests - before} requests")
+    return {
+        "seconds":       round(seconds, 4),
+        "requests":      mock.requests - before,
+        "injected_errors": mock.errors - errors,
+        "throttled":     mock.throttled - throttled,
+        "retries":       totals["retries"],
+        "research_chars": len(research),
+    }
+
+
+def bench_update(ra, mock: MockAPI, workers: list[int], n_files: int, workdir: Path) -> list[dict]:
+    root = workdir / "update-tree"
+    results = []
+    for w in workers:
+        shutil.rmtree(root, ignore_errors=True)
+        build_tree(root, n_files, seed=2)
+        ra.REPO_ROOT  = root
+        ra.run_report = ra.RunReport()
+        _fresh_limiters(ra)
+        files   = ra.get_all_eligible_files()
+        updates = [
+            {"file": str(f.relative_to(root)), "reason": "mock update", "priority": ("high", "medium", "low")[i % 3]}
+            for i, f in enumerate(files)
+        ]
+        before, errors, throttled = mock.requests, mock.errors, mock.throttled
+        with redirect_stdout(io.StringIO()):
+            start   = time.perf_counter()
+            changed = ra.update_all_files(updates, "mock research", "Claude Opus 4.6", w, stream=True, patch=False)
+            seconds = time.perf_counter() - start
+        totals = ra.run_report.as_dict()["totals"]
+        results.append({
+            "workers":        w,
+            "files":          len(updates),
+            "changed":        len(changed),
+            "seconds":        round(seconds, 4),
+            "files_per_second": round(len(updates) / seconds, 3),
+            "requests":       mock.requests - before,
+            "injected_errors": mock.errors - errors,
+            "throttled":      mock.throttled - throttled,
+            "retries":        totals["retries"],
+            "errors":         totals["errors"],
+            "final_window":   ra.claude_limiter(ra.CLAUDE_MODEL).snapshot()["window"],
+        })
+        log(f"  update {len(updates)} files with {w:>2} workers: {seconds:.3f}s "
+            f"({results[-1]['files_per_second']} files/s)")
+    shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_batch(ra, mock: MockAPI, n_files: int, workdir: Path) -> dict:
+    root = workdir / "batch-tree"
+    build_tree(root, n_files, seed=3)
+    ra.REPO_ROOT  = root
+    ra.run_report = ra.RunReport()
+    ra.BATCH_POLL_INITIAL = max(mock.latency / 4, 0.01)
+    files   = ra.get_all_eligible_files()
+    updates = [{"file": str(f.relative_to(root)), "reason": "mock update", "priority": "medium"} for f in files]
+    before, errors = mock.requests, mock.errors
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        updated, _ = ra.batch_update_and_create(
+            updates, [], "mock research", "Claude Opus 4.6", "", 4, patch=False,
+        )
+        seconds = time.perf_counter() - start
+    shutil.rmtree(root, ignore_errors=True)
+    log(f"  batch {len(updates)} files: {seconds:.3f}s, {len(updated)} updated")
+    return {
+        "files":           len(updates),
+        "changed":         len(updated),
+        "seconds":         round(seconds, 4),
+        "requests":        mock.requests - before,
+        "injected_errors": mock.errors - errors,
+    }
+
+
+# ─── Main ────────────────────────────────────────────────────────────────────
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the research agent against local mock APIs.")
+    parser.add_argument("--sizes", type=_int_list, default=[100, 1_000, 10_000, 100_000],
+                        help="synthetic tree sizes for the scan and plan benchmarks (default: 100,1000,10000,100000)")
+    parser.add_argument("--workers", type=_int_list, default=[1, 2, 4, 8, 16],
+                        help="Phase 4 worker counts to compare (default: 1,2,4,8,16)")
+    parser.add_argument("--update-files", type=int, default=32,
+                        help="files updated per Phase 4 run (default: 32)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per scan/plan measurement; the best is reported (default: 3)")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="mock API seconds before each response (default: 0.2)")
+    parser.add_argument("--stream-seconds", type=float, default=0.3,
+                        help="mock seconds spent streaming each Claude response (default: 0.3)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of mock requests answered with 429/503 (default: 0)")
+    parser.add_argument("--response-bytes", type=int, default=2_000,
+                        help="size of each mock response body text (default: 2000)")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="mock requests per minute per API, 0 for none (default: 0)")
+    parser.add_argument("--token-limit", type=int, default=0,
+                        help="mock input tokens per minute per API, 0 for none (default: 0)")
+    parser.add_argument("--skip", default="",
+                        help="comma-separated benchmarks to skip: startup, scan, research, update, batch")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="write results here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    skip = set(args.skip.split(","))
+
+    mock = MockAPI(
+        args.latency, args.error_rate, args.response_bytes, args.stream_seconds,
+        args.rate_limit, args.token_limit,
+    )
+    threading.Thread(target=mock.serve_forever, daemon=True).start()
+
+    # research_agent reads these at import time
+    os.environ.update({
+        "ANTHROPIC_BASE_URL":  mock.url,
+        "PERPLEXITY_BASE_URL": mock.url,
+        "ANTHROPIC_API_KEY":   "mock",
+        "PERPLEXITY_API_KEY":  "mock",
+    })
+    sys.path.insert(0, str(Path(__file__).parent))
+    import research_agent as ra
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    results: dict = {}
+    workdir = Path(tempfile.mkdtemp(prefix="research-agent-bench-"))
+    try:
+        if "startup" not in skip:
+            log("[startup]")
+            results["startup"] = bench_startup(args.repeat, workdir)
+        if "scan" not in skip:
+            log("[scan + plan prompt]")
+            results["scan"], results["plan_prompt"] = bench_scan_and_plan(ra, args.sizes, args.repeat, workdir)
+        if "research" not in skip:
+            log("[research]")
+            results["research"] = bench_research(ra, mock)
+        if "update" not in skip:
+            log("[update]")
+            results["update"] = bench_update(ra, mock, args.workers, args.update_files, workdir)
+        if "batch" not in skip:
+            log("[batch]")
+            results["batch"] = bench_batch(ra, mock, args.update_files, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        mock.shutdown()
+
+    report = {
+        "schema":   SCHEMA_VERSION,
+        "commit":   commit,
+        "date":     time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python":   platform.python_version(),
+        "platform": platform.platform(),
+        "mock": {
+            "latency":        args.latency,
+            "stream_seconds": args.stream_seconds,
+            "error_rate":     args.error_rate,
+            "response_bytes": args.response_bytes,
+            "rate_limit":     args.rate_limit,
+            "token_limit":    args.token_limit,
+        },
+        "results":  results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        args.output.write_text(text, encoding="utf-8")
+        log(f"Results written to {args.output}")
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,45 +7,225 @@ What this does:
   2. Detects the current latest Claude model automatically
   3. Plans which files need updating AND which new skill files to create
   4. Updates ALL relevant files: skills, templates, docs, guides, READMEs
+     (bounded worker pool, high-priority files first; see --workers)
   5. Creates NEW skill files for newly relevant tools/frameworks
   6. Updates index files (skills/README.md, INDEX.md) for any new files
-  7. Opens a PR with all changes for review
+  7. Validates every changed file (frontmatter, headings, truncation, links),
+     retrying or reverting the ones that fail
+  8. Opens a PR with all changes for review
 
 Required secrets (GitHub repo → Settings → Secrets → Actions):
   PERPLEXITY_API_KEY  — from console.perplexity.ai
   ANTHROPIC_API_KEY   — from console.anthropic.com
   GH_PAT              — GitHub PAT with repo + pull_requests scope
+
+Subcommands run one stage at a time, passing state through --state-dir
+(default: <cache-dir>/state-<date>); without one, the whole pipeline runs:
+  scan      list eligible files and what changed (no API keys needed)
+  research  Phase 1 → research.json
+  plan      Phases 2-3 → plan.json (runs research first if needed)
+  update    Phases 4-5 from research.json + plan.json → changes.json
+  pr        Phase 6 from changes.json
+
+A whole run checkpoints each finished step to <cache-dir>/journal.jsonl;
+after a crash or timeout, `--resume` continues from the first unfinished one.
+
+Research facts (model names and IDs, versions, prices) and citations are kept
+in <cache-dir>/research.sqlite3; a day with no new facts since the last PR
+and no edited files ends before planning.
 """
 
+from __future__ import annotations
+
+import time
+
+_STARTED = time.perf_counter()
+
 import os
+import re
 import sys
 import json
+import math
+import queue
+import random
+import heapq
+import hashlib
+import itertools
+import tempfile
+import asyncio
+import argparse
+import zlib
+import difflib
+import threading
+import sqlite3
 import subprocess
-import requests
-import anthropic
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import importlib.util
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timezone
 from pathlib import Path
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit, urlunsplit
+
+
+def _lazy_import(name: str):
+    """
+    The module `name`, executed on first attribute access instead of now
+    (importlib.util.LazyLoader). anthropic and requests take seconds to
+    import; `scan` and --help never touch them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec   = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+anthropic = _lazy_import("anthropic")
+requests  = _lazy_import("requests")
+
+
+class LazyClient:
+    """Stands in for an API client and builds it with `factory` on first use."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client  = None
+        self._lock    = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
+
+
+_log_lock  = threading.Lock()
+_log_local = threading.local()
 
 
 def log(msg: str) -> None:
     """Print with immediate flush so GitHub Actions shows output in real-time."""
-    print(msg, flush=True)
+    buffer = getattr(_log_local, "buffer", None)
+    if buffer is not None:
+        buffer.append(msg)
+        return
+    with _log_lock:
+        print(msg, flush=True)
+
+
+@contextmanager
+def grouped_log():
+    """Buffer this thread's log() lines and print them as one block on exit."""
+    _log_local.buffer = []
+    try:
+        yield
+    finally:
+        lines = _log_local.buffer
+        _log_local.buffer = None
+        if lines:
+            with _log_lock:
+                print("\n".join(lines), flush=True)
 
 
 # ─── Config ──────────────────────────────────────────────────────────────────
 
-TODAY     = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+# RESEARCH_AGENT_DATE pins the date embedded in every prompt (for --replay)
+TODAY     = os.environ.get("RESEARCH_AGENT_DATE") or datetime.now(timezone.utc).strftime("%Y-%m-%d")
 REPO_ROOT = Path(__file__).parent.parent
 
-PERPLEXITY_KEY = os.environ["PERPLEXITY_API_KEY"]
-ANTHROPIC_KEY  = os.environ["ANTHROPIC_API_KEY"]
-GH_TOKEN       = os.environ["GH_TOKEN"]
+# Checked in main() (see REQUIRED_ENV) so the module imports without secrets
+PERPLEXITY_KEY = os.environ.get("PERPLEXITY_API_KEY", "")
+ANTHROPIC_KEY  = os.environ.get("ANTHROPIC_API_KEY", "")
+GH_TOKEN       = os.environ.get("GH_TOKEN", "")
 
 # 180s timeout per Claude call — prevents infinite hangs on large files
-claude = anthropic.Anthropic(api_key=ANTHROPIC_KEY, timeout=180.0)
+claude = LazyClient(lambda: anthropic.Anthropic(
+    api_key=ANTHROPIC_KEY,
+    timeout=180.0,
+    # Every response, including the SDK's own retries, feeds its model's limiter
+    http_client=anthropic.DefaultHttpxClient(event_hooks={"response": [lambda response: _observe_claude(response)]}),
+))
 CLAUDE_MODEL = "claude-opus-4-6"
 
+# Update routing tiers (see triage_update): a small model decides whether a
+# file needs changing at all, trivial edits go to a mid-tier model and only
+# substantive ones reach CLAUDE_MODEL. Overridable with --triage-model and
+# --light-model.
+TRIAGE_MODEL = os.environ.get("TRIAGE_MODEL", "claude-haiku-4-5")
+LIGHT_MODEL  = os.environ.get("LIGHT_MODEL", "claude-sonnet-4-5")
+
+# One keep-alive session shared by every Perplexity query (pool sized for the
+# parallel research fan-out). PERPLEXITY_BASE_URL points it at a local stub.
+PERPLEXITY_URL = os.environ.get("PERPLEXITY_BASE_URL", "https://api.perplexity.ai").rstrip("/") + "/chat/completions"
+
+
+def _perplexity_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {PERPLEXITY_KEY}",
+        "Content-Type": "application/json",
+    })
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+    session.mount("http://",  requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+    return session
+
+
+perplexity = LazyClient(_perplexity_session)
+
+# Perplexity retries — 429/5xx/timeouts, full-jitter exponential backoff,
+# and one deadline shared by the whole research phase
+PERPLEXITY_TIMEOUT        = 60.0
+PERPLEXITY_RETRIES        = 4
+PERPLEXITY_BACKOFF_BASE   = 1.0
+PERPLEXITY_BACKOFF_MAX    = 30.0
+PERPLEXITY_RETRY_STATUS   = {429, 500, 502, 503, 504}
+RESEARCH_DEADLINE_SECONDS = 300.0
+
+# A replayed stream is yielded in this many pieces (see claude_stream_text)
+REPLAY_STREAM_CHUNKS = 20
+
+# Phase 4 concurrency — override with --workers or UPDATE_WORKERS
+DEFAULT_UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "4"))
+
+# 429 handling — retries per call, base delay when no retry-after header is sent
+RATE_LIMIT_RETRIES    = 5
+RATE_LIMIT_BASE_DELAY = 2.0
+
+# Adaptive limiter (see RateLimiter) — the AIMD concurrency window each
+# provider starts at and may grow to; RPM/TPM limits come from response
+# headers, except Perplexity's requests/min, which it does not send
+RATE_LIMIT_WINDOW_START = 8
+RATE_LIMIT_WINDOW_MAX   = 64
+PERPLEXITY_RPM          = float(os.environ.get("PERPLEXITY_RPM", "50"))
+
+# On-disk API response cache — override with --cache-dir, disable with --no-cache.
+# Lives outside the repo so `git add -A` in create_pr never picks it up.
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("RESEARCH_AGENT_CACHE_DIR", Path.home() / ".cache" / "research-agent")
+)
+CACHE_TTL_SECONDS = 24 * 3600
+CACHE_MAX_BYTES   = 200 * 1024 * 1024
+
+# Estimated-token budgets for the research packed into prompts: the planner's
+# block is shared by every plan call (and so hits the prompt cache), per-file
+# calls get a smaller one ranked for their file (see pack_research)
+RESEARCH_CONTEXT_TOKENS = 2500
+RESEARCH_FOCUS_TOKENS   = 1500
+LATEST_MODEL_TOKENS     = 300
+
+# --batch polling — first delay, cap, and give-up point (batches expire after 24h)
+BATCH_POLL_INITIAL = 10.0
+BATCH_POLL_MAX     = 120.0
+BATCH_TIMEOUT      = 24 * 3600
+
 # Files to never modify
 SKIP_FILES = {
     "LICENSE",
@@ -58,6 +238,7 @@ SKIP_FILES = {
     "planning/activity.md",
     "scripts/research_agent.py",
     "scripts/requirements.txt",
+    "run-report.json",
     ".github/workflows/daily-research-agent.yml",
 }
 
@@ -71,6 +252,1092 @@ SKIP_DIRS = {
 ELIGIBLE_EXTENSIONS = {".md", ".txt", ".yml", ".yaml", ".json"}
 MAX_FILE_SIZE_BYTES  = 150_000
 
+# Markdown files above CHUNK_THRESHOLD_BYTES are updated section by section
+# (8192 output tokens is roughly 30 KB of markdown), which also lets them go
+# past MAX_FILE_SIZE_BYTES up to MAX_CHUNKED_FILE_SIZE_BYTES.
+CHUNK_THRESHOLD_BYTES       = 30_000
+CHUNK_MAX_CHARS             = 20_000
+CHUNK_WORKERS               = 4
+MAX_CHUNKED_FILE_SIZE_BYTES = 1_000_000
+
+# Above PLAN_SHARD_THRESHOLD eligible files the planner scores every file
+# against the research locally, keeps the PLAN_MAX_CANDIDATES most relevant
+# (plus changed files and files naming an older Opus) and plans them in
+# per-directory shards of at most PLAN_SHARD_SIZE, PLAN_WORKERS at a time.
+PLAN_SHARD_THRESHOLD = 150
+PLAN_SHARD_SIZE      = 80
+PLAN_MAX_CANDIDATES  = 400
+PLAN_WORKERS         = 4
+PLAN_SCORE_BYTES     = 64_000
+
+
+# ─── Response cache ──────────────────────────────────────────────────────────
+
+class ResponseCache:
+    """
+    On-disk cache of API responses, keyed by a SHA-256 of the full request.
+    Because prompts embed the file content, the key covers (model, prompt,
+    max_tokens, file content). Entries expire after `ttl` seconds, and once the
+    directory exceeds `max_bytes` the least recently used entries are evicted
+    (an entry's mtime is bumped on every hit).
+    """
+
+    def __init__(self, root: Path, ttl: float = CACHE_TTL_SECONDS, max_bytes: int = CACHE_MAX_BYTES):
+        self.root      = root
+        self.ttl       = ttl
+        self.max_bytes = max_bytes
+        self._lock     = threading.Lock()
+        root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(namespace: str, request: dict) -> str:
+        blob = json.dumps([namespace, request], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def get(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)  # mark as recently used for LRU eviction
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def put(self, key: str, value: dict) -> None:
+        path = self._path(key)
+        tmp  = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_text(
+                json.dumps({"created": time.time(), "value": value}, ensure_ascii=False),
+                encoding="utf-8",
+            )
+            os.replace(tmp, path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            log(f"     ⚠️  Cache write failed: {e}")
+            return
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            for p in self.root.glob(f"{'[0-9a-f]' * 64}.json"):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+            total = sum(size for _, size, _ in entries)
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                p.unlink(missing_ok=True)
+                total -= size
+
+
+# Set from --cache-dir / --no-cache in main(); None disables caching
+response_cache: ResponseCache | None = None
+
+
+# ─── Record / replay ─────────────────────────────────────────────────────────
+
+class FixtureMissing(LookupError):
+    """A replayed run made a request that was never recorded."""
+
+
+class FixtureStore:
+    """
+    Recorded API request/response pairs for offline runs. With --record every
+    live Claude and Perplexity response is saved under ResponseCache.key() of
+    the full request, together with the call's wall time. With --replay they
+    are served from disk instead, after sleeping for the recorded time ×
+    `latency_scale` (or a fixed `latency`), so the agent runs without
+    credentials or network and concurrency changes can be benchmarked
+    deterministically. Prompts embed the date and file contents, so replay
+    against the tree the fixtures were recorded on, with RESEARCH_AGENT_DATE
+    set to the recording date.
+    """
+
+    def __init__(self, root: Path, replaying: bool, latency_scale: float = 1.0, latency: float | None = None):
+        self.root          = root
+        self.replaying     = replaying
+        self.latency_scale = latency_scale
+        self.latency       = latency
+        meta = root / "meta.json"
+        if replaying:
+            try:
+                recorded = json.loads(meta.read_text(encoding="utf-8"))["date"]
+            except (OSError, ValueError, KeyError):
+                recorded = None
+            if recorded and recorded != TODAY:
+                log(f"  ⚠️  Fixtures were recorded on {recorded}; prompts embed the date, "
+                    f"so set RESEARCH_AGENT_DATE={recorded} to replay them")
+        else:
+            root.mkdir(parents=True, exist_ok=True)
+            meta.write_text(json.dumps({"date": TODAY}) + "\n", encoding="utf-8")
+
+    def record(self, namespace: str, request: dict, value: dict, seconds: float) -> None:
+        path = self.root / f"{ResponseCache.key(namespace, request)}.json"
+        tmp  = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_text(
+                json.dumps({"namespace": namespace, "seconds": round(seconds, 3), "value": value},
+                           ensure_ascii=False),
+                encoding="utf-8",
+            )
+            os.replace(tmp, path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            log(f"     ⚠️  Fixture write failed: {e}")
+
+    def replay(self, namespace: str, request: dict, sleep: bool = True) -> tuple[dict, float]:
+        """(recorded value, simulated seconds); sleeps for the latter unless `sleep` is False."""
+        key = ResponseCache.key(namespace, request)
+        try:
+            entry = json.loads((self.root / f"{key}.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            raise FixtureMissing(f"no {namespace} fixture {key[:12]} in {self.root}") from None
+        seconds = self.latency if self.latency is not None else entry["seconds"] * self.latency_scale
+        if sleep:
+            time.sleep(seconds)
+        return entry["value"], seconds
+
+
+# Set from --record / --replay in main(); None means live calls only
+fixtures: FixtureStore | None = None
+
+
+def replaying() -> bool:
+    return fixtures is not None and fixtures.replaying
+
+
+def record_fixture(namespace: str, request: dict, value: dict, seconds: float) -> None:
+    if fixtures is not None and not fixtures.replaying:
+        fixtures.record(namespace, request, value, seconds)
+
+
+# ─── Checkpoint journal ──────────────────────────────────────────────────────
+
+def _sha256(text: str | None) -> str | None:
+    return None if text is None else hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RunJournal:
+    """
+    Append-only JSON Lines checkpoint journal for `run`. A "start" line opens
+    each run, followed by "research", "plan" and one "file" line per
+    finished step (an update, a created skill, the skills index) with the
+    content hashes before and after it, and an "end" line once the run is
+    over. Every line is fsynced before the run moves on, so --resume can
+    pick up a crashed run where it stopped: research and plan are read back
+    and finished files are skipped. Edits are journaled with their content,
+    so a resume on a fresh checkout restores them instead of paying for
+    them again.
+    """
+
+    def __init__(self, path: Path):
+        self.path   = path
+        self.events: list[dict] = []
+        self._torn  = False
+        self._lock  = threading.Lock()
+
+    def load(self) -> bool:
+        """Read back the last run's events; False if there is no unfinished run."""
+        events: list[dict] = []
+        try:
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # A line torn by a crash mid-write; later appends start on a fresh line
+                        self._torn = not line.endswith("\n")
+                        continue
+                    self._torn = False
+                    if event.get("event") == "start":
+                        events = []
+                    events.append(event)
+        except OSError:
+            return False
+        if not events or events[-1]["event"] == "end":
+            return False
+        self.events = events
+        return True
+
+    def start(self) -> None:
+        """
+        Begin a new run. Earlier runs (with the file content they journaled)
+        move to `<path>.1`, replacing the one kept there, so the journal
+        never holds more than the current run.
+        """
+        with self._lock:
+            self.events = []
+            self._torn  = False
+            try:
+                os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+            except FileNotFoundError:
+                pass
+        self.append("start", date=TODAY)
+
+    def append(self, event: str, **fields) -> None:
+        entry = {"event": event, **fields}
+        with self._lock:
+            self.events.append(entry)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(("\n" if self._torn else "") + json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._torn = False
+
+    def last(self, event: str) -> dict | None:
+        with self._lock:
+            return next((e for e in reversed(self.events) if e["event"] == event), None)
+
+    def files(self, step: str) -> list[str]:
+        """Files with a journaled `step`, in the order they were first recorded."""
+        with self._lock:
+            return list(dict.fromkeys(
+                e["file"] for e in self.events if e["event"] == "file" and e["step"] == step
+            ))
+
+    def record_file(self, step: str, rel: str, before: str | None, after: str | None) -> None:
+        """A finished step on `rel`; `after` is None when the file was left as it was."""
+        self.append("file", step=step, file=rel, before=_sha256(before), after=_sha256(after), content=after)
+
+    def completed(self, step: str, rel: str) -> bool | None:
+        """
+        None if `step` on `rel` still has to run, else whether it changed the
+        file. A journaled edit missing from the tree is written back; a file
+        that has since changed some other way is done again.
+        """
+        with self._lock:
+            entry = next(
+                (e for e in reversed(self.events)
+                 if e["event"] == "file" and e["step"] == step and e["file"] == rel),
+                None,
+            )
+        if entry is None:
+            return None
+        path = REPO_ROOT / rel
+        try:
+            digest = _sha256(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            digest = None
+        if entry["after"] is None:
+            return False if digest == entry["before"] else None
+        if digest == entry["after"]:
+            return True
+        if digest == entry["before"]:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(entry["content"], encoding="utf-8")
+            log(f"  ↺ Restored {rel} from the journal")
+            return True
+        return None
+
+
+# Set in main() for `run`; None means no checkpoints
+journal: RunJournal | None = None
+
+
+# ─── Run report ──────────────────────────────────────────────────────────────
+
+def _usage_tokens(usage) -> dict:
+    """Normalise Anthropic (attrs) or Perplexity (dict) usage into token counts."""
+    if usage is None:
+        return {}
+    if isinstance(usage, dict):
+        return {
+            "input_tokens":  usage.get("prompt_tokens", 0) or 0,
+            "output_tokens": usage.get("completion_tokens", 0) or 0,
+        }
+    return {
+        "input_tokens":       getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens":      getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_tokens":  getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+
+
+class RunReport:
+    """
+    Thread-safe record of phase timings, every network call (wall time,
+    retries, tokens, bytes) and per-file I/O, written to run-report.json
+    and summarised at the end of main(). Calls are attributed to the label
+    set with `label()` on the calling thread, typically the file path.
+    """
+
+    def __init__(self):
+        self.started    = time.time()
+        self.startup_seconds: float | None = None
+        self.phases: list[dict] = []
+        self.calls: list[dict]  = []
+        self.files: dict[str, dict] = {}
+        self.routes: dict[str, dict] = {}
+        self.stop_reasons: dict[str, str | None] = {}
+        self._phase: tuple[str, float] | None = None
+        self._lock  = threading.Lock()
+        self._local = threading.local()
+
+    def start_phase(self, name: str) -> None:
+        """End the running phase (if any) and start timing `name`."""
+        with self._lock:
+            self._end_phase()
+            self._phase = (name, time.monotonic())
+
+    def end_phase(self) -> None:
+        with self._lock:
+            self._end_phase()
+
+    def _end_phase(self) -> None:
+        if self._phase is not None:
+            name, start = self._phase
+            self.phases.append({"name": name, "seconds": round(time.monotonic() - start, 3)})
+            self._phase = None
+
+    @contextmanager
+    def label(self, name: str | None):
+        previous = getattr(self._local, "label", None)
+        self._local.label = name
+        try:
+            yield
+        finally:
+            self._local.label = previous
+
+    def current_label(self) -> str | None:
+        return getattr(self._local, "label", None)
+
+    def record_call(
+        self,
+        provider: str,
+        kind: str,
+        seconds: float,
+        *,
+        label: str | None = None,
+        retries: int = 0,
+        usage=None,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        cached: bool = False,
+        error: str | None = None,
+        model: str | None = None,
+    ) -> None:
+        call = {
+            "provider":       provider,
+            "kind":           kind,
+            "model":          model,
+            "label":          label or self.current_label(),
+            "seconds":        round(seconds, 3),
+            "retries":        retries,
+            "bytes_sent":     bytes_sent,
+            "bytes_received": bytes_received,
+            "cached":         cached,
+            "error":          error,
+            **{field: 0 for field in TOKEN_FIELDS},
+            **_usage_tokens(usage),
+        }
+        with self._lock:
+            self.calls.append(call)
+
+    def note_stop(self, label: str | None, stop_reason: str | None) -> None:
+        """
+        Stop reason of the latest response written to the file `label`,
+        as is or as applied SEARCH/REPLACE edits (rewrites and patches,
+        streamed or not and online or batched, new skills, the skills
+        index), for truncated() to check.
+        """
+        if label:
+            with self._lock:
+                self.stop_reasons[label] = stop_reason
+
+    def clear_stop(self, label: str) -> None:
+        """Forget `label`'s stop reason before a new attempt at the file."""
+        with self._lock:
+            self.stop_reasons.pop(label, None)
+
+    def truncated(self, label: str) -> bool:
+        with self._lock:
+            return self.stop_reasons.get(label) == "max_tokens"
+
+    def failed(self, label: str) -> bool:
+        """Whether any call made under `label` ended in an error."""
+        with self._lock:
+            return any(call["label"] == label and call["error"] is not None for call in self.calls)
+
+    def record_file(self, rel: str, bytes_read: int, bytes_written: int) -> None:
+        with self._lock:
+            self.files[rel] = {"bytes_read": bytes_read, "bytes_written": bytes_written}
+
+    def record_route(self, rel: str, edit_type: str, model: str | None, why: str = "") -> None:
+        """Triage decision for one file: its edit type and the model it was routed to."""
+        with self._lock:
+            self.routes[rel] = {"edit_type": edit_type, "model": model, "why": why}
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            calls = list(self.calls)
+            files = {rel: dict(io) for rel, io in self.files.items()}
+            routes = {rel: dict(route) for rel, route in self.routes.items()}
+            truncated = sorted(label for label, reason in self.stop_reasons.items() if reason == "max_tokens")
+
+        totals = {"calls": len(calls), "cached_calls": 0, "retries": 0, "errors": 0,
+                  "call_seconds": 0.0, **{field: 0 for field in TOKEN_FIELDS}}
+        by_label: dict[str, dict] = {}
+        by_model: dict[str, dict] = {}
+        for call in calls:
+            totals["cached_calls"] += call["cached"]
+            totals["retries"]      += call["retries"]
+            totals["errors"]       += call["error"] is not None
+            totals["call_seconds"] += call["seconds"]
+            for field in TOKEN_FIELDS:
+                totals[field] += call[field]
+            if call["label"]:
+                entry = by_label.setdefault(call["label"], {"calls": 0, "seconds": 0.0,
+                                                            **{field: 0 for field in TOKEN_FIELDS}})
+                entry["calls"]   += 1
+                entry["seconds"]  = round(entry["seconds"] + call["seconds"], 3)
+                for field in TOKEN_FIELDS:
+                    entry[field] += call[field]
+            if call["model"]:
+                entry = by_model.setdefault(call["model"], {"calls": 0, **{field: 0 for field in TOKEN_FIELDS}})
+                entry["calls"] += 1
+                for field in TOKEN_FIELDS:
+                    entry[field] += call[field]
+        totals["call_seconds"] = round(totals["call_seconds"], 3)
+        for rel, io in files.items():
+            by_label.setdefault(rel, {"calls": 0, "seconds": 0.0,
+                                      **{field: 0 for field in TOKEN_FIELDS}}).update(io)
+
+        return {
+            "date":         TODAY,
+            "model":        CLAUDE_MODEL,
+            "started_at":   datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "wall_seconds": round(time.time() - self.started, 3),
+            "startup_seconds": self.startup_seconds,
+            "phases":       list(self.phases),
+            "totals":       totals,
+            "by_label":     by_label,
+            "by_model":     by_model,
+            "routing":      routes,
+            "truncated":    truncated,
+            "rate_limits":  {
+                limiter.name: limiter.snapshot()
+                for limiter in (*list(claude_limiters.values()), perplexity_limiter)
+            },
+            "calls":        calls,
+        }
+
+    def write(self, path: Path) -> None:
+        self.end_phase()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.as_dict(), indent=2) + "\n", encoding="utf-8")
+
+    def log_summary(self) -> None:
+        report = self.as_dict()
+        totals = report["totals"]
+        log("\n📊  Run summary")
+        log(f"  {'phase':<28}{'seconds':>10}")
+        for phase in report["phases"]:
+            log(f"  {phase['name']:<28}{phase['seconds']:>10.1f}")
+        log(f"  {'total':<28}{report['wall_seconds']:>10.1f}")
+        if report["startup_seconds"] is not None:
+            log(f"  startup: {report['startup_seconds']:.3f}s")
+        log(f"  calls: {totals['calls']} ({totals['cached_calls']} cached, "
+            f"{totals['retries']} retries, {totals['errors']} errors)")
+        log(f"  tokens: {totals['input_tokens']} in, {totals['output_tokens']} out, "
+            f"{totals['cache_read_tokens']} cache read, {totals['cache_write_tokens']} cache write")
+        for name, limits in report["rate_limits"].items():
+            if limits["throttled"] or limits["requests_per_minute"]:
+                log(f"  {name} limits: {limits['requests_per_minute'] or '?'} req/min, "
+                    f"{limits['tokens_per_minute'] or '?'} tokens/min, window {limits['window']}, "
+                    f"{limits['throttled']} throttled")
+        if report["routing"]:
+            tiers = Counter(route["edit_type"] for route in report["routing"].values())
+            log("  triage: " + ", ".join(f"{n} {edit_type}" for edit_type, n in sorted(tiers.items())))
+        costly = sorted(
+            report["by_label"].items(),
+            key=lambda kv: kv[1]["input_tokens"] + kv[1]["output_tokens"],
+            reverse=True,
+        )[:5]
+        if costly and costly[0][1]["calls"]:
+            log(f"  {'most expensive':<48}{'calls':>6}{'seconds':>9}{'in':>9}{'out':>8}")
+            for label, entry in costly:
+                log(f"  {label[:47]:<48}{entry['calls']:>6}{entry['seconds']:>9.1f}"
+                    f"{entry['input_tokens']:>9}{entry['output_tokens']:>8}")
+
+
+run_report = RunReport()
+
+
+# ─── Claude calls with a shared adaptive rate limiter ────────────────────────
+
+class _Bucket:
+    """Token bucket refilled evenly over a minute; an unknown (None) capacity never blocks."""
+
+    def __init__(self, per_minute: float | None = None):
+        self.capacity = per_minute
+        self.level    = per_minute or 0.0
+        self.stamp    = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.stamp) * self.capacity / 60)
+        self.stamp = now
+
+    def wait(self, amount: float) -> float:
+        """Seconds until `amount` is available; a request larger than the bucket waits for a full one."""
+        if not self.capacity:
+            return 0.0
+        return max(0.0, (min(amount, self.capacity) - self.level) * 60 / self.capacity)
+
+    def take(self, amount: float) -> None:
+        if self.capacity:
+            self.level -= amount
+
+    def learn(self, limit: float, remaining: float | None) -> None:
+        """Adopt the server's view: its limit, and its remaining count if lower than ours."""
+        known = self.capacity is not None
+        self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining) if known else remaining
+        elif not known:
+            self.level = limit
+
+
+class RateLimiter:
+    """
+    Process-wide limiter for one provider, shared by every worker thread:
+    token buckets for requests and tokens per minute, plus an AIMD window
+    on concurrent calls. Limits start unknown unless given and are learned
+    by observe() from the rate-limit headers of every response
+    (`header_names` maps "requests" / "tokens" to candidate (limit,
+    remaining) header pairs). Each successful call widens the window by
+    1/window, about one slot per window of successes; a 429 halves it (once
+    per back-off) and pauses every caller for its retry-after.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        header_names: dict[str, list[tuple[str, str]]],
+        requests_per_minute: float | None = None,
+        window: float = RATE_LIMIT_WINDOW_START,
+        max_window: float = RATE_LIMIT_WINDOW_MAX,
+    ):
+        self.name         = name
+        self.header_names = header_names
+        self.buckets      = {"requests": _Bucket(requests_per_minute), "tokens": _Bucket()}
+        self.window       = float(window)
+        self.max_window   = float(max_window)
+        self.active       = 0
+        self.throttled    = 0
+        self._resume_at   = 0.0
+        self._cond        = threading.Condition()
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until a call estimated at `tokens` input tokens may start, and count it."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for bucket in self.buckets.values():
+                    bucket.refill(now)
+                wait = max(
+                    self._resume_at - now,
+                    self.buckets["requests"].wait(1),
+                    self.buckets["tokens"].wait(tokens),
+                )
+                if wait <= 0 and self.active < int(self.window):
+                    self.active += 1
+                    self.buckets["requests"].take(1)
+                    self.buckets["tokens"].take(tokens)
+                    return
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, ok: bool) -> None:
+        """End a call started with acquire(); a success widens the window."""
+        with self._cond:
+            self.active -= 1
+            if ok:
+                self.window = min(self.max_window, self.window + 1 / self.window)
+            self._cond.notify_all()
+
+    def observe(self, status: int, headers) -> None:
+        """Learn from one HTTP response, including ones a client library retries by itself."""
+        with self._cond:
+            for kind, pairs in self.header_names.items():
+                for limit_name, remaining_name in pairs:
+                    limit = _header_number(headers, limit_name)
+                    if limit:
+                        self.buckets[kind].learn(limit, _header_number(headers, remaining_name))
+                        break
+            if status == 429:
+                self.throttled += 1
+                if time.monotonic() >= self._resume_at:
+                    self.window = max(1.0, self.window / 2)
+                self._pause(_header_number(headers, "retry-after") or 0.0)
+
+    def pause(self, seconds: float) -> None:
+        with self._cond:
+            self._pause(seconds)
+
+    def _pause(self, seconds: float) -> None:
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "window":              round(self.window, 2),
+                "throttled":           self.throttled,
+                "requests_per_minute": self.buckets["requests"].capacity,
+                "tokens_per_minute":   self.buckets["tokens"].capacity,
+            }
+
+
+def _header_number(headers, name: str) -> float | None:
+    try:
+        return float(headers.get(name, ""))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+# Input tokens/min is the limit prompts run into; the combined tokens limit
+# (older tiers) is the fallback
+ANTHROPIC_LIMIT_HEADERS = {
+    "requests": [("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining")],
+    "tokens":   [("anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-input-tokens-remaining"),
+                 ("anthropic-ratelimit-tokens-limit", "anthropic-ratelimit-tokens-remaining")],
+}
+# Anthropic sets its limits per model, so each model (triage, light and
+# update tiers) learns and throttles on a limiter of its own
+claude_limiters: dict[str, RateLimiter] = {}
+_claude_limiters_lock = threading.Lock()
+REQUEST_MODEL_RE = re.compile(rb'"model"\s*:\s*"([^"]+)"')
+
+
+def claude_limiter(model: str | None) -> RateLimiter:
+    """The RateLimiter for `model`, created on first use."""
+    model = model or CLAUDE_MODEL
+    with _claude_limiters_lock:
+        if model not in claude_limiters:
+            claude_limiters[model] = RateLimiter(f"anthropic {model}", ANTHROPIC_LIMIT_HEADERS)
+        return claude_limiters[model]
+
+
+def _observe_claude(response) -> None:
+    """httpx response hook: feed a Messages API response to its model's limiter."""
+    if not response.request.url.path.endswith("/messages"):
+        return  # batches, token counting, ...: limits not tied to one model's calls
+    try:
+        m = REQUEST_MODEL_RE.search(response.request.content)
+    except Exception:  # a streamed request body that cannot be read back
+        m = None
+    claude_limiter(m.group(1).decode("utf-8") if m else None).observe(response.status_code, response.headers)
+
+
+perplexity_limiter = RateLimiter("perplexity", {
+    "requests": [("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests")],
+    "tokens":   [("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens")],
+}, requests_per_minute=PERPLEXITY_RPM or None)
+
+
+def request_tokens(params: dict) -> int:
+    """estimate_tokens() of the system and message text of a messages.create request."""
+    system = params.get("system") or ""
+    texts  = [system] if isinstance(system, str) else [block.get("text", "") for block in system]
+    for message in params.get("messages", []):
+        content = message["content"]
+        texts += [content] if isinstance(content, str) else [block.get("text", "") for block in content]
+    return sum(estimate_tokens(text) for text in texts)
+
+
+def _retry_after_seconds(error: anthropic.APIStatusError) -> float | None:
+    """Read the retry-after header from a 429 response, if present."""
+    try:
+        return float(error.response.headers.get("retry-after", ""))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def cached_message(params: dict) -> anthropic.types.Message | None:
+    """Look up a Claude response for these request params in response_cache."""
+    if response_cache is None:
+        return None
+    cached = response_cache.get(response_cache.key("anthropic", params))
+    return anthropic.types.Message.model_validate(cached) if cached is not None else None
+
+
+def store_message(params: dict, message: anthropic.types.Message) -> None:
+    if response_cache is not None:
+        response_cache.put(response_cache.key("anthropic", params), message.model_dump(mode="json"))
+
+
+# ─── Research context packing ────────────────────────────────────────────────
+
+# Letter runs, digit runs, newline runs and single symbols; spaces ride along
+# with the following word
+TOKEN_PIECE_RE = re.compile(r"[^\W\d_]+|\d+|\n+|[^\w\s]")
+CITATION_RE    = re.compile(r"\[(\d{1,2})\]")
+PASSAGE_TAG_RE = re.compile(r"^\[([a-z_]+\.\d+)\] ", re.MULTILINE)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local estimate of Claude's token count, without a network call or
+    tokenizer dependency: about four ASCII letters or three digits per
+    token, one per symbol, newline run or non-ASCII letter.
+    """
+    tokens = 0
+    for piece in TOKEN_PIECE_RE.findall(text):
+        if piece[0].isdigit():
+            tokens += math.ceil(len(piece) / 3)
+        elif piece.isascii() and piece[0].isalpha():
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += 1 if not piece[0].isalpha() else len(piece)
+    return tokens
+
+
+def clip_tokens(text: str, budget: int) -> str:
+    """The longest whole-line prefix of `text` that fits in `budget` tokens."""
+    kept, used = [], 0
+    for line in text.splitlines(keepends=True):
+        used += estimate_tokens(line)
+        if used > budget:
+            break
+        kept.append(line)
+    return "".join(kept)
+
+
+def research_sections(research: str) -> list[tuple[str, str, list[str]]]:
+    """(topic, content, source URLs) for each section of an assemble_research() document."""
+    sections = []
+    for section in research.split("\n\n---\n\n"):
+        head, _, body = section.partition("\n")
+        if head.startswith("# Research"):
+            head, _, body = body.lstrip("\n").partition("\n")
+        if not head.startswith("## "):
+            continue
+        content, _, sources = body.rpartition("\n\nSources:\n")
+        if not content:
+            content, sources = body, ""
+        urls = [line.strip()[2:] for line in sources.splitlines() if line.strip().startswith("- ")]
+        sections.append((head[3:].strip().lower(), content, urls))
+    return sections
+
+
+@lru_cache(maxsize=4)
+def research_passages(research: str) -> tuple[dict, ...]:
+    """
+    Split an assemble_research() document into passages: one per paragraph
+    of each topic, with a short heading line kept with the paragraph it
+    introduces. Each passage carries its tag (`topic.n`), the sources its
+    [n] markers cite, its rendered text and its token estimate and terms.
+    """
+    passages = []
+    for topic, content, urls in research_sections(research):
+        paragraphs, pending = [], ""
+        for para in re.split(r"\n\s*\n", content.strip()):
+            para = para.strip()
+            if not para:
+                continue
+            if len(para) < 120 and "\n" not in para and (para.startswith("#") or para.endswith(":")):
+                pending += para + "\n"
+                continue
+            paragraphs.append(pending + para)
+            pending = ""
+        if pending:
+            paragraphs.append(pending.strip())
+
+        for n, para in enumerate(paragraphs, 1):
+            cited = sorted({int(i) for i in CITATION_RE.findall(para) if 0 < int(i) <= len(urls)})
+            text = f"[{topic}.{n}] {para}"
+            if cited:
+                text += "\nSources: " + " ".join(f"[{i}] {urls[i - 1]}" for i in cited)
+            passages.append({
+                "tag":    f"{topic}.{n}",
+                "topic":  topic,
+                "index":  n,
+                "text":   text,
+                "tokens": estimate_tokens(text),
+                "terms":  _terms(para),
+            })
+    return tuple(passages)
+
+
+def pack_research(
+    research: str,
+    budget: int,
+    focus: str | None = None,
+    exclude: frozenset[str] = frozenset(),
+) -> str:
+    """
+    The research passages that best serve one call, within `budget`
+    estimated tokens. With `focus` (the file path, content and planner
+    reason, or a skill topic) passages are ranked by TF-IDF against it;
+    the rest, and every passage without a focus, follow round-robin across
+    topics so late sections get a share of the budget. The first
+    latest_claude_model passage always goes first. Passages whose tag is
+    in `exclude` are left out. Picked passages are emitted in document
+    order under their topic headings.
+    """
+    passages = research_passages(research)
+    if not passages:
+        return "" if exclude else clip_tokens(research, budget)
+
+    # Round-robin: every topic's first passage, then every topic's second, ...
+    coverage = sorted(range(len(passages)), key=lambda i: passages[i]["index"])
+    ranked = [i for i in coverage if passages[i]["tag"] == "latest_claude_model.1"]
+    if focus:
+        df = Counter()
+        for p in passages:
+            df.update(p["terms"].keys())
+        query = {t: 1 + math.log(n) for t, n in _terms(focus).items() if t in df and t not in REASON_STOPWORDS}
+
+        def score(p: dict) -> float:
+            total = sum(
+                (1 + math.log(p["terms"][t])) * math.log(1 + len(passages) / df[t]) * w
+                for t, w in query.items() if t in p["terms"]
+            )
+            return total / math.sqrt(len(p["terms"]) or 1)
+
+        scores = {i: score(passages[i]) for i in coverage}
+        ranked += sorted((i for i in coverage if scores[i] > 0), key=lambda i: -scores[i])
+    ranked += coverage
+
+    # Each passage costs its text plus a separator, and the first of a topic its heading too
+    picked, topics, used = set(), set(), 0
+    for i in ranked:
+        topic = passages[i]["topic"]
+        cost = passages[i]["tokens"] + 1
+        if topic not in topics:
+            cost += estimate_tokens(f"### {topic.upper()}") + 1
+        if i in picked or passages[i]["tag"] in exclude or used + cost > budget:
+            continue
+        picked.add(i)
+        topics.add(topic)
+        used += cost
+
+    out, topic = [], None
+    for i in sorted(picked):
+        if passages[i]["topic"] != topic:
+            topic = passages[i]["topic"]
+            out.append(f"### {topic.upper()}")
+        out.append(passages[i]["text"])
+    return "\n\n".join(out)
+
+
+def research_system(research: str, *references: str) -> list[dict]:
+    """
+    System blocks holding the shared research pack (and optional reference
+    text such as the skill format reference), each ending in a
+    cache_control breakpoint. The blocks are the same for every call, so
+    after the first one that prefix is read from the prompt cache; what is
+    specific to one file goes in its user turn (see focused_research).
+    """
+    blocks = [{
+        "type": "text",
+        "text": (
+            "You maintain a Claude/Anthropic prompt engineering guide repository.\n\n"
+            f"## Research (as of {TODAY}; passages tagged [topic.n]):\n"
+            f"{pack_research(research, RESEARCH_CONTEXT_TOKENS)}"
+        ),
+        "cache_control": {"type": "ephemeral"},
+    }]
+    for text in references:
+        blocks.append({"type": "text", "text": text, "cache_control": {"type": "ephemeral"}})
+    return blocks
+
+
+@lru_cache(maxsize=4)
+def _shared_tags(research: str) -> frozenset[str]:
+    """Tags of the passages research_system() packs for every call."""
+    return frozenset(PASSAGE_TAG_RE.findall(pack_research(research, RESEARCH_CONTEXT_TOKENS)))
+
+
+def focused_research(research: str, focus: str) -> str:
+    """
+    User-turn block of the passages ranked most relevant to `focus` that the
+    shared research_system() pack leaves out, within RESEARCH_FOCUS_TOKENS;
+    empty when there are none. Keeping them out of the system prompt keeps
+    its cached prefix identical across per-file calls.
+    """
+    packed = pack_research(research, RESEARCH_FOCUS_TOKENS, focus, _shared_tags(research))
+    if not packed:
+        return ""
+    return f"## More research relevant to this task (passages tagged [topic.n]):\n{packed}\n\n"
+
+
+def log_usage(usage) -> None:
+    """Log input/output tokens and prompt-cache reads/writes from resp.usage."""
+    if usage is None:
+        return
+    cache_read  = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    status = "hit" if cache_read else ("miss, written" if cache_write else "miss")
+    log(f"     tokens: {usage.input_tokens} in + {cache_read} cache read + "
+        f"{cache_write} cache write, {usage.output_tokens} out (prompt cache {status})")
+
+
+def claude_create(**kwargs):
+    """
+    claude.messages.create through its model's claude_limiter(), retrying 429 responses
+    with exponential backoff (retry-after wins when sent).
+    Responses are served from / stored in response_cache when it is enabled,
+    and recorded to / replayed from fixtures with --record / --replay.
+    """
+    if replaying():
+        try:
+            value, seconds = fixtures.replay("anthropic", kwargs)
+        except FixtureMissing:
+            run_report.record_call("anthropic", "messages", 0.0, error="FixtureMissing", model=kwargs.get("model"))
+            raise
+        resp = anthropic.types.Message.model_validate(value)
+        run_report.record_call("anthropic", "messages", seconds, usage=resp.usage, model=kwargs.get("model"))
+        return resp
+
+    cached = cached_message(kwargs)
+    if cached is not None:
+        log("     ↺ Claude response served from cache")
+        run_report.record_call("anthropic", "messages", 0.0, cached=True, model=kwargs.get("model"))
+        return cached
+
+    start      = time.monotonic()
+    retries    = 0
+    bytes_sent = len(json.dumps(kwargs, ensure_ascii=False).encode("utf-8"))
+    tokens     = request_tokens(kwargs)
+    limiter    = claude_limiter(kwargs.get("model"))
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            limiter.acquire(tokens)
+            ok = False
+            try:
+                resp = claude.messages.create(**kwargs)
+                ok = True
+                break
+            except anthropic.RateLimitError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retries += 1
+                delay = _retry_after_seconds(e) or RATE_LIMIT_BASE_DELAY * 2 ** attempt
+                log(f"     ⏳ Rate limited (429), backing off {delay:.1f}s "
+                    f"[{attempt + 1}/{RATE_LIMIT_RETRIES}]")
+                limiter.pause(delay)
+            finally:
+                limiter.release(ok)
+    except Exception as e:
+        run_report.record_call(
+            "anthropic", "messages", time.monotonic() - start,
+            retries=retries, bytes_sent=bytes_sent, error=type(e).__name__, model=kwargs.get("model"),
+        )
+        raise
+
+    run_report.record_call(
+        "anthropic", "messages", time.monotonic() - start,
+        retries=retries, usage=resp.usage, bytes_sent=bytes_sent,
+        bytes_received=sum(len(getattr(b, "text", "").encode("utf-8")) for b in resp.content),
+        model=kwargs.get("model"),
+    )
+    log_usage(resp.usage)
+    store_message(kwargs, resp)
+    record_fixture("anthropic", kwargs, resp.model_dump(mode="json"), time.monotonic() - start)
+    return resp
+
+
+def claude_stream_text(**kwargs):
+    """
+    Yield text deltas from claude.messages.stream with the same limiter and
+    429 backoff as claude_create. A cache hit yields the stored text as a single chunk;
+    only streams that run to completion are written to the cache, so a
+    caller that stops reading early leaves nothing behind. A replayed
+    fixture is yielded in REPLAY_STREAM_CHUNKS pieces spread over its
+    simulated latency.
+    """
+    if replaying():
+        try:
+            value, seconds = fixtures.replay("anthropic", kwargs, sleep=False)
+        except FixtureMissing:
+            run_report.record_call("anthropic", "stream", 0.0, error="FixtureMissing", model=kwargs.get("model"))
+            raise
+        message = anthropic.types.Message.model_validate(value)
+        run_report.record_call("anthropic", "stream", seconds, usage=message.usage, model=kwargs.get("model"))
+        run_report.note_stop(run_report.current_label(), message.stop_reason)
+        text = message.content[0].text
+        step = max(len(text) // REPLAY_STREAM_CHUNKS, 1)
+        for i in range(0, len(text), step):
+            time.sleep(seconds * step / max(len(text), 1))
+            yield text[i:i + step]
+        return
+
+    cached = cached_message(kwargs)
+    if cached is not None:
+        log("     ↺ Claude response served from cache")
+        run_report.record_call("anthropic", "stream", 0.0, cached=True, model=kwargs.get("model"))
+        run_report.note_stop(run_report.current_label(), cached.stop_reason)
+        yield cached.content[0].text
+        return
+
+    start    = time.monotonic()
+    retries  = 0
+    received = 0
+    final    = None
+    error    = None
+    label    = run_report.current_label()
+    tokens   = request_tokens(kwargs)
+    limiter  = claude_limiter(kwargs.get("model"))
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            # The stream holds its slot until it ends, or the caller stops reading
+            limiter.acquire(tokens)
+            ok = False
+            try:
+                with claude.messages.stream(**kwargs) as stream:
+                    for text in stream.text_stream:
+                        received += len(text.encode("utf-8"))
+                        yield text
+                    final = stream.get_final_message()
+                ok = True
+                break
+            except anthropic.RateLimitError as e:
+                # 429s arrive before the first event, so nothing has been yielded yet
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retries += 1
+                delay = _retry_after_seconds(e) or RATE_LIMIT_BASE_DELAY * 2 ** attempt
+                log(f"     ⏳ Rate limited (429), backing off {delay:.1f}s "
+                    f"[{attempt + 1}/{RATE_LIMIT_RETRIES}]")
+                limiter.pause(delay)
+            finally:
+                limiter.release(ok)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        # Also runs when the caller stops reading early (GeneratorExit)
+        run_report.record_call(
+            "anthropic", "stream", time.monotonic() - start,
+            label=label, retries=retries, usage=final.usage if final else None,
+            bytes_sent=len(json.dumps(kwargs, ensure_ascii=False).encode("utf-8")),
+            bytes_received=received, error=error, model=kwargs.get("model"),
+        )
+
+    log_usage(final.usage)
+    run_report.note_stop(label, final.stop_reason)
+    store_message(kwargs, final)
+    record_fixture("anthropic", kwargs, final.model_dump(mode="json"), time.monotonic() - start)
+
 
 # ─── Phase 1: Research (parallel) ────────────────────────────────────────────
 
@@ -133,40 +1400,109 @@ RESEARCH_QUERIES = [
 ]
 
 
-def perplexity_query(topic: str, query: str) -> dict:
-    """Single Perplexity sonar-pro query with 60s timeout."""
+def _perplexity_post(topic: str, payload: dict, deadline: float) -> tuple[requests.Response, int]:
+    """
+    POST to Perplexity on the shared session, retrying 429/5xx responses,
+    connection errors and timeouts with full-jitter exponential backoff
+    (retry-after wins when sent). Never waits past `deadline`. Returns the
+    response and the number of retries; raises the last error when out of
+    attempts or time.
+    """
+    for attempt in range(PERPLEXITY_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("research deadline exceeded")
+
+        retry_after = None
+        perplexity_limiter.acquire(estimate_tokens(json.dumps(payload["messages"])))
+        ok = False
+        try:
+            resp = perplexity.post(PERPLEXITY_URL, json=payload, timeout=min(PERPLEXITY_TIMEOUT, remaining))
+            perplexity_limiter.observe(resp.status_code, resp.headers)
+            if resp.status_code not in PERPLEXITY_RETRY_STATUS:
+                resp.raise_for_status()
+                ok = True
+                return resp, attempt
+            error = requests.HTTPError(f"{resp.status_code} from Perplexity", response=resp)
+            retry_after = _header_number(resp.headers, "retry-after")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            perplexity_limiter.release(ok)
+
+        delay = retry_after or random.uniform(0, min(PERPLEXITY_BACKOFF_MAX, PERPLEXITY_BACKOFF_BASE * 2 ** attempt))
+        if attempt == PERPLEXITY_RETRIES or time.monotonic() + delay >= deadline:
+            error.retries = attempt
+            raise error
+        log(f"    ⏳ [{topic}] {error}; retrying in {delay:.1f}s [{attempt + 1}/{PERPLEXITY_RETRIES}]")
+        time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def perplexity_query(topic: str, query: str, deadline: float | None = None) -> dict:
+    """Single Perplexity sonar-pro query, retried until `deadline` (monotonic)."""
     log(f"    → [{topic}] starting...")
-    try:
-        resp = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers={
-                "Authorization": f"Bearer {PERPLEXITY_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "sonar-pro",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a professional AI research analyst. "
-                            "Provide factual, precise, citation-backed findings. "
-                            "Focus on: exact version numbers, dates, feature names, "
-                            "pricing figures, API model IDs. No speculation or filler."
-                        ),
-                    },
-                    {"role": "user", "content": query},
-                ],
+    payload = {
+        "model": "sonar-pro",
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "You are a professional AI research analyst. "
+                    "Provide factual, precise, citation-backed findings. "
+                    "Focus on: exact version numbers, dates, feature names, "
+                    "pricing figures, API model IDs. No speculation or filler."
+                ),
             },
-            timeout=60,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        content  = data["choices"][0]["message"]["content"]
-        citations = data.get("citations", [])
+            {"role": "user", "content": query},
+        ],
+    }
+
+    if replaying():
+        try:
+            value, seconds = fixtures.replay("perplexity", payload)
+        except FixtureMissing as e:
+            run_report.record_call("perplexity", "chat", 0.0, label=topic, error="FixtureMissing")
+            log(f"    ⚠️  [{topic}] failed: {e}")
+            return {"topic": topic, "content": "", "citations": []}
+        run_report.record_call("perplexity", "chat", seconds, label=topic)
+        log(f"    ✓ [{topic}] replayed ({len(value['content'])} chars)")
+        return {"topic": topic, **value}
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = response_cache.key("perplexity", payload)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            log(f"    ↺ [{topic}] served from cache")
+            run_report.record_call("perplexity", "chat", 0.0, label=topic, cached=True)
+            return {"topic": topic, **cached}
+
+    start   = time.monotonic()
+    retries = 0
+    if deadline is None:
+        deadline = start + RESEARCH_DEADLINE_SECONDS
+    try:
+        resp, retries = _perplexity_post(topic, payload, deadline)
+        data = resp.json()
+        content  = data["choices"][0]["message"]["content"]
+        citations = data.get("citations", [])
+        run_report.record_call(
+            "perplexity", "chat", time.monotonic() - start, label=topic, retries=retries,
+            usage=data.get("usage"), bytes_sent=len(json.dumps(payload).encode("utf-8")),
+            bytes_received=len(resp.content),
+        )
         log(f"    ✓ [{topic}] done ({len(content)} chars, {len(citations)} sources)")
+        if cache_key is not None:
+            response_cache.put(cache_key, {"content": content, "citations": citations})
+        record_fixture("perplexity", payload, {"content": content, "citations": citations},
+                       time.monotonic() - start)
         return {"topic": topic, "content": content, "citations": citations}
     except Exception as e:
+        run_report.record_call(
+            "perplexity", "chat", time.monotonic() - start, label=topic,
+            retries=getattr(e, "retries", retries), error=type(e).__name__,
+        )
         log(f"    ⚠️  [{topic}] failed: {e}")
         return {"topic": topic, "content": "", "citations": []}
 
@@ -178,19 +1514,28 @@ def gather_research() -> tuple[str, str]:
     """
     log("  Launching 6 Perplexity queries in parallel...")
     results_map: dict[str, dict] = {}
+    deadline = time.monotonic() + RESEARCH_DEADLINE_SECONDS
 
     with ThreadPoolExecutor(max_workers=6) as pool:
         futures = {
-            pool.submit(perplexity_query, topic, query): topic
+            pool.submit(perplexity_query, topic, query, deadline): topic
             for topic, query in RESEARCH_QUERIES
         }
         for future in as_completed(futures):
             result = future.result()
             results_map[result["topic"]] = result
 
-    # Assemble in original query order for consistent research doc
+    full_research = assemble_research(results_map)
+    latest_model  = extract_latest_model(results_map.get("latest_claude_model", {}).get("content", ""))
+    return full_research, latest_model
+
+
+def assemble_research(results_map: dict[str, dict]) -> str:
+    """
+    Join query results in RESEARCH_QUERIES order for a consistent research
+    doc. Exits the run when every query failed.
+    """
     sections = []
-    latest_model_raw = ""
     for topic, _ in RESEARCH_QUERIES:
         result = results_map.get(topic, {})
         if result.get("content"):
@@ -198,13 +1543,8 @@ def gather_research() -> tuple[str, str]:
             sections.append(
                 f"## {topic.upper()}\n{result['content']}\n\nSources:\n{sources}"
             )
-            if topic == "latest_claude_model":
-                latest_model_raw = result["content"]
-
-    full_research = f"# Research — {TODAY}\n\n" + "\n\n---\n\n".join(sections)
 
     # Abort if every Perplexity query failed — no research = no reliable updates
-    successful = sum(1 for _, r in RESEARCH_QUERIES if results_map.get(r[0] if isinstance(r, tuple) else _, {}).get("content"))
     if not sections:
         log("\n❌  All Perplexity queries failed (401 Unauthorized).")
         log("   Check your PERPLEXITY_API_KEY secret:")
@@ -212,299 +1552,2464 @@ def gather_research() -> tuple[str, str]:
         log("   Get a valid key from: https://console.perplexity.ai")
         sys.exit(1)
 
-    # Extract canonical latest model name
+    return f"# Research — {TODAY}\n\n" + "\n\n---\n\n".join(sections)
+
+
+def extract_latest_model(latest_model_raw: str) -> str:
+    """Ask Claude for the canonical latest Opus name in the latest_claude_model research."""
     latest_model = "Claude Opus 4.6"  # safe fallback
     if latest_model_raw:
         try:
             log("  Extracting latest model name from research...")
-            resp = claude.messages.create(
-                model=CLAUDE_MODEL,
-                max_tokens=50,
-                messages=[{
-                    "role": "user",
-                    "content": (
-                        "From this text, extract ONLY the latest Claude Opus model name "
-                        "(e.g. 'Claude Opus 4.6' or 'Claude Opus 5'). "
-                        "Return the model name only, nothing else.\n\n"
-                        f"{latest_model_raw[:1000]}"
-                    ),
-                }],
-            )
+            with run_report.label("latest_model"):
+                resp = claude_create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=50,
+                    messages=[{
+                        "role": "user",
+                        "content": (
+                            "From this text, extract ONLY the latest Claude Opus model name "
+                            "(e.g. 'Claude Opus 4.6' or 'Claude Opus 5'). "
+                            "Return the model name only, nothing else.\n\n"
+                            f"{clip_tokens(latest_model_raw, LATEST_MODEL_TOKENS)}"
+                        ),
+                    }],
+                )
             extracted = resp.content[0].text.strip()
             if extracted:
                 latest_model = extracted
         except Exception as e:
             log(f"  ⚠️  Model extraction failed ({e}), using fallback: {latest_model}")
 
-    return full_research, latest_model
+    return latest_model
+
+
+# ─── Phase 1b: Research history ──────────────────────────────────────────────
+
+# Normalized facts pulled from research prose: model names and API IDs,
+# version numbers and prices (per million tokens)
+MODEL_NAME_RE = re.compile(
+    r"\bClaude\s+(?:(Opus|Sonnet|Haiku)\s+(\d+(?:\.\d+)?)|(\d+(?:\.\d+)?)\s+(Opus|Sonnet|Haiku))\b", re.IGNORECASE
+)
+MODEL_ID_RE = re.compile(r"\bclaude-(?=[a-z0-9.-]*\d)[a-z0-9][a-z0-9.-]*[a-z0-9]\b", re.IGNORECASE)
+VERSION_RE  = re.compile(r"\b(?:v|version\s+)(\d+\.\d+(?:\.\d+)?)\b|(?<![\w.$])(\d+\.\d+\.\d+)(?![\w.])", re.IGNORECASE)
+PRICE_RE    = re.compile(r"\$\s?(\d+(?:\.\d+)?)")
+PRICE_CONTEXT_RE = re.compile(r"million|MTok|\bM tokens|per 1M", re.IGNORECASE)
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# Committed runs kept in the history database
+HISTORY_KEEP_RUNS = 60
+
+
+def research_facts(topic: str, text: str) -> set[tuple[str, str, str]]:
+    """
+    (kind, subject, value) facts in `text`: ("model", "claude opus 4.6", ""),
+    ("model_id", "claude-opus-4-6", ""), ("version", topic, "2.1.3") and
+    ("price", model name or topic, "$15"), a price only when its sentence
+    talks about tokens per million.
+    """
+    facts = set()
+    for sentence in SENTENCE_RE.split(text):
+        models = [
+            f"claude {(family or family_b).lower()} {version or version_b}"
+            for family, version, version_b, family_b in MODEL_NAME_RE.findall(sentence)
+        ]
+        facts.update(("model", model, "") for model in models)
+        facts.update(("model_id", model_id.lower(), "") for model_id in MODEL_ID_RE.findall(sentence))
+        facts.update(("version", topic, a or b) for a, b in VERSION_RE.findall(sentence))
+        if PRICE_CONTEXT_RE.search(sentence):
+            subject = models[0] if models else topic
+            facts.update(("price", subject, f"${float(price):g}") for price in PRICE_RE.findall(sentence))
+    return facts
+
+
+def normalize_url(url: str) -> str:
+    """Lower-case scheme and host, no fragment, tracking parameters or trailing slash."""
+    parts = urlsplit(url.strip())
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query) if not k.startswith("utm_")])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), query, ""))
+
+
+def _describe_fact(fact: tuple[str, str, str]) -> str:
+    kind, subject, value = fact
+    if kind == "price":
+        return f"{subject} {value}/MTok"
+    if kind == "version":
+        return f"version {value}"
+    return subject
+
+
+class ResearchHistory:
+    """
+    SQLite store of the normalized facts (see research_facts) and citation
+    URLs of each day's research. record() saves today's extraction as a
+    pending run and diffs it against the last committed one; commit() marks
+    the pending run committed once its changes have been acted on (a PR
+    opened, or the repo found current), so a dry run, failed run or quiet
+    day is measured against the same baseline again tomorrow.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id        INTEGER PRIMARY KEY,
+            date      TEXT NOT NULL,
+            committed INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS facts (
+            run     INTEGER NOT NULL,
+            topic   TEXT NOT NULL,
+            kind    TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            value   TEXT NOT NULL,
+            PRIMARY KEY (run, kind, subject, value)
+        );
+        CREATE TABLE IF NOT EXISTS citations (
+            run   INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            url   TEXT NOT NULL,
+            PRIMARY KEY (run, url)
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, research: str) -> dict:
+        """
+        Store the facts and citations of `research` as the pending run.
+        Returns the delta against the last committed run: {"since": its date
+        (None if there is none), "added": {fact: topic}, "removed": {fact:
+        topic}, "new_citations": [url]}.
+        """
+        facts: dict[tuple, str] = {}
+        citations: dict[str, str] = {}
+        for topic, content, urls in research_sections(research):
+            for fact in research_facts(topic, content):
+                facts.setdefault(fact, topic)
+            for url in urls:
+                citations.setdefault(normalize_url(url), topic)
+
+        with self._connect() as db:
+            base = db.execute("SELECT id, date FROM runs WHERE committed ORDER BY id DESC LIMIT 1").fetchone()
+            db.execute(
+                "DELETE FROM runs WHERE NOT committed OR id NOT IN "
+                "(SELECT id FROM runs WHERE committed ORDER BY id DESC LIMIT ?)", (HISTORY_KEEP_RUNS,)
+            )
+            for table in ("facts", "citations"):
+                db.execute(f"DELETE FROM {table} WHERE run NOT IN (SELECT id FROM runs)")
+            run = db.execute("INSERT INTO runs (date) VALUES (?)", (TODAY,)).lastrowid
+            db.executemany(
+                "INSERT INTO facts VALUES (?, ?, ?, ?, ?)",
+                [(run, topic, *fact) for fact, topic in facts.items()],
+            )
+            db.executemany("INSERT INTO citations VALUES (?, ?, ?)", [(run, t, u) for u, t in citations.items()])
+            if base is None:
+                return {"since": None, "added": facts, "removed": {}, "new_citations": list(citations)}
+            old_facts = {
+                (kind, subject, value): topic
+                for topic, kind, subject, value in db.execute(
+                    "SELECT topic, kind, subject, value FROM facts WHERE run = ?", (base[0],)
+                )
+            }
+            old_urls = {url for (url,) in db.execute("SELECT url FROM citations WHERE run = ?", (base[0],))}
+        return {
+            "since":         base[1],
+            "added":         {f: t for f, t in facts.items() if f not in old_facts},
+            "removed":       {f: t for f, t in old_facts.items() if f not in facts},
+            "new_citations": [url for url in citations if url not in old_urls],
+        }
+
+    def commit(self) -> None:
+        """Make the pending run the baseline for the next record()."""
+        with self._connect() as db:
+            db.execute("UPDATE runs SET committed = 1 WHERE NOT committed")
+
+
+# Set in main() unless --no-history, --record or --replay; None treats all research as new
+research_history: ResearchHistory | None = None
+
+
+def research_changed(research: str) -> bool:
+    """
+    Diff today's research against the history (see ResearchHistory.record)
+    and say whether anything material (a new or changed fact) turned up;
+    new citations alone are not. Only the quiet-day exit uses the answer:
+    planning and updates always get the full research, so a fact left
+    unapplied on an earlier day still reaches them.
+    """
+    if research_history is None:
+        return True
+    try:
+        delta = research_history.record(research)
+    except sqlite3.Error as e:
+        log(f"  ⚠️  Research history unavailable ({e}); treating the research as changed")
+        return True
+    if delta["since"] is None:
+        log(f"  – No research history yet; {len(delta['added'])} facts recorded as the first baseline")
+        return True
+    if not delta["added"]:
+        log(f"  ✓ No new facts since {delta['since']} "
+            f"({len(delta['removed'])} no longer reported, {len(delta['new_citations'])} new sources)")
+        return False
+    added = sorted(delta["added"])
+    log(f"  ✓ {len(added)} new facts since {delta['since']}: "
+        + "; ".join(map(_describe_fact, added[:8])) + (" ..." if len(added) > 8 else ""))
+    return True
+
+
+def quiet_day(material: bool, changed: set[str] | None) -> bool:
+    """
+    True when the research has nothing material and no eligible file changed
+    since the last successful run: the plan would be the same as last time's.
+    """
+    if material:
+        return False
+    if changed is None or changed:
+        reason = "there is no previous manifest" if changed is None else f"{len(changed)} files changed"
+        log(f"  – Research unchanged, but {reason}; planning anyway")
+        return False
+    log("\n✓ No material research changes and no edited files since the last run. Nothing to plan today.")
+    return True
+
+
+def skip_quiet_day(material: bool, changed: set[str] | None) -> None:
+    """Exit before planning on a quiet day (see quiet_day)."""
+    if not quiet_day(material, changed):
+        return
+    if journal is not None:
+        journal.append("end", outcome="quiet")
+    sys.exit(0)
 
 
 # ─── Phase 2: Discover files ──────────────────────────────────────────────────
 
 def get_all_eligible_files() -> list[Path]:
-    """Return every file in the repo eligible for agent review."""
+    """
+    Return every file in the repo eligible for agent review.
+    Directories in SKIP_DIRS (matched by name or repo-relative path) are
+    pruned before descending, so their contents are never listed or stat'ed.
+    """
     eligible = []
-    for path in REPO_ROOT.rglob("*"):
-        if not path.is_file():
+    stack = [(str(REPO_ROOT), "")]
+    while stack:
+        directory, rel_dir = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as e:
+            log(f"  ⚠️  Cannot scan {rel_dir or '.'}: {e}")
             continue
-        rel   = path.relative_to(REPO_ROOT)
-        parts = rel.parts
 
-        if any(part in SKIP_DIRS for part in parts):
-            continue
-        if str(rel) in SKIP_FILES or rel.name in SKIP_FILES:
-            continue
-        if path.suffix not in ELIGIBLE_EXTENSIONS:
-            continue
-        if path.stat().st_size > MAX_FILE_SIZE_BYTES:
-            continue
+        for entry in entries:
+            rel = rel_dir + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIP_DIRS and rel not in SKIP_DIRS:
+                    stack.append((entry.path, rel + "/"))
+                continue
+            if not entry.is_file():
+                continue
+            if rel in SKIP_FILES or entry.name in SKIP_FILES:
+                continue
+            ext = os.path.splitext(entry.name)[1]
+            if ext not in ELIGIBLE_EXTENSIONS:
+                continue
+            limit = MAX_CHUNKED_FILE_SIZE_BYTES if ext == ".md" else MAX_FILE_SIZE_BYTES
+            if entry.stat().st_size > limit:
+                continue
 
-        eligible.append(path)
+            eligible.append(Path(entry.path))
     return sorted(eligible)
 
 
+class FileManifest:
+    """
+    (size, mtime, sha256) for every eligible file, persisted as JSON between
+    successful runs so the planner can be told what changed since the last one.
+    Files whose size and mtime match the previous entry reuse its hash instead
+    of being re-read.
+    """
+
+    def __init__(self, path: Path):
+        self.path    = path
+        self.entries: dict[str, dict] = {}
+        try:
+            self.previous: dict[str, dict] | None = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.previous = None
+
+    def refresh(self, files: list[Path]) -> set[str] | None:
+        """
+        Record the current state of `files`. Returns the repo-relative paths
+        that are new or whose content changed since the saved manifest, or
+        None when there is no previous manifest to compare against.
+        """
+        previous = self.previous or {}
+        changed: set[str] = set()
+        self.entries = {}
+        for f in files:
+            rel = str(f.relative_to(REPO_ROOT))
+            st  = f.stat()
+            old = previous.get(rel)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                digest = old["sha256"]
+            else:
+                digest = hashlib.sha256(f.read_bytes()).hexdigest()
+            self.entries[rel] = {"size": st.st_size, "mtime": st.st_mtime, "sha256": digest}
+            if not old or old["sha256"] != digest:
+                changed.add(rel)
+        return changed if self.previous is not None else None
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+TERM_RE = re.compile(r"[a-z][a-z0-9]*(?:[.\-][a-z0-9]+)*")
+
+
+def _terms(text: str) -> Counter:
+    return Counter(t for t in TERM_RE.findall(text.lower()) if len(t) > 2)
+
+
+class RepoIndex:
+    """
+    Persisted content index of eligible files: term counts, Opus model
+    name/ID mentions with line numbers, and top-level frontmatter fields.
+    Like FileManifest, entries whose size and mtime are unchanged are reused,
+    so a refresh only re-reads files edited since the last run. The planner
+    uses it to attach concrete hit lists and to skip files with no hits.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path):
+        self.path    = path
+        self.entries: dict[str, dict] = {}
+        try:
+            saved = json.loads(path.read_text(encoding="utf-8"))
+            self.previous: dict[str, dict] = saved["files"] if saved.get("version") == self.VERSION else {}
+        except (OSError, ValueError, KeyError, AttributeError):
+            self.previous = {}
+
+    @staticmethod
+    def _entry(text: str) -> dict:
+        models = []
+        for lineno, line in enumerate(text.splitlines(), 1):
+            for pattern in (OPUS_NAME_RE, OPUS_ID_RE, OPUS_LEGACY_RE):
+                for m in pattern.finditer(line):
+                    models.append([m.group(0), *_version(m.group(1), m.group(2)), lineno])
+        frontmatter = {}
+        front = FRONTMATTER_RE.match(text)
+        if front:
+            for line in front.group(1).splitlines():
+                key, sep, value = line.partition(":")
+                if sep and key and not key[0].isspace():
+                    frontmatter[key.strip()] = value.strip()
+        return {"terms": dict(_terms(text)), "models": models, "frontmatter": frontmatter}
+
+    def refresh(self, files: list[Path]) -> int:
+        """Index `files`, re-reading only new or modified ones. Returns how many were re-read."""
+        reread = 0
+        for f in files:
+            rel = str(f.relative_to(REPO_ROOT))
+            st  = f.stat()
+            old = self.previous.get(rel)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                entry = old
+            else:
+                try:
+                    text = f.read_text(encoding="utf-8", errors="replace")
+                except OSError:
+                    continue
+                entry = {"size": st.st_size, "mtime": st.st_mtime, **self._entry(text)}
+                reread += 1
+            self.entries[rel] = entry
+        return reread
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"version": self.VERSION, "files": self.entries}), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def terms(self, rel: str) -> Counter:
+        return Counter(self.entries.get(rel, {}).get("terms", {}))
+
+    def frontmatter(self, rel: str) -> dict:
+        return self.entries.get(rel, {}).get("frontmatter", {})
+
+    def outdated(self, latest_model: str, rels=None) -> dict[str, dict[str, list[int]]]:
+        """
+        Opus names/IDs older than `latest_model`: {mention: {rel: [line, ...]}},
+        optionally restricted to `rels`.
+        """
+        latest = OPUS_NAME_RE.search(latest_model)
+        if not latest:
+            return {}
+        latest_version = _version(latest.group(1), latest.group(2))
+        hits: dict[str, dict[str, list[int]]] = {}
+        for rel in self.entries if rels is None else rels:
+            for text, major, minor, lineno in self.entries.get(rel, {}).get("models", []):
+                if (major, minor) < latest_version:
+                    hits.setdefault(text, {}).setdefault(rel, []).append(lineno)
+        return hits
+
+
+repo_index: RepoIndex | None = None
+
+
 # ─── Phase 3: Planning ────────────────────────────────────────────────────────
 
-def plan_all_updates(research: str, latest_model: str, files: list[Path]) -> dict:
-    """Ask Claude to decide which files to update and which new skills to create."""
-    file_index = "\n".join(f"- {f.relative_to(REPO_ROOT)}" for f in files)
-    log(f"  Sending plan request to Claude ({len(file_index)} chars file index)...")
+PLAN_KINDS = {
+    # line "kind" → (plan key, required fields)
+    "update":    ("updates",    ("file", "reason")),
+    "new_skill": ("new_skills", ("filename", "topic", "reason")),
+}
+
+
+def _plan_request(
+    research: str,
+    latest_model: str,
+    files: list[Path],
+    changed: set[str] | None,
+    shard: str | None = None,
+    skills: bool = True,
+) -> dict:
+    rels = [str(f.relative_to(REPO_ROOT)) for f in files]
+    hits = repo_index.outdated(latest_model, rels) if repo_index else {}
+    lines = []
+    for rel in rels:
+        line = f"- {rel} (changed)" if changed and rel in changed else f"- {rel}"
+        if repo_index:
+            notes = [
+                f"{mention} ×{len(by_file[rel])}"
+                for mention, by_file in hits.items() if rel in by_file
+            ]
+            updated = repo_index.frontmatter(rel).get("updated")
+            if updated:
+                notes.append(f"updated {updated}")
+            if notes:
+                line += f" [{', '.join(notes)}]"
+        lines.append(line)
+    file_index = "\n".join(lines)
+    hits_section = _index_hits_section(hits)
+
+    changed_note = ""
+    if changed is not None:
+        changed_note = (
+            f"\n{len(changed)} of these files are marked (changed): they are new or were "
+            "edited since the last successful run. Unmarked files were already reviewed "
+            "against earlier research, so only queue them if today's research makes "
+            "them outdated.\n"
+        )
+    heading = "All Files in Repo"
+    if repo_index:
+        heading = "Candidate Files in Repo (files with no index hits were skipped)"
+    if shard:
+        heading = f"Files in {shard} (one shard of the repo, planned separately)"
+        changed_note += (
+            "\nOther files were planned separately or ruled out as irrelevant to "
+            "today's research; only plan the files listed here.\n"
+        )
+    skills_note = "" if skills else (
+        "\nThis shard does not propose new skills: emit update lines only."
+    )
+    log(f"  Sending plan request to Claude ({len(file_index)} chars file index"
+        f"{f', {shard}' if shard else ''})...")
 
-    resp = claude.messages.create(
+    return dict(
         model=CLAUDE_MODEL,
         max_tokens=4096,
+        system=research_system(research),
         messages=[{
             "role": "user",
             "content": f"""You are the chief editor of a Claude/Anthropic prompt engineering repository.
 
 Today is {TODAY}. The latest Claude Opus model is: {latest_model}
+Today's research is in the system prompt.
 
-## Today's Research
-{research[:8000]}
-
-## All Files in Repo
+## {heading}
 {file_index}
-
+{changed_note}{hits_section}
 ## Task
-Return a JSON object with two keys:
+List the planned work as JSON Lines. Two kinds of line:
 
-"updates" — existing files that need changes:
+Existing files that need changes:
 {{
+  "kind": "update",
   "file": "relative/path",
   "reason": "specific description of what is outdated",
   "priority": "high|medium|low",
-  "update_compatibility": true/false
+  "update_compatibility": true/false,
+  "mechanical_only": true/false
 }}
 
 Set update_compatibility=true for files with Claude model names, compatibility frontmatter,
 model ID strings, or Claude Code version numbers.
 
+Set mechanical_only=true only when the ONLY changes needed are replacing outdated Opus
+model names/IDs and refreshing the compatibility/updated frontmatter — no new facts,
+pricing, features or prose edits. These are applied locally without a Claude call.
+
 Priority:
 - high   = model names/IDs, version numbers, pricing, breaking changes
 - medium = new features, ecosystem stats, new commands
 - low    = minor additions
 
-"new_skills" — brand new skill files to create in skills/examples/:
+Brand new skill files to create in skills/examples/:
 {{
+  "kind": "new_skill",
   "filename": "tool-name-skill.md",
   "topic": "Human-readable name",
   "reason": "why this is newly important"
 }}
 
-Only add new_skills if research reveals genuinely important tools not yet in the repo.
+Only add new_skill lines if research reveals genuinely important tools not yet in the repo.
 
-Return valid JSON only. No markdown fences.""",
+Output JSON Lines only: one compact JSON object per line, nothing else — no
+wrapping object or array, no markdown fences, no commentary. Emit high-priority
+updates first, then new skills, then medium and low updates.{skills_note}""",
         }],
     )
 
+
+def _index_hits_section(hits: dict[str, dict[str, list[int]]], max_files: int = 15) -> str:
+    """Render RepoIndex.outdated() hits as a prompt section listing files and lines."""
+    if not hits:
+        return ""
+    out = ["\n## Outdated Model References (from the local index)"]
+    for mention, by_file in sorted(hits.items(), key=lambda kv: -len(kv[1])):
+        listed = [
+            f"{rel}:{','.join(map(str, lines[:10]))}"
+            for rel, lines in sorted(by_file.items())[:max_files]
+        ]
+        more = f" (+{len(by_file) - max_files} more)" if len(by_file) > max_files else ""
+        out.append(f"- {mention} appears in {len(by_file)} files: {'; '.join(listed)}{more}")
+    return "\n".join(out) + "\n"
+
+
+def _plan_item(line: str, seen: set) -> tuple[str, dict] | None:
+    """
+    Parse one JSON Lines plan entry into (plan key, item). Blank lines,
+    stray fences, malformed or incomplete lines and duplicates give None.
+    """
+    line = line.strip()
+    if not line.startswith("{"):
+        return None
     try:
-        text = resp.content[0].text.strip()
-        if text.startswith("```"):
-            text = "\n".join(text.split("\n")[1:])
-        if text.endswith("```"):
-            text = "\n".join(text.split("\n")[:-1])
-        return json.loads(text)
-    except Exception as e:
-        log(f"  ⚠️  Plan JSON parse failed: {e}")
-        log(f"  Raw response: {resp.content[0].text[:500]}")
-        return {"updates": [], "new_skills": []}
+        item = json.loads(line)
+    except json.JSONDecodeError:
+        log(f"  ⚠️  Skipping unparseable plan line: {line[:120]}")
+        return None
+    if not isinstance(item, dict) or item.get("kind") not in PLAN_KINDS:
+        log(f"  ⚠️  Skipping plan line of unknown kind: {line[:120]}")
+        return None
+    key, required = PLAN_KINDS[item.pop("kind")]
+    if not all(isinstance(item.get(field), str) and item[field] for field in required):
+        log(f"  ⚠️  Skipping plan line missing {'/'.join(required)}: {line[:120]}")
+        return None
+    ident = (key, item[required[0]])
+    if ident in seen:
+        return None
+    seen.add(ident)
+    return key, item
 
 
-# ─── Phase 4: Update existing files ──────────────────────────────────────────
+def _iter_shard(request: dict, label: str):
+    """Stream one plan request, yielding each JSON Lines item as it completes."""
+    seen: set = set()
+    buffer = ""
+    with run_report.label(label):
+        try:
+            for text in claude_stream_text(**request):
+                buffer += text
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    parsed = _plan_item(line, seen)
+                    if parsed:
+                        yield parsed
+        except Exception as e:
+            log(f"  ⚠️  Plan stream failed ({label}): {e} — keeping the {len(seen)} items parsed so far")
+        parsed = _plan_item(buffer, seen)
+        if parsed:
+            yield parsed
 
-def update_existing_file(
-    file_path: Path,
+
+def relevance_prefilter(
     research: str,
     latest_model: str,
-    reason: str,
-    update_compatibility: bool,
-) -> bool:
-    """Update a single file. Returns True if file was changed."""
-    rel = str(file_path.relative_to(REPO_ROOT))
-    try:
-        current = file_path.read_text(encoding="utf-8")
-    except Exception as e:
-        log(f"     ⚠️  Cannot read {rel}: {e}")
-        return False
+    files: list[Path],
+    changed: set[str] | None,
+) -> list[Path]:
+    """
+    Cheap local TF-IDF pass: score the head of every file against the terms
+    in today's research and keep the PLAN_MAX_CANDIDATES best. Changed files
+    and files still naming an older Opus are always kept. Files that score
+    zero are dropped. Reads term counts from repo_index when it is loaded
+    instead of re-reading every file. Returns the candidates in their
+    original order.
+    """
+    docs: dict[Path, Counter] = {}
+    must: set[Path] = set()
+    outdated = {
+        rel for by_file in repo_index.outdated(latest_model).values() for rel in by_file
+    } if repo_index else set()
+    for f in files:
+        rel = str(f.relative_to(REPO_ROOT))
+        if repo_index and rel in repo_index.entries:
+            docs[f] = repo_index.terms(rel)
+            if (changed and rel in changed) or rel in outdated:
+                must.add(f)
+            continue
+        try:
+            with open(f, encoding="utf-8", errors="replace") as fh:
+                text = fh.read(PLAN_SCORE_BYTES)
+        except OSError:
+            continue
+        docs[f] = _terms(text)
+        if changed and str(f.relative_to(REPO_ROOT)) in changed:
+            must.add(f)
+        elif compat_prepass(text, latest_model)[2]:
+            must.add(f)
 
-    compat_block = ""
-    if update_compatibility:
-        compat_block = f"""
-COMPATIBILITY UPDATE (mandatory):
-- Replace old Claude model names → "{latest_model}"
-- Update frontmatter `compatibility:` → "{latest_model}, Claude Code v2.x"
-- Update frontmatter `updated:` → {TODAY}
-- Update model ID strings in code examples to the latest version
-- Update any inline text referencing old model versions
-"""
+    df = Counter()
+    for counts in docs.values():
+        df.update(counts.keys())
+    query = {
+        t: 1 + math.log(n)
+        for t, n in _terms(research).items()
+        if t not in REASON_STOPWORDS
+    }
 
-    log(f"     Calling Claude for {rel} ({len(current)} chars)...")
-    try:
-        resp = claude.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=8192,
-            messages=[{
-                "role": "user",
-                "content": f"""Update this file from a Claude/Anthropic prompt engineering guide repository.
+    def score(counts: Counter) -> float:
+        total = sum(
+            (1 + math.log(counts[t])) * math.log(len(docs) / df[t]) * w
+            for t, w in query.items() if t in counts
+        )
+        return total / math.sqrt(len(counts) or 1)
 
-## File: {rel}
-## Current Content:
-{current}
+    ranked = sorted((f for f in docs if f not in must), key=lambda f: score(docs[f]), reverse=True)
+    keep = must | {f for f in ranked[:max(PLAN_MAX_CANDIDATES - len(must), 0)] if score(docs[f]) > 0}
+    log(f"  ✓ Relevance prefilter kept {len(keep)} of {len(files)} files "
+        f"({len(must)} changed or naming an older Opus)")
+    return [f for f in files if f in keep]
 
-## Research (as of {TODAY}):
-{research[:4000]}
 
-## What needs updating:
-{reason}
-{compat_block}
+def plan_shards(files: list[Path]) -> list[tuple[str, list[Path]]]:
+    """
+    Group files by their first two directory levels and pack the groups, in
+    path order, into shards of at most PLAN_SHARD_SIZE files. Returns
+    (description, files) pairs.
+    """
+    groups: dict[str, list[Path]] = {}
+    for f in files:
+        parts = f.relative_to(REPO_ROOT).parts[:-1][:2]
+        groups.setdefault("/".join(parts) or ".", []).append(f)
 
-## Rules:
-1. Preserve ALL existing structure, formatting, and writing style exactly
-2. Update version numbers, model IDs, pricing, feature lists, stats, dates
-3. Update "Last Updated" / "Last Major Update" dates to {TODAY}
-4. Add new information from research that genuinely belongs in this file
-5. Do NOT restructure or rewrite content that is already accurate
-6. Do NOT add padding, speculation, or off-topic content
-7. If nothing needs changing after review, return exactly: NO_CHANGES_NEEDED
+    shards: list[tuple[list[str], list[Path]]] = []
+    for directory in sorted(groups):
+        members = groups[directory]
+        for start in range(0, len(members), PLAN_SHARD_SIZE):
+            part = members[start:start + PLAN_SHARD_SIZE]
+            if shards and len(shards[-1][1]) + len(part) <= PLAN_SHARD_SIZE:
+                shards[-1][0].append(directory)
+                shards[-1][1].extend(part)
+            else:
+                shards.append(([directory], list(part)))
+    return [(", ".join(dict.fromkeys(dirs)), members) for dirs, members in shards]
 
-Return the complete updated file content only (or NO_CHANGES_NEEDED). No preamble.""",
-            }],
-        )
-    except Exception as e:
-        log(f"     ⚠️  Claude call failed for {rel}: {e}")
-        return False
 
-    new_content = resp.content[0].text.strip()
+def iter_plan_items(
+    research: str,
+    latest_model: str,
+    files: list[Path],
+    changed: set[str] | None = None,
+):
+    """
+    Stream the plan as JSON Lines and yield ("updates" | "new_skills", item)
+    as soon as each line is complete, so callers can dispatch work while the
+    rest of the plan is still being generated. A plan cut off by max_tokens
+    or a dropped stream still yields every item parsed before the cutoff.
 
-    if new_content == "NO_CHANGES_NEEDED":
-        return False
-    if new_content == current.strip():
-        return False
+    When repo_index is loaded, files with no relevance or outdated-model hits
+    are dropped before planning and the prompt carries the index hit lists.
+    Repos with more than PLAN_SHARD_THRESHOLD eligible files are planned
+    hierarchically: relevance_prefilter() narrows the candidates, and each
+    plan_shards() shard is planned in parallel. Items from all shards are
+    merged as they arrive. Only the shard holding skills/ proposes new skills.
+    """
+    if repo_index:
+        files = relevance_prefilter(research, latest_model, files, changed)
+    if len(files) <= PLAN_SHARD_THRESHOLD:
+        yield from _iter_shard(_plan_request(research, latest_model, files, changed), "plan")
+        return
 
-    file_path.write_text(new_content + "\n", encoding="utf-8")
-    return True
+    candidates = files if repo_index else relevance_prefilter(research, latest_model, files, changed)
+    shards     = plan_shards(candidates)
+    skills_at  = next(
+        (i for i, (_, members) in enumerate(shards)
+         if any(f.relative_to(REPO_ROOT).parts[0] == "skills" for f in members)),
+        0,
+    )
+    log(f"  Planning {len(candidates)} files in {len(shards)} shards ({PLAN_WORKERS} at a time)...")
 
+    results: queue.Queue = queue.Queue()
 
-# ─── Phase 5: Create new skill files ─────────────────────────────────────────
+    def plan_shard(index: int, name: str, members: list[Path]) -> None:
+        try:
+            request = _plan_request(
+                research, latest_model, members, changed, shard=name, skills=index == skills_at
+            )
+            for parsed in _iter_shard(request, f"plan:{name}"):
+                results.put(parsed)
+        except Exception as e:
+            log(f"  ⚠️  Plan shard {name} failed: {e}")
+        finally:
+            results.put(None)
 
-def create_new_skill(
-    filename: str,
-    topic: str,
-    reason: str,
+    seen: set = set()
+    with ThreadPoolExecutor(max_workers=PLAN_WORKERS) as pool:
+        for index, (name, members) in enumerate(shards):
+            pool.submit(plan_shard, index, name, members)
+        remaining = len(shards)
+        while remaining:
+            parsed = results.get()
+            if parsed is None:
+                remaining -= 1
+                continue
+            key, item = parsed
+            ident = (key, item.get("file") or item.get("filename"))
+            if ident not in seen:
+                seen.add(ident)
+                yield parsed
+
+
+def plan_all_updates(
     research: str,
     latest_model: str,
-    format_reference: str,
-) -> bool:
-    """Generate and write a new skill file. Returns True if created."""
-    skill_path = REPO_ROOT / "skills" / "examples" / filename
+    files: list[Path],
+    changed: set[str] | None = None,
+) -> dict:
+    """
+    Ask Claude to decide which files to update and which new skills to create.
+    `changed` (from FileManifest.refresh) marks files that are new or edited
+    since the last successful run so the planner can look at them first.
+    Collects iter_plan_items() into {"updates": [...], "new_skills": [...]}.
+    """
+    plan = {"updates": [], "new_skills": []}
+    for key, item in iter_plan_items(research, latest_model, files, changed):
+        plan[key].append(item)
+    return plan
+
+
+# ─── Phase 3b: Group related updates ─────────────────────────────────────────
+
+# README.ja.md, guide.zh-CN.md, ... → the language tag before the extension
+TRANSLATION_RE = re.compile(r"^(?P<base>.+)\.(?P<lang>[a-z]{2}(?:-[A-Za-z]{2,4})?)(?P<ext>\.[a-z]+)$")
+
+# Near-duplicates: bottom-k MinHash sketches of word shingles
+SHINGLE_WORDS      = 5
+MINHASH_SIZE       = 64
+NEAR_DUPLICATE_MIN = 0.8
+
+
+def translation_of(rel: str) -> tuple[str, str] | None:
+    """(source path, language) for a translated file such as README.ja.md, else None."""
+    path = Path(rel)
+    m = TRANSLATION_RE.match(path.name)
+    if not m:
+        return None
+    return str(path.with_name(m["base"] + m["ext"])), m["lang"]
+
+
+def minhash(text: str) -> frozenset[int] | None:
+    """
+    Bottom-k MinHash sketch of the SHINGLE_WORDS-word shingles of `text`:
+    the MINHASH_SIZE smallest shingle hashes. None if `text` is too short.
+    """
+    words = text.lower().split()
+    hashes = {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    return frozenset(heapq.nsmallest(MINHASH_SIZE, hashes)) if hashes else None
+
+
+def sketch_similarity(a: frozenset[int], b: frozenset[int]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two minhash() sketches."""
+    union = heapq.nsmallest(MINHASH_SIZE, a | b)
+    return sum(h in a and h in b for h in union) / len(union)
+
+
+def group_updates(updates: list[dict]) -> list[dict]:
+    """
+    Fold planned updates that need the same edits into groups, so Phase 4
+    updates one canonical file and propagates its diff (see _update_group):
+      - translation sets: README.ja.md / README.zh-CN.md join README.md
+        when both are planned
+      - near-duplicates: files whose estimated shingle similarity
+        (minhash()) reaches NEAR_DUPLICATE_MIN; the first planned one is
+        canonical
+    The canonical item gets a "members" list (and the group's highest
+    priority); members leave the top-level list. Returns the new list.
+    """
+    by_file = {item["file"]: item for item in updates}
+    parent  = {rel: rel for rel in by_file}
+    kinds: dict[str, str] = {}
+
+    def root(rel: str) -> str:
+        while parent[rel] != rel:
+            parent[rel] = parent[parent[rel]]
+            rel = parent[rel]
+        return rel
+
+    for rel in by_file:
+        source = translation_of(rel)
+        if source and source[0] in by_file and not translation_of(source[0]):
+            parent[root(rel)] = root(source[0])
+            kinds[rel] = "translation"
+
+    sketches = {}
+    for rel in by_file:
+        if rel in kinds:
+            continue
+        try:
+            sketch = minhash((REPO_ROOT / rel).read_text(encoding="utf-8"))
+        except (OSError, UnicodeDecodeError):
+            continue
+        if sketch is not None:
+            sketches[rel] = sketch
+    # Pairwise is fine at plan sizes (PLAN_MAX_CANDIDATES at most)
+    for first, rel in itertools.combinations(sketches, 2):
+        if root(rel) != root(first) and sketch_similarity(sketches[first], sketches[rel]) >= NEAR_DUPLICATE_MIN:
+            parent[root(rel)] = root(first)
+            kinds.setdefault(rel, "duplicate")
+
+    # Canonical: a translation set's source, else the first planned member
+    order = {rel: i for i, rel in enumerate(by_file)}
+    members: dict[str, list[str]] = {}
+    for rel in by_file:
+        members.setdefault(root(rel), []).append(rel)
+    grouped = []
+    for rels in members.values():
+        canonical = min(rels, key=lambda rel: (kinds.get(rel) == "translation", order[rel]))
+        item = dict(by_file[canonical])
+        others = [rel for rel in rels if rel != canonical]
+        if others:
+            item["members"] = [{**by_file[rel], "group": kinds.get(rel, "duplicate")} for rel in others]
+            item["priority"] = min(
+                (by_file[rel].get("priority", "low") for rel in rels),
+                key=lambda priority: PRIORITY_ORDER.get(priority, 2),
+            )
+            log(f"  ✓ Grouped {', '.join(others)} with {canonical}")
+        grouped.append(item)
+    grouped.sort(key=lambda item: order[item["file"]])
+    return grouped
+
+
+# ─── Phase 4: Update existing files ──────────────────────────────────────────
+
+NO_CHANGES_SENTINEL = "NO_CHANGES_NEEDED"
+
+
+OPUS_NAME_RE   = re.compile(r"\b(?:Claude )?Opus (\d+)(?:\.(\d+))?\b")
+OPUS_ID_RE     = re.compile(r"\bclaude-opus-(\d+)(?:-(\d{1,2}))?(?:-\d{8})?\b")
+OPUS_LEGACY_RE = re.compile(r"\bclaude-(\d+)(?:-(\d+))?-opus(?:-\d{8})?\b")
+FRONTMATTER_RE = re.compile(r"\A---\n(.*?\n)---\n", re.DOTALL)
+FENCE_RE       = re.compile(r"^(`{3,}|~{3,})[^\n]*\n.*?^\1[ \t]*$", re.DOTALL | re.MULTILINE)
+
+
+def _version(major: str, minor: str | None) -> tuple[int, int]:
+    return int(major), int(minor or 0)
+
+
+def compat_prepass(content: str, latest_model: str) -> tuple[str, int, list[str]]:
+    """
+    Deterministic part of a compatibility update, run before any Claude call:
+      - older Opus names in the frontmatter `compatibility:` field → latest_model
+      - older Opus model IDs inside fenced code blocks → the latest alias ID
+      - frontmatter `updated:` → TODAY, if anything else changed
+    Prose is left alone: older models are often mentioned on purpose there.
+    Returns (new_content, substitution_count, residual) where residual lists
+    outdated Opus names/IDs still present anywhere in the file.
+    """
+    latest = OPUS_NAME_RE.search(latest_model)
+    if not latest:
+        return content, 0, []
+    major, minor   = latest.group(1), latest.group(2)
+    latest_version = _version(major, minor)
+    latest_name    = f"Claude Opus {major}" + (f".{minor}" if minor else "")
+    latest_id      = f"claude-opus-{major}" + (f"-{minor}" if minor else "")
+
+    count = 0
+
+    def sub_older(pattern: re.Pattern, replacement: str, text: str) -> str:
+        def repl(m: re.Match) -> str:
+            nonlocal count
+            if _version(m.group(1), m.group(2)) >= latest_version:
+                return m.group(0)
+            count += 1
+            return replacement
+
+        return pattern.sub(repl, text)
+
+    front = FRONTMATTER_RE.match(content)
+    if front:
+        lines = front.group(1).splitlines(keepends=True)
+        for i, line in enumerate(lines):
+            if line.startswith("compatibility:"):
+                lines[i] = sub_older(OPUS_NAME_RE, latest_name, line)
+        content = "---\n" + "".join(lines) + "---\n" + content[front.end():]
+
+    def sub_code(m: re.Match) -> str:
+        block = sub_older(OPUS_ID_RE, latest_id, m.group(0))
+        return sub_older(OPUS_LEGACY_RE, latest_id, block)
+
+    content = FENCE_RE.sub(sub_code, content)
+
+    front = FRONTMATTER_RE.match(content)
+    if front and count:
+        header, n = re.subn(r"^updated:.*$", f"updated: {TODAY}", front.group(1), count=1, flags=re.MULTILINE)
+        if n and header != front.group(1):
+            content = "---\n" + header + "---\n" + content[front.end():]
+            count += 1
+
+    residual = [
+        m.group(0)
+        for pattern in (OPUS_NAME_RE, OPUS_ID_RE, OPUS_LEGACY_RE)
+        for m in pattern.finditer(content)
+        if _version(m.group(1), m.group(2)) < latest_version
+    ]
+    return content, count, residual
+
+
+def _stream_temp_file(file_path: Path):
+    """
+    Open `.<name>.<random>.tmp` next to `file_path`: the same filesystem,
+    so os.replace() is atomic. The pattern is in .gitignore, and
+    sweep_stale_temp_files() clears any left by a killed run before a commit.
+    """
+    return tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=file_path.parent,
+        prefix=f".{file_path.name}.", suffix=".tmp", delete=False,
+    )
+
+
+def _write_streamed_update(file_path: Path, current: str, chunks) -> bool:
+    """
+    Consume a streamed rewrite of `file_path`. Stops reading as soon as the
+    output is recognisably NO_CHANGES_NEEDED; otherwise writes the output to a
+    temp file next to the target (see _stream_temp_file) as it arrives and
+    atomically renames it into place. Output is stripped like the
+    non-streaming path. Returns True if the file was changed.
+    """
+    target     = current.strip()
+    head       = ""     # output held back while it could still be the sentinel
+    pending_ws = ""     # trailing whitespace held back until more text follows
+    written    = 0
+    unchanged  = True   # output so far is a prefix of the current content
+    tmp        = None
+
+    try:
+        for chunk in chunks:
+            if tmp is None:
+                head += chunk
+                text = head.lstrip()
+                if text.startswith(NO_CHANGES_SENTINEL):
+                    return False
+                if NO_CHANGES_SENTINEL.startswith(text):
+                    continue
+                tmp = _stream_temp_file(file_path)
+                chunk = text
+
+            text = pending_ws + chunk
+            body = text.rstrip()
+            pending_ws = text[len(body):]
+            if body:
+                tmp.write(body)
+                unchanged = unchanged and target.startswith(body, written)
+                written  += len(body)
+
+        if tmp is None:
+            # Stream ended while still ambiguous — short output or the bare sentinel
+            text = head.strip()
+            if not text or text == NO_CHANGES_SENTINEL:
+                return False
+            tmp = _stream_temp_file(file_path)
+            tmp.write(text)
+            unchanged = text == target
+            written   = len(text)
+
+        if unchanged and written == len(target):
+            return False
+
+        tmp.write("\n")
+        tmp.close()
+        os.chmod(tmp.name, file_path.stat().st_mode)
+        os.replace(tmp.name, file_path)
+        tmp = None
+        return True
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        if tmp is not None:
+            tmp.close()
+            Path(tmp.name).unlink(missing_ok=True)
+
+
+PATCH_SEARCH, PATCH_DIVIDER, PATCH_REPLACE = "<<<<<<< SEARCH", "=======", ">>>>>>> REPLACE"
+
+
+def parse_patch_blocks(response: str) -> list[tuple[str, str]] | None:
+    """
+    Split `response` into (search, replace) pairs, reading it line by line.
+    The divider only counts between a SEARCH and a REPLACE marker; prose
+    around the blocks is ignored. Returns None when a block is ambiguous —
+    a second divider (a `=======` line in the file's own text, such as a
+    Markdown heading underline, can't be told apart from the real one), a
+    marker out of place, an empty SEARCH, or an unclosed block.
+    """
+    blocks: list[tuple[str, str]] = []
+    search: list[str] = []
+    replace: list[str] = []
+    state = "outside"
+    for line in response.splitlines():
+        marker = line.rstrip()
+        if state == "outside":
+            if marker == PATCH_SEARCH:
+                search, replace, state = [], [], "search"
+            elif marker == PATCH_REPLACE:
+                return None
+        elif marker == PATCH_SEARCH:
+            return None
+        elif state == "search":
+            if marker == PATCH_REPLACE:
+                return None
+            if marker == PATCH_DIVIDER:
+                state = "replace"
+            else:
+                search.append(line)
+        elif marker == PATCH_DIVIDER:
+            return None
+        elif marker == PATCH_REPLACE:
+            if not any(search):
+                return None
+            blocks.append(("\n".join(search), "\n".join(replace)))
+            state = "outside"
+        else:
+            replace.append(line)
+    return blocks if state == "outside" else None
+
+
+def apply_patch_blocks(current: str, response: str) -> str | None:
+    """
+    Apply SEARCH/REPLACE blocks from `response` to `current` in order.
+    Returns None if there are no blocks, any block is malformed or
+    ambiguous (see parse_patch_blocks), or a SEARCH text does not occur
+    exactly once — the caller then falls back to a full rewrite rather
+    than guessing.
+    """
+    blocks = parse_patch_blocks(response)
+    if not blocks:
+        return None
+    updated = current
+    for search, replace in blocks:
+        if updated.count(search) != 1:
+            return None
+        if not replace and updated.count(search + "\n") == 1:
+            search += "\n"  # deleting whole lines should not leave a blank one
+        updated = updated.replace(search, replace, 1)
+    return updated
+
+
+UPDATE_TASK  = "Update this file from a Claude/Anthropic prompt engineering guide repository."
+SECTION_TASK = (
+    "Update this section of a larger file from a Claude/Anthropic prompt engineering guide "
+    "repository. The other sections are updated separately — edit only the text shown."
+)
+
+
+def _compat_block(latest_model: str) -> str:
+    return f"""
+COMPATIBILITY UPDATE (mandatory):
+- Replace old Claude model names → "{latest_model}"
+- Update frontmatter `compatibility:` → "{latest_model}, Claude Code v2.x"
+- Update frontmatter `updated:` → {TODAY}
+- Update model ID strings in code examples to the latest version
+- Update any inline text referencing old model versions
+"""
+
+
+def _update_rules() -> str:
+    return f"""1. Preserve ALL existing structure, formatting, and writing style exactly
+2. Update version numbers, model IDs, pricing, feature lists, stats, dates
+3. Update "Last Updated" / "Last Major Update" dates to {TODAY}
+4. Add new information from research that genuinely belongs in this file
+5. Do NOT restructure or rewrite content that is already accurate
+6. Do NOT add padding, speculation, or off-topic content"""
+
+
+PATCH_OUTPUT_FORMAT = """## Output format:
+Return only the edits, as one or more blocks of exactly this form:
+
+<<<<<<< SEARCH
+lines copied verbatim from the current file
+=======
+the replacement lines
+>>>>>>> REPLACE
+
+- SEARCH text must match the current file character for character and occur exactly once;
+  include neighbouring lines when needed to make it unique
+- Keep each block small: only the lines that change plus minimal context
+- Blocks are applied in order; do not overlap them
+
+Return the edit blocks only (or NO_CHANGES_NEEDED). No preamble."""
+
+
+def _patch_request(research: str, context: str, task: str = UPDATE_TASK, model: str = CLAUDE_MODEL) -> dict:
+    """messages.create params asking for SEARCH/REPLACE edits instead of the whole text."""
+    return dict(
+        model=model,
+        max_tokens=4096,
+        system=research_system(research),
+        messages=[{
+            "role": "user",
+            "content": f"""{focused_research(research, context)}{task}
+
+{context}
+
+## Rules:
+{_update_rules()}
+7. If nothing needs changing after review, return exactly: NO_CHANGES_NEEDED
+
+{PATCH_OUTPUT_FORMAT}""",
+        }],
+    )
+
+
+def _patch_result(current: str, resp) -> str | None:
+    """
+    Apply a _patch_request response. Returns the edited text (`current`
+    itself when nothing needs changing), or None when the edits are
+    truncated or do not apply cleanly.
+    """
+    text = resp.content[0].text.strip()
+    if text == NO_CHANGES_SENTINEL:
+        return current
+    if resp.stop_reason == "max_tokens":
+        return None
+    return apply_patch_blocks(current, text)
+
+
+def _request_patch(
+    research: str,
+    current: str,
+    context: str,
+    task: str = UPDATE_TASK,
+    model: str = CLAUDE_MODEL,
+) -> str | None:
+    """Ask Claude for SEARCH/REPLACE edits and apply them (see _patch_result)."""
+    resp   = claude_create(**_patch_request(research, context, task, model))
+    result = _patch_result(current, resp)
+    if result is not None:
+        run_report.note_stop(run_report.current_label(), resp.stop_reason)
+    return result
+
+
+def _update_context(rel: str, current: str, reason: str, compat_block: str) -> str:
+    """Per-file part of an update prompt; the research lives in research_system()."""
+    return f"""## File: {rel}
+## Current Content:
+{current}
+
+## What needs updating:
+{reason}
+{compat_block}"""
+
+
+def _rewrite_request(research: str, context: str, model: str = CLAUDE_MODEL) -> dict:
+    """messages.create params asking for the complete updated file."""
+    return dict(
+        model=model,
+        max_tokens=8192,
+        system=research_system(research),
+        messages=[{
+            "role": "user",
+            "content": f"""{focused_research(research, context)}{UPDATE_TASK}
+
+{context}
+
+## Rules:
+{_update_rules()}
+7. If nothing needs changing after review, return exactly: NO_CHANGES_NEEDED
+
+Return the complete updated file content only (or NO_CHANGES_NEEDED). No preamble.""",
+        }],
+    )
+
+
+def _rewrite_result(current: str, resp) -> str | None:
+    """New file content from a _rewrite_request response, or None if unchanged."""
+    new_content = resp.content[0].text.strip()
+    if new_content == NO_CHANGES_SENTINEL or new_content == current.strip():
+        return None
+    return new_content + "\n"
+
+
+def _claude_update(
+    file_path: Path,
+    current: str,
+    research: str,
+    latest_model: str,
+    reason: str,
+    update_compatibility: bool,
+    stream: bool,
+    patch: bool,
+    model: str = CLAUDE_MODEL,
+) -> bool:
+    """
+    Have Claude update one file. Returns True if file was changed.
+    With `patch`, Claude returns SEARCH/REPLACE edits that are applied
+    locally; edits that fail to apply fall back to a full rewrite. With
+    `stream`, a full rewrite is written as it arrives and a NO_CHANGES_NEEDED
+    reply ends the call after its first few tokens.
+    """
+    rel = str(file_path.relative_to(REPO_ROOT))
+    compat_block = _compat_block(latest_model) if update_compatibility else ""
+    context = _update_context(rel, current, reason, compat_block)
+
+    if patch:
+        log(f"     Requesting edits from Claude for {rel} ({len(current)} chars)...")
+        try:
+            patched = _request_patch(research, current, context, model=model)
+        except Exception as e:
+            log(f"     ⚠️  Claude call failed for {rel}: {e}")
+            return False
+        if patched is not None:
+            if patched == current:
+                return False
+            file_path.write_text(patched, encoding="utf-8")
+            return True
+        log(f"     ↻ Edits for {rel} did not apply cleanly, falling back to full rewrite")
+
+    log(f"     Calling Claude for {rel} ({len(current)} chars)...")
+    request = _rewrite_request(research, context, model)
+
+    if stream:
+        try:
+            return _write_streamed_update(file_path, current, claude_stream_text(**request))
+        except Exception as e:
+            log(f"     ⚠️  Claude call failed for {rel}: {e}")
+            return False
+
+    try:
+        resp = claude_create(**request)
+    except Exception as e:
+        log(f"     ⚠️  Claude call failed for {rel}: {e}")
+        return False
+
+    new_content = _rewrite_result(current, resp)
+    if new_content is None:
+        return False
+    file_path.write_text(new_content, encoding="utf-8")
+    run_report.note_stop(rel, resp.stop_reason)
+    return True
+
+
+HEADING_RE = re.compile(r"^#{1,3} .*$", re.MULTILINE)
+
+# Words too common in planner reasons to say anything about a section
+REASON_STOPWORDS = {
+    "update", "updated", "updates", "outdated", "latest", "current", "version", "versions",
+    "file", "section", "sections", "mention", "mentions", "should", "needs", "with", "from",
+    "that", "this", "these", "into", "have", "claude", "anthropic", "information", "references",
+    "reference", "add", "adds", "new", "also", "and", "the", "for",
+}
+
+
+def _headings(content: str) -> list[re.Match]:
+    """Level 1-3 ATX headings that are not inside fenced code blocks."""
+    fences = [m.span() for m in FENCE_RE.finditer(content)]
+    return [
+        m for m in HEADING_RE.finditer(content)
+        if not any(start <= m.start() < end for start, end in fences)
+    ]
+
+
+def split_markdown_sections(content: str, max_chars: int = CHUNK_MAX_CHARS) -> list[str]:
+    """
+    Split markdown at level 1-3 headings (outside code fences) and pack
+    consecutive sections into chunks of at most `max_chars`. A single section
+    larger than that stays whole. "".join(chunks) == content.
+    """
+    cuts = [0] + [m.start() for m in _headings(content) if m.start()] + [len(content)]
+    chunks: list[str] = []
+    for start, end in zip(cuts, cuts[1:]):
+        section = content[start:end]
+        if chunks and len(chunks[-1]) + len(section) <= max_chars:
+            chunks[-1] += section
+        else:
+            chunks.append(section)
+    return chunks
+
+
+def _reason_terms(reason: str) -> set[str]:
+    """Distinctive terms in a planner reason, used to find the text it is about."""
+    return {
+        t.lower().strip(".,;:()")
+        for t in re.findall(r"[\w][\w.\-/]{2,}", reason)
+    } - REASON_STOPWORDS
+
+
+def _relevant_chunks(chunks: list[str], reason: str, latest_model: str, update_compatibility: bool) -> list[int]:
+    """
+    Indexes of chunks worth sending to Claude: those sharing a distinctive
+    term with the planner's reason, those with a "Last Updated" line, and —
+    for compatibility updates — those still naming an older Opus model.
+    Falls back to every chunk when nothing matches.
+    """
+    terms = _reason_terms(reason)
+    selected = []
+    for i, chunk in enumerate(chunks):
+        lowered = chunk.lower()
+        if any(t in lowered for t in terms) or re.search(r"last (major )?update", lowered):
+            selected.append(i)
+        elif update_compatibility and compat_prepass(chunk, latest_model)[2]:
+            selected.append(i)
+    return selected or list(range(len(chunks)))
+
+
+def _update_chunk(
+    rel: str,
+    index: int,
+    chunks: list[str],
+    outline: str,
+    research: str,
+    reason: str,
+    compat_block: str,
+    patch: bool,
+    model: str = CLAUDE_MODEL,
+) -> str:
+    """Update one section of a chunked file. Returns the (possibly unchanged) section."""
+    chunk = chunks[index]
+    label = f"{rel} §{index + 1}/{len(chunks)}"
+    context = f"""## File: {rel} — section {index + 1} of {len(chunks)}
+## Document outline:
+{outline}
+
+## Current Section:
+{chunk}
+
+## What needs updating (whole file):
+{reason}
+{compat_block}"""
+
+    try:
+        if patch:
+            patched = _request_patch(research, chunk, context, SECTION_TASK, model)
+            if patched is not None:
+                return patched
+            log(f"     ↻ Edits for {label} did not apply cleanly, rewriting the section")
+
+        resp = claude_create(
+            model=model,
+            max_tokens=8192,
+            system=research_system(research),
+            messages=[{
+                "role": "user",
+                "content": f"""{focused_research(research, context)}{SECTION_TASK}
+
+{context}
+
+## Rules:
+{_update_rules()}
+7. If nothing needs changing after review, return exactly: NO_CHANGES_NEEDED
+
+Return the complete updated section only (or NO_CHANGES_NEEDED). No preamble.""",
+            }],
+        )
+    except Exception as e:
+        log(f"     ⚠️  Claude call failed for {label}: {e}")
+        return chunk
+
+    new_section = resp.content[0].text.strip()
+    if new_section == NO_CHANGES_SENTINEL or not new_section:
+        return chunk
+    if resp.stop_reason == "max_tokens":
+        log(f"     ⚠️  Rewrite of {label} hit max_tokens, keeping the original section")
+        return chunk
+    # Keep the original boundary whitespace so sections rejoin cleanly
+    lead  = chunk[: len(chunk) - len(chunk.lstrip())]
+    trail = chunk[len(chunk.rstrip()):]
+    return lead + new_section + trail
+
+
+def _chunked_update(
+    file_path: Path,
+    current: str,
+    research: str,
+    latest_model: str,
+    reason: str,
+    update_compatibility: bool,
+    patch: bool,
+    model: str = CLAUDE_MODEL,
+) -> bool:
+    """
+    Update a large markdown file section by section: only sections relevant
+    to `reason` go to Claude, in parallel, and the file is reassembled.
+    Returns True if file was changed.
+    """
+    rel      = str(file_path.relative_to(REPO_ROOT))
+    chunks   = split_markdown_sections(current)
+    selected = _relevant_chunks(chunks, reason, latest_model, update_compatibility)
+    outline  = "\n".join(m.group(0) for m in _headings(current))
+    compat_block = _compat_block(latest_model) if update_compatibility else ""
+    log(f"     Large file {rel} ({len(current)} chars): "
+        f"sending {len(selected)} of {len(chunks)} sections to Claude...")
+
+    # Chunk workers log into this file's buffer so its output stays grouped,
+    # and their calls are attributed to this file in the run report
+    parent_buffer = getattr(_log_local, "buffer", None)
+    parent_label  = run_report.current_label()
+
+    def run(i: int) -> str:
+        _log_local.buffer = parent_buffer
+        try:
+            with run_report.label(parent_label):
+                return _update_chunk(rel, i, chunks, outline, research, reason, compat_block, patch, model)
+        finally:
+            _log_local.buffer = None
+
+    updated = list(chunks)
+    with ThreadPoolExecutor(max_workers=min(CHUNK_WORKERS, len(selected))) as pool:
+        for i, section in zip(selected, pool.map(run, selected)):
+            updated[i] = section
+
+    new_content = "".join(updated)
+    if new_content == current:
+        return False
+    file_path.write_text(new_content, encoding="utf-8")
+    return True
+
+
+def _apply_prepass(
+    file_path: Path,
+    current: str,
+    latest_model: str,
+    mechanical_only: bool,
+) -> tuple[str, bool, bool]:
+    """
+    Run compat_prepass() and write its result. Returns (content, changed,
+    done) where `done` means the pre-pass covered every planned change.
+    """
+    rewritten, substitutions, residual = compat_prepass(current, latest_model)
+    if substitutions:
+        file_path.write_text(rewritten, encoding="utf-8")
+        log(f"     ✓ Local pre-pass made {substitutions} substitution(s)")
+    if mechanical_only and substitutions and not residual:
+        log("     ✓ Pre-pass covered every planned change, skipping Claude")
+        return rewritten, True, True
+    if residual:
+        log(f"     – Still outdated after pre-pass: {', '.join(sorted(set(residual))[:5])}")
+    return rewritten, bool(substitutions), False
+
+
+def _needs_chunking(file_path: Path, current: str) -> bool:
+    return file_path.suffix == ".md" and len(current.encode("utf-8")) > CHUNK_THRESHOLD_BYTES
+
+
+EDIT_TYPES = ("none", "trivial", "substantive")
+
+# Routing tiers: edit type → model, plus the triage model itself (None with
+# --no-triage). Set in main(); left None, every file goes to CLAUDE_MODEL.
+model_tiers: dict[str, str] | None = None
+
+
+def file_summary(current: str, reason: str, latest_model: str, max_lines: int = 40) -> str:
+    """
+    Compact view of a file for triage: frontmatter, heading outline and the
+    lines that mention the planner's reason terms, an outdated Opus or a
+    "Last Updated" date, with their line numbers.
+    """
+    front   = FRONTMATTER_RE.match(current)
+    outline = "\n".join(m.group(0) for m in _headings(current))
+    terms   = _reason_terms(reason)
+    lines   = current.splitlines()
+    matches = []
+    for lineno, line in enumerate(lines, 1):
+        lowered = line.lower()
+        if (any(t in lowered for t in terms)
+                or re.search(r"last (major )?update", lowered)
+                or compat_prepass(line, latest_model)[2]):
+            matches.append(f"{lineno}: {line[:200]}")
+            if len(matches) == max_lines:
+                break
+    return f"""## Frontmatter:
+{front.group(1).strip() if front else "(none)"}
+
+## Outline:
+{outline[:3000] or "(no headings)"}
+
+## Matching lines ({len(matches)} shown, {len(lines)} lines total):
+{chr(10).join(matches) or "(none)"}"""
+
+
+def triage_update(rel: str, current: str, research: str, latest_model: str, reason: str) -> str:
+    """
+    Ask model_tiers["triage"] whether `rel` needs changing and how much,
+    from file_summary() instead of the whole file. Returns one of EDIT_TYPES
+    and records the decision in the run report. Any failure answers
+    "substantive" so the file still gets the full update.
+    """
+    focused = focused_research(research, f"{rel}\n{reason}\n{current[:PLAN_SCORE_BYTES]}")
+    try:
+        resp = claude_create(
+            model=model_tiers["triage"],
+            max_tokens=200,
+            system=research_system(research),
+            messages=[{
+                "role": "user",
+                "content": f"""{focused}Triage a planned update to one file of a Claude/Anthropic prompt engineering repository.
+
+Today is {TODAY}. The latest Claude Opus model is: {latest_model}
+Today's research is in the system prompt.
+
+## File: {rel}
+{file_summary(current, reason, latest_model)}
+
+## What the planner thinks is outdated:
+{reason}
+
+## Task
+Decide whether the file actually needs changing given the research, and how much:
+- "none"        — it is already current
+- "trivial"     — only model names/IDs, version numbers, dates, prices or a few words change
+- "substantive" — new facts, new or rewritten sections, or anything needing judgement
+
+When unsure, answer "substantive".
+Return one JSON object only: {{"edit_type": "none|trivial|substantive", "why": "one short sentence"}}""",
+            }],
+        )
+        match = re.search(r"\{.*\}", resp.content[0].text, re.DOTALL)
+        if not match:
+            raise ValueError("no JSON object in reply")
+        decision  = json.loads(match.group(0))
+        edit_type = decision.get("edit_type")
+        why       = str(decision.get("why", ""))
+        if edit_type not in EDIT_TYPES:
+            raise ValueError(f"unknown edit_type {edit_type!r}")
+    except Exception as e:
+        log(f"     ⚠️  Triage failed for {rel} ({e}), treating as substantive")
+        edit_type, why = "substantive", f"triage failed: {e}"
+
+    model = model_tiers.get(edit_type)
+    run_report.record_route(rel, edit_type, model, why)
+    log(f"     Triage: {edit_type}" + (f" → {model}" if model else "") + (f" ({why[:80]})" if why else ""))
+    return edit_type
+
+
+def update_existing_file(
+    file_path: Path,
+    research: str,
+    latest_model: str,
+    reason: str,
+    update_compatibility: bool,
+    stream: bool = True,
+    patch: bool = True,
+    mechanical_only: bool = False,
+) -> bool:
+    """
+    Update a single file. Returns True if file was changed.
+    Compatibility updates first go through compat_prepass(); when the planner
+    flagged the item `mechanical_only` and the pre-pass leaves no outdated
+    Opus reference behind, the Claude call is skipped entirely. With
+    model_tiers set, triage_update() then routes the file: "none" skips the
+    update call, "trivial" uses the light model and "substantive" the full
+    one. Markdown files above CHUNK_THRESHOLD_BYTES are updated section by
+    section.
+    """
+    rel = str(file_path.relative_to(REPO_ROOT))
+    try:
+        current = file_path.read_text(encoding="utf-8")
+    except Exception as e:
+        log(f"     ⚠️  Cannot read {rel}: {e}")
+        return False
+
+    prepass_changed = False
+    if update_compatibility:
+        current, prepass_changed, done = _apply_prepass(file_path, current, latest_model, mechanical_only)
+        if done:
+            return True
+
+    chunked = _needs_chunking(file_path, current)
+    if not chunked and len(current.encode("utf-8")) > MAX_FILE_SIZE_BYTES:
+        log(f"     – {rel} is too large to send whole, skipping")
+        return prepass_changed
+
+    model = model_tiers["substantive"] if model_tiers else CLAUDE_MODEL
+    if model_tiers and model_tiers["triage"]:
+        edit_type = triage_update(rel, current, research, latest_model, reason)
+        if edit_type == "none":
+            return prepass_changed
+        model = model_tiers[edit_type]
+
+    if chunked:
+        changed = _chunked_update(
+            file_path, current, research, latest_model, reason,
+            update_compatibility, patch, model,
+        )
+    else:
+        changed = _claude_update(
+            file_path, current, research, latest_model, reason,
+            update_compatibility, stream, patch, model,
+        )
+    return changed or prepass_changed
+
+
+PRIORITY_ORDER = {"high": 0, "medium": 1, "low": 2}
+
+
+def _update_one(item: dict, research: str, latest_model: str, stream: bool, patch: bool) -> bool:
+    """Phase 4 worker: update one planned file, keeping its log lines together."""
+    fpath = REPO_ROOT / item["file"]
+    with grouped_log(), run_report.label(item["file"]):
+        run_report.clear_stop(item["file"])
+        priority = item.get("priority", "?")
+        log(f"  → {item['file']} [{priority}]")
+        log(f"     reason: {item['reason'][:80]}...")
+
+        try:
+            before = fpath.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError):
+            before = None
+        changed = update_existing_file(
+            fpath,
+            research,
+            latest_model,
+            item["reason"],
+            item.get("update_compatibility", False),
+            stream,
+            patch,
+            item.get("mechanical_only", False),
+        )
+        run_report.record_file(
+            item["file"],
+            len(before.encode("utf-8")) if before is not None else 0,
+            fpath.stat().st_size if changed else 0,
+        )
+        # A failed call leaves the file as it was; keep it out of the journal so --resume retries it
+        if journal is not None and before is not None and (changed or not run_report.failed(item["file"])):
+            journal.record_file("update", item["file"], before, fpath.read_text(encoding="utf-8") if changed else None)
+        log("     ✓ updated" if changed else "     – no changes needed")
+        return changed
+
+
+def diff_patch_blocks(old: str, new: str, target: str | None = None) -> str:
+    """
+    SEARCH/REPLACE blocks (the apply_patch_blocks() format) turning `old`
+    into `new`: one per run of changed lines, with unchanged lines either
+    side. The context starts at one line and doubles until every SEARCH
+    occurs exactly once in `old` and in `target` (the near-duplicate the
+    blocks are meant for), or covers the whole file.
+    """
+    a, b = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    texts = [old] if target is None else [old, target]
+    opcodes = difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    context = 1
+    while True:
+        # get_grouped_opcodes() trims the matcher's cached opcodes in place, so feed it a fresh copy
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        matcher.opcodes = list(opcodes)
+        blocks, unique = [], True
+        for group in matcher.get_grouped_opcodes(context):
+            search  = "".join(a[group[0][1]:group[-1][2]]).rstrip("\n")
+            replace = "".join(b[group[0][3]:group[-1][4]]).rstrip("\n")
+            unique  = unique and bool(search) and all(text.count(search) == 1 for text in texts)
+            blocks.append(f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE")
+        if unique or context >= len(a):
+            return "\n".join(blocks)
+        context *= 2
+
+
+def _translation_request(rel: str, current: str, source: str, diff: str, lang: str, model: str) -> dict:
+    """
+    messages.create params carrying the edits just made to `source` into
+    its translation `rel`. The diff stands in for the research, which the
+    source's update already applied.
+    """
+    return dict(
+        model=model,
+        max_tokens=4096,
+        messages=[{
+            "role": "user",
+            "content": f"""`{source}` in a Claude/Anthropic prompt engineering guide repository was just updated. `{rel}` is its translation ({lang}) and needs the same changes.
+
+## Changes made to {source}:
+```diff
+{diff}
+```
+
+## File: {rel}
+## Current Content:
+{current}
+
+## Rules:
+1. Carry over every factual change in the diff: model names and IDs, versions, pricing, numbers, dates, added or removed items
+2. Write new or changed prose in the translation's language; keep code, identifiers and URLs as in the diff
+3. Preserve the translation's existing wording, structure and formatting everywhere else
+4. If the translation already reflects the changes, return exactly: NO_CHANGES_NEEDED
+
+{PATCH_OUTPUT_FORMAT}""",
+        }],
+    )
+
+
+def _propagate(member: dict, source: str, before: str | None, after: str | None) -> bool | None:
+    """
+    Carry the canonical file's change (`before` → `after`, both None when
+    it was left alone) into one group member. Returns whether the member
+    changed, or None when it has to be updated on its own.
+    """
+    rel   = member["file"]
+    mpath = REPO_ROOT / rel
+    with grouped_log(), run_report.label(rel):
+        run_report.clear_stop(rel)
+        log(f"  → {rel} [{member['group']} of {source}]")
+        try:
+            current = mpath.read_text(encoding="utf-8")
+        except Exception as e:
+            log(f"     ⚠️  Cannot read {rel}: {e}")
+            return False
+
+        if after is None:
+            # The member was planned in its own right (a translation can lag its source)
+            log(f"     – {source} needed no changes, updating on its own")
+            return None
+        if member["group"] == "duplicate":
+            new_content = apply_patch_blocks(current, diff_patch_blocks(before, after, current))
+            if new_content is None:
+                log(f"     ↻ Edits to {source} do not apply here, updating on its own")
+                return None
+        else:
+            diff = "".join(difflib.unified_diff(
+                before.splitlines(keepends=True), after.splitlines(keepends=True), source, source,
+            ))
+            model = model_tiers["trivial"] if model_tiers else CLAUDE_MODEL
+            log(f"     Requesting translated edits from Claude ({len(diff)} chars of diff)...")
+            try:
+                resp = claude_create(**_translation_request(
+                    rel, current, source, diff, translation_of(rel)[1], model,
+                ))
+            except Exception as e:
+                log(f"     ⚠️  Claude call failed for {rel}: {e}")
+                return None
+            new_content = _patch_result(current, resp)
+            if new_content is None:
+                log("     ↻ Translated edits did not apply cleanly, updating on its own")
+                return None
+            run_report.note_stop(rel, resp.stop_reason)
+
+        changed = new_content != current
+        if changed:
+            mpath.write_text(new_content, encoding="utf-8")
+        run_report.record_file(rel, len(current.encode("utf-8")), len(new_content.encode("utf-8")) if changed else 0)
+        if journal is not None:
+            journal.record_file("update", rel, current, new_content if changed else None)
+        log("     ✓ updated" if changed else "     – no changes needed")
+        return changed
+
+
+def _update_group(item: dict, research: str, latest_model: str, stream: bool, patch: bool) -> list[str]:
+    """
+    Phase 4 worker for a group from group_updates(): update the canonical
+    file, then carry its diff to each member — near-duplicates by applying
+    the same edits locally, translations with one small call that sees the
+    diff instead of the research. Members the diff does not fit are updated
+    on their own. Returns the changed paths, canonical first.
+    """
+    fpath = REPO_ROOT / item["file"]
+    try:
+        before = fpath.read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        before = None
+    changed = [item["file"]] if _update_one(item, research, latest_model, stream, patch) else []
+    after = fpath.read_text(encoding="utf-8") if changed and before is not None else None
+
+    for member in item["members"]:
+        # A failed canonical update says nothing about the members
+        done = None if run_report.failed(item["file"]) else _propagate(member, item["file"], before, after)
+        if done is None:
+            done = _update_one(member, research, latest_model, stream, patch)
+        if done:
+            changed.append(member["file"])
+    return changed
+
+
+def update_all_files(
+    updates: list[dict],
+    research: str,
+    latest_model: str,
+    workers: int,
+    stream: bool = True,
+    patch: bool = True,
+) -> list[str]:
+    """
+    Run update_existing_file across a bounded worker pool.
+    Items are submitted high → medium → low so the pool picks them up in
+    priority order; an item with "members" (see group_updates) runs as one
+    unit through _update_group. Returns changed paths in that same order.
+    """
+    ordered = sorted(
+        updates,
+        key=lambda x: PRIORITY_ORDER.get(x.get("priority", "low"), 2),
+    )
+    changed: dict[int, list[str]] = {}
+
+    def run_item(item: dict) -> list[str]:
+        if item.get("members"):
+            return _update_group(item, research, latest_model, stream, patch)
+        return [item["file"]] if _update_one(item, research, latest_model, stream, patch) else []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_item, item): i for i, item in enumerate(ordered)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                changed[i] = future.result()
+            except Exception as e:
+                log(f"  ⚠️  {ordered[i]['file']} failed: {e}")
+                changed[i] = []
+
+    return [rel for i in range(len(ordered)) for rel in changed[i]]
+
+
+# ─── Phase 5: Create new skill files ─────────────────────────────────────────
+
+def create_new_skill(
+    filename: str,
+    topic: str,
+    reason: str,
+    research: str,
+    latest_model: str,
+    format_reference: str,
+) -> bool:
+    """Generate and write a new skill file. Returns True if created."""
+    skill_path = REPO_ROOT / "skills" / "examples" / filename
+
+    if skill_path.exists():
+        log(f"     – {filename} already exists, skipping")
+        return False
+
+    log(f"     Generating skill file for: {topic}...")
+    try:
+        resp = claude_create(
+            **_skill_request(topic, reason, research, latest_model, format_reference)
+        )
+    except Exception as e:
+        log(f"     ⚠️  Skill generation failed for {filename}: {e}")
+        return False
+
+    content = resp.content[0].text.strip()
+    skill_path.write_text(content + "\n", encoding="utf-8")
+    run_report.note_stop(run_report.current_label(), resp.stop_reason)
+    return True
+
+
+def _skill_request(
+    topic: str,
+    reason: str,
+    research: str,
+    latest_model: str,
+    format_reference: str,
+) -> dict:
+    """messages.create params for generating one new skill file."""
+    return dict(
+        model=CLAUDE_MODEL,
+        max_tokens=8192,
+        system=research_system(
+            research,
+            f"Use this existing skill as your exact format reference:\n{format_reference}",
+        ),
+        messages=[{
+            "role": "user",
+            "content": f"""{focused_research(research, topic + chr(10) + reason)}Create a complete, production-ready Claude Code skill file for: {topic}
+
+Why this skill is needed (from research):
+{reason}
+
+Use the research and the format reference skill in the system prompt.
+
+Requirements:
+- Frontmatter: name, description, allowed-tools, version (1.0.0), compatibility, updated
+- Set compatibility to: "{latest_model}, Claude Code v2.x"
+- Set updated to: {TODAY}
+- Sections: Overview, core patterns with real code examples, anti-patterns, verification checklist, Resources
+- Code examples must be practical and production-ready
+- Match the exact writing style, depth, and format of the reference
+- End with a Resources section with real valid URLs
+
+Return the complete skill file content only. No preamble.""",
+        }],
+    )
+
+
+def update_skills_readme(new_skill_defs: list[dict], latest_model: str):
+    """Add new skill entries to skills/README.md."""
+    readme_path = REPO_ROOT / "skills" / "README.md"
+    if not readme_path.exists():
+        return
+
+    current = readme_path.read_text(encoding="utf-8")
+    skills_summary = "\n".join(
+        f"- Filename: {s['filename']} | Topic: {s['topic']} | Reason: {s['reason']}"
+        for s in new_skill_defs
+    )
+
+    log("     Updating skills/README.md index...")
+    try:
+        resp = claude_create(
+            model=CLAUDE_MODEL,
+            max_tokens=6000,
+            messages=[{
+                "role": "user",
+                "content": f"""Update this skills/README.md to include newly created skill files.
+
+Current README:
+{current}
+
+New skills to add:
+{skills_summary}
+
+Rules:
+1. Add each new skill to the appropriate table/section based on its topic
+2. Follow the exact existing table format: | [Name](./examples/filename.md) | Purpose | Status |
+3. Update the total skill count in the intro text
+4. Update any "Last Updated" date to {TODAY}
+5. Preserve everything else exactly
+
+Return the complete updated README content only.""",
+            }],
+        )
+        readme_path.write_text(resp.content[0].text.strip() + "\n", encoding="utf-8")
+        run_report.note_stop(run_report.current_label(), resp.stop_reason)
+    except Exception as e:
+        log(f"     ⚠️  skills/README.md update failed: {e}")
+
+
+# ─── Batch mode (Phases 4 + 5) ───────────────────────────────────────────────
+
+def run_message_batch(
+    batch_reqs: dict[str, dict],
+    labels: dict[str, str] | None = None,
+) -> dict[str, anthropic.types.Message | None]:
+    """
+    Submit {custom_id: messages.create params} as one Message Batch and wait
+    for it. Requests already in response_cache are answered locally and
+    fresh results are stored there. Polling backs off from
+    BATCH_POLL_INITIAL to BATCH_POLL_MAX. Returns {custom_id: message}, with
+    None for requests that errored, were canceled or expired. `labels` maps
+    custom_ids to the file names used in the run report.
+    """
+    labels = labels or {}
+    results: dict[str, anthropic.types.Message | None] = {}
+    pending: dict[str, dict] = {}
+    for custom_id, params in batch_reqs.items():
+        cached = cached_message(params)
+        if cached is not None:
+            results[custom_id] = cached
+            run_report.record_call("anthropic", "batch", 0.0, label=labels.get(custom_id), cached=True)
+        else:
+            pending[custom_id] = params
+    if not pending:
+        log(f"  ↺ All {len(results)} requests served from cache")
+        return results
+
+    if replaying():
+        # The whole batch "completes" after its slowest recorded request
+        waits = [0.0]
+        for custom_id, params in pending.items():
+            try:
+                value, seconds = fixtures.replay("anthropic", params, sleep=False)
+            except FixtureMissing as e:
+                log(f"    ⚠️  {custom_id}: {e}")
+                results[custom_id] = None
+                run_report.record_call("anthropic", "batch", 0.0, label=labels.get(custom_id), error="FixtureMissing")
+                continue
+            results[custom_id] = anthropic.types.Message.model_validate(value)
+            waits.append(seconds)
+            run_report.record_call("anthropic", "batch", 0.0, label=labels.get(custom_id),
+                                   usage=results[custom_id].usage)
+        time.sleep(max(waits))
+        run_report.record_call("anthropic", "batch-wait", max(waits), label="batch")
+        log(f"  ↺ Replayed {len(pending)} batch requests")
+        return results
+
+    start = time.monotonic()
+    batch = claude.messages.batches.create(
+        requests=[{"custom_id": cid, "params": params} for cid, params in pending.items()]
+    )
+    log(f"  Submitted batch {batch.id}: {len(pending)} requests "
+        f"({len(results)} served from cache)")
+
+    delay    = BATCH_POLL_INITIAL
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while batch.processing_status != "ended":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"batch {batch.id} still {batch.processing_status} after {BATCH_TIMEOUT}s")
+        time.sleep(delay)
+        delay  = min(delay * 2, BATCH_POLL_MAX)
+        batch  = claude.messages.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        log(f"    … {counts.processing} processing, {counts.succeeded} succeeded, "
+            f"{counts.errored + counts.expired + counts.canceled} failed")
+
+    cache_read = cache_write = 0
+    for entry in claude.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            usage = entry.result.message.usage
+            cache_read  += usage.cache_read_input_tokens or 0
+            cache_write += usage.cache_creation_input_tokens or 0
+            results[entry.custom_id] = entry.result.message
+            run_report.record_call(
+                "anthropic", "batch", 0.0, label=labels.get(entry.custom_id), usage=usage,
+                bytes_received=sum(len(getattr(b, "text", "").encode("utf-8"))
+                                   for b in entry.result.message.content),
+            )
+            store_message(pending[entry.custom_id], entry.result.message)
+            record_fixture("anthropic", pending[entry.custom_id],
+                           entry.result.message.model_dump(mode="json"), time.monotonic() - start)
+        else:
+            log(f"    ⚠️  {entry.custom_id}: {entry.result.type}")
+            results[entry.custom_id] = None
+            run_report.record_call(
+                "anthropic", "batch", 0.0, label=labels.get(entry.custom_id), error=entry.result.type,
+            )
+    for custom_id in pending.keys() - results.keys():
+        results[custom_id] = None
+    # Wall time for the whole batch; per-request entries above carry the tokens
+    run_report.record_call("anthropic", "batch-wait", time.monotonic() - start, label="batch")
+    log(f"  Batch prompt cache: {cache_read} tokens read, {cache_write} written")
+    return results
+
+
+def batch_update_and_create(
+    updates: list[dict],
+    new_skills: list[dict],
+    research: str,
+    latest_model: str,
+    format_ref: str,
+    workers: int,
+    patch: bool = True,
+) -> tuple[list[str], list[str]]:
+    """
+    Phases 4 and 5 as Message Batches: every file update and new skill is
+    submitted together, and patch-mode edits that fail to apply are retried
+    as full rewrites in a second batch. Local pre-passes run first; markdown
+    files large enough to need chunking go through the online worker pool.
+    Returns (updated_files, created_files) in priority order.
+    """
+    ordered = sorted(
+        updates,
+        key=lambda x: PRIORITY_ORDER.get(x.get("priority", "low"), 2),
+    )
+    batch_reqs: dict[str, dict] = {}
+    model = model_tiers["substantive"] if model_tiers else CLAUDE_MODEL
+    pending: dict[str, tuple[dict, Path, str, str]] = {}
+    changed: set[str] = set()
+    online: list[dict] = []
+    originals: dict[str, str] = {}
+
+    def checkpoint(step: str, rel: str, content: str) -> None:
+        if journal is not None:
+            journal.record_file(step, rel, originals.get(rel), content)
+
+    for i, item in enumerate(ordered):
+        fpath = REPO_ROOT / item["file"]
+        log(f"  → {item['file']} [{item.get('priority', '?')}]")
+        try:
+            current = fpath.read_text(encoding="utf-8")
+        except Exception as e:
+            log(f"     ⚠️  Cannot read {item['file']}: {e}")
+            continue
+        originals[item["file"]] = current
+
+        if item.get("update_compatibility", False):
+            current, prepassed, done = _apply_prepass(
+                fpath, current, latest_model, item.get("mechanical_only", False)
+            )
+            if prepassed:
+                changed.add(item["file"])
+            if done:
+                checkpoint("update", item["file"], current)
+                continue
+
+        if _needs_chunking(fpath, current):
+            log("     – large file, updating online section by section")
+            online.append(item)
+            continue
+        if len(current.encode("utf-8")) > MAX_FILE_SIZE_BYTES:
+            log(f"     – {item['file']} is too large to send whole, skipping")
+            continue
+
+        compat_block = _compat_block(latest_model) if item.get("update_compatibility") else ""
+        context = _update_context(item["file"], current, item["reason"], compat_block)
+        batch_reqs[f"update-{i}"] = (
+            _patch_request(research, context, model=model) if patch
+            else _rewrite_request(research, context, model=model)
+        )
+        pending[f"update-{i}"] = (item, fpath, current, context)
+
+    skill_ids: dict[str, dict] = {}
+    for j, skill_def in enumerate(new_skills):
+        if (REPO_ROOT / "skills" / "examples" / skill_def["filename"]).exists():
+            log(f"     – {skill_def['filename']} already exists, skipping")
+            continue
+        batch_reqs[f"skill-{j}"] = _skill_request(
+            skill_def["topic"], skill_def["reason"], research, latest_model, format_ref
+        )
+        skill_ids[f"skill-{j}"] = skill_def
+
+    labels = {cid: item["file"] for cid, (item, *_) in pending.items()}
+    labels.update({cid: f"skills/examples/{d['filename']}" for cid, d in skill_ids.items()})
+    results = run_message_batch(batch_reqs, labels) if batch_reqs else {}
+
+    retry: dict[str, dict] = {}
+    for custom_id, (item, fpath, current, context) in pending.items():
+        resp = results.get(custom_id)
+        if resp is None:
+            continue
+        if patch:
+            new_content = _patch_result(current, resp)
+            if new_content is None:
+                log(f"  ↻ Edits for {item['file']} did not apply cleanly, queued for full rewrite")
+                retry[custom_id] = _rewrite_request(research, context, model=model)
+                continue
+            run_report.note_stop(item["file"], resp.stop_reason)
+            if new_content == current:
+                continue
+        else:
+            new_content = _rewrite_result(current, resp)
+            if new_content is None:
+                continue
+            run_report.note_stop(item["file"], resp.stop_reason)
+        fpath.write_text(new_content, encoding="utf-8")
+        changed.add(item["file"])
+        run_report.record_file(item["file"], len(current.encode("utf-8")), len(new_content.encode("utf-8")))
+        checkpoint("update", item["file"], new_content)
+
+    if retry:
+        log(f"  Resubmitting {len(retry)} full rewrites...")
+        for custom_id, resp in run_message_batch(retry, labels).items():
+            item, fpath, current, _ = pending[custom_id]
+            new_content = _rewrite_result(current, resp) if resp is not None else None
+            if new_content is not None:
+                fpath.write_text(new_content, encoding="utf-8")
+                run_report.note_stop(item["file"], resp.stop_reason)
+                changed.add(item["file"])
+                run_report.record_file(item["file"], len(current.encode("utf-8")), len(new_content.encode("utf-8")))
+                checkpoint("update", item["file"], new_content)
+
+    created_files = []
+    for custom_id, skill_def in skill_ids.items():
+        resp = results.get(custom_id)
+        if resp is None:
+            continue
+        skill_path = REPO_ROOT / "skills" / "examples" / skill_def["filename"]
+        content = resp.content[0].text.strip() + "\n"
+        skill_path.write_text(content, encoding="utf-8")
+        run_report.note_stop(f"skills/examples/{skill_def['filename']}", resp.stop_reason)
+        created_files.append(f"skills/examples/{skill_def['filename']}")
+        checkpoint("skill", f"skills/examples/{skill_def['filename']}", content)
+        log(f"  ✓ created {skill_def['filename']}")
+
+    if online:
+        changed.update(update_all_files(online, research, latest_model, workers, patch=patch))
+
+    updated_files = [item["file"] for item in ordered if item["file"] in changed]
+    for f in updated_files:
+        log(f"  ✓ updated {f}")
+    return updated_files, created_files
+
+
+# ─── Validation (before Phase 6) ─────────────────────────────────────────────
+
+VALIDATION_RETRIES = 1
+# A file shrinking below SHRINK_RATIO of an original of at least
+# SHRINK_MIN_BYTES most likely lost its tail
+SHRINK_RATIO       = 0.5
+SHRINK_MIN_BYTES   = 2_000
+SKILL_REQUIRED_KEYS = ("name", "description")
+
+FRONTMATTER_KEY_RE = re.compile(r"^([A-Za-z_][\w-]*):(?:\s|$)")
+ISO_DATE_RE        = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+FENCE_LINE_RE      = re.compile(r"^\s{0,3}(`{3,}|~{3,})", re.MULTILINE)
+LINK_RE            = re.compile(r"\]\(\s*<?([^)\s>]+)>?(?:\s+\"[^\"]*\")?\s*\)")
+
+# Every path in the repo, set in each validator process by _init_validator()
+_repo_paths: frozenset[str] = frozenset()
+
+
+def _frontmatter(text: str) -> tuple[dict[str, str], list[str]] | None:
+    """Top-level `key: value` pairs of a frontmatter block and its problems; None without one."""
+    m = FRONTMATTER_RE.match(text)
+    if not m:
+        return None
+    keys, problems = {}, []
+    for line in m.group(1).splitlines():
+        if not line.strip() or line[0].isspace() or line.startswith(("#", "- ")):
+            continue
+        key = FRONTMATTER_KEY_RE.match(line)
+        if not key:
+            problems.append(f"frontmatter line is not `key: value`: {line[:60]!r}")
+        elif key.group(1) in keys:
+            problems.append(f"frontmatter key `{key.group(1)}` appears twice")
+        else:
+            keys[key.group(1)] = line[key.end():].strip().strip("\"'")
+    return keys, problems
+
+
+def check_frontmatter(rel: str, original: str | None, current: str) -> list[str]:
+    """Frontmatter kept (with all its keys), well formed, and complete for skills."""
+    before, after = (_frontmatter(original) if original else None), _frontmatter(current)
+    is_skill = rel.startswith("skills/examples/")
+    if after is None:
+        if before is not None or (is_skill and original is None):
+            return ["frontmatter missing or unterminated"]
+        return []
+    keys, problems = after
+    if before is not None:
+        lost = [key for key in before[0] if key not in keys]
+        if lost:
+            problems.append(f"frontmatter lost {', '.join(lost)}")
+    if is_skill:
+        problems += [f"frontmatter has no `{key}`" for key in SKILL_REQUIRED_KEYS if not keys.get(key)]
+    if "updated" in keys and not ISO_DATE_RE.match(keys["updated"]):
+        problems.append(f"frontmatter `updated: {keys['updated']}` is not a YYYY-MM-DD date")
+    return problems
+
+
+def check_headings(original: str | None, current: str) -> list[str]:
+    """No level of heading (outside code fences) lost compared with the original."""
+    if original is None:
+        return []
+    before = HEADING_RE.findall(FENCE_RE.sub("", original))
+    after  = HEADING_RE.findall(FENCE_RE.sub("", current))
+    problems = []
+    for level in sorted({h.split(" ", 1)[0] for h in before}):
+        had  = [h for h in before if h.startswith(level + " ")]
+        kept = [h for h in after if h.startswith(level + " ")]
+        if len(kept) < len(had):
+            missing = [h for h in had if h not in after][:3]
+            problems.append(f"lost {len(had) - len(kept)} `{level}` headings (e.g. {'; '.join(missing)})")
+    return problems
+
+
+def check_truncation(original: str | None, current: str, hit_max_tokens: bool) -> list[str]:
+    """stop_reason, then an unclosed code fence or a file that lost most of its size."""
+    problems = ["output hit max_tokens"] if hit_max_tokens else []
+    fences = FENCE_LINE_RE.findall(current)
+    if len(fences) % 2 and (original is None or len(FENCE_LINE_RE.findall(original)) % 2 == 0):
+        problems.append("unclosed code fence")
+    if original is not None and len(original) >= SHRINK_MIN_BYTES and len(current) < SHRINK_RATIO * len(original):
+        problems.append(f"shrank from {len(original)} to {len(current)} chars")
+    return problems
 
-    if skill_path.exists():
-        log(f"     – {filename} already exists, skipping")
-        return False
 
-    log(f"     Generating skill file for: {topic}...")
-    try:
-        resp = claude.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=8192,
-            messages=[{
-                "role": "user",
-                "content": f"""Create a complete, production-ready Claude Code skill file for: {topic}
+def check_links(rel: str, original: str | None, current: str) -> list[str]:
+    """Relative links added by this run point at files or directories in the repo."""
+    old = set(LINK_RE.findall(FENCE_RE.sub("", original))) if original else set()
+    dead = []
+    for target in dict.fromkeys(LINK_RE.findall(FENCE_RE.sub("", current))):
+        if target in old or "://" in target or target.startswith(("#", "mailto:")):
+            continue
+        path = unquote(target.split("#", 1)[0].split("?", 1)[0])
+        if not path:
+            continue
+        resolved = os.path.normpath(path.lstrip("/") if path.startswith("/") else os.path.join(os.path.dirname(rel), path))
+        if resolved.startswith("..") or resolved not in _repo_paths:
+            dead.append(target)
+    return [f"dead link{'s' if len(dead) > 1 else ''}: {', '.join(dead[:5])}"] if dead else []
 
-Why this skill is needed (from research):
-{reason}
 
-Relevant research context:
-{research[:3000]}
+def _init_validator(paths: frozenset[str]) -> None:
+    global _repo_paths
+    _repo_paths = paths
 
-Use this existing skill as your exact format reference:
-{format_reference}
 
-Requirements:
-- Frontmatter: name, description, allowed-tools, version (1.0.0), compatibility, updated
-- Set compatibility to: "{latest_model}, Claude Code v2.x"
-- Set updated to: {TODAY}
-- Sections: Overview, core patterns with real code examples, anti-patterns, verification checklist, Resources
-- Code examples must be practical and production-ready
-- Match the exact writing style, depth, and format of the reference
-- End with a Resources section with real valid URLs
+def validate_file(task: dict) -> list[str]:
+    """All checks for one changed file (runs in a validator process); returns its problems."""
+    rel, original, current = task["file"], task["original"], task["current"]
+    problems = check_truncation(original, current, task["truncated"])
+    if rel.endswith(".md"):
+        problems += check_frontmatter(rel, original, current)
+        problems += check_headings(original, current)
+        problems += check_links(rel, original, current)
+    return problems
 
-Return the complete skill file content only. No preamble.""",
-            }],
-        )
-    except Exception as e:
-        log(f"     ⚠️  Skill generation failed for {filename}: {e}")
-        return False
 
-    content = resp.content[0].text.strip()
-    skill_path.write_text(content + "\n", encoding="utf-8")
-    return True
+def head_versions(rels: list[str]) -> dict[str, str | None]:
+    """Each file as committed at HEAD (None if it is new), read with one `git cat-file --batch`."""
+    try:
+        out = subprocess.run(
+            ["git", "cat-file", "--batch"], cwd=REPO_ROOT, capture_output=True, check=True,
+            input="".join(f"HEAD:{rel}\n" for rel in rels).encode("utf-8"),
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return dict.fromkeys(rels)
+    versions, pos = {}, 0
+    for rel in rels:
+        end = out.index(b"\n", pos)
+        header = out[pos:end].split()
+        pos = end + 1
+        if header[-1] == b"missing":
+            versions[rel] = None
+            continue
+        size = int(header[2])
+        versions[rel] = out[pos:pos + size].decode("utf-8", errors="replace")
+        pos += size + 1
+    return versions
 
 
-def update_skills_readme(new_skill_defs: list[dict], latest_model: str):
-    """Add new skill entries to skills/README.md."""
-    readme_path = REPO_ROOT / "skills" / "README.md"
-    if not readme_path.exists():
-        return
+def repo_paths() -> frozenset[str]:
+    """Repo-relative paths of every file and directory outside .git and node_modules."""
+    paths = set()
+    for dirpath, dirnames, filenames in os.walk(REPO_ROOT):
+        dirnames[:] = [d for d in dirnames if d not in (".git", "node_modules")]
+        base = os.path.relpath(dirpath, REPO_ROOT)
+        for name in dirnames + filenames:
+            paths.add(os.path.normpath(os.path.join(base, name)))
+    return frozenset(paths)
 
-    current = readme_path.read_text(encoding="utf-8")
-    skills_summary = "\n".join(
-        f"- Filename: {s['filename']} | Topic: {s['topic']} | Reason: {s['reason']}"
-        for s in new_skill_defs
-    )
 
-    log("     Updating skills/README.md index...")
+def validate_changes(rels: list[str], originals: dict[str, str | None]) -> dict[str, list[str]]:
+    """
+    Run validate_file() over the changed files on a process pool (inline
+    when a pool cannot start). Returns {path: problems} for failed files.
+    """
+    tasks = []
+    for rel in rels:
+        try:
+            current = (REPO_ROOT / rel).read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError) as e:
+            log(f"  ⚠️  Cannot read {rel} to validate it: {e}")
+            continue
+        tasks.append({"file": rel, "original": originals.get(rel), "current": current,
+                      "truncated": run_report.truncated(rel)})
+    if not tasks:
+        return {}
+    paths = repo_paths()
     try:
-        resp = claude.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=6000,
-            messages=[{
-                "role": "user",
-                "content": f"""Update this skills/README.md to include newly created skill files.
+        with ProcessPoolExecutor(
+            max_workers=min(len(tasks), os.cpu_count() or 1),
+            initializer=_init_validator, initargs=(paths,),
+        ) as pool:
+            results = list(pool.map(validate_file, tasks, chunksize=max(1, len(tasks) // 32)))
+    except (OSError, BrokenProcessPool) as e:
+        log(f"  – Validator processes unavailable ({e}), validating inline")
+        _init_validator(paths)
+        results = [validate_file(task) for task in tasks]
+    return {task["file"]: problems for task, problems in zip(tasks, results) if problems}
 
-Current README:
-{current}
 
-New skills to add:
-{skills_summary}
+def validate_phase(
+    args: argparse.Namespace,
+    research: str,
+    latest_model: str,
+    updates: list[dict],
+    new_skills: list[dict],
+    updated_files: list[str],
+    created_files: list[str],
+) -> tuple[list[str], list[str]]:
+    """
+    Check every changed file before the PR: truncation, frontmatter,
+    heading structure and new intra-repo links (validate_file). A failed
+    file is reverted to HEAD; planned updates and new skills then get
+    VALIDATION_RETRIES more attempts with the problems added to their
+    reason. Whatever still fails stays reverted and leaves the PR, and the
+    rest is checked once more in case it linked to a dropped file. Returns
+    the surviving (updated_files, created_files).
+    """
+    run_report.start_phase("validate")
+    log(f"\nValidating {len(updated_files) + len(created_files)} changed files...")
+    items  = {item["file"]: item for item in updates}
+    skills = {f"skills/examples/{d['filename']}": d for d in new_skills}
+    originals = head_versions(updated_files + created_files)
+    format_ref = load_format_reference() if skills else ""
 
-Rules:
-1. Add each new skill to the appropriate table/section based on its topic
-2. Follow the exact existing table format: | [Name](./examples/filename.md) | Purpose | Status |
-3. Update the total skill count in the intro text
-4. Update any "Last Updated" date to {TODAY}
-5. Preserve everything else exactly
+    def revert(rel: str, problems: list[str]) -> None:
+        log(f"  ✗ {rel}: {'; '.join(problems)}")
+        original = originals.get(rel)
+        if original is None:
+            (REPO_ROOT / rel).unlink(missing_ok=True)
+        else:
+            (REPO_ROOT / rel).write_text(original, encoding="utf-8")
+        if journal is not None:
+            step = "skill" if rel in skills else "index" if rel == "skills/README.md" else "update"
+            journal.record_file(step, rel, original, None)
 
-Return the complete updated README content only.""",
-            }],
-        )
-        readme_path.write_text(resp.content[0].text.strip() + "\n", encoding="utf-8")
-    except Exception as e:
-        log(f"     ⚠️  skills/README.md update failed: {e}")
+    def redo(rel: str, problems: list[str]) -> bool:
+        note = f"\nA previous attempt was rejected ({'; '.join(problems)}); do not repeat it."
+        if rel in items:
+            item = items[rel]
+            return _update_one({**item, "reason": item["reason"] + note},
+                               research, latest_model, not args.no_stream, not args.no_patch)
+        skill_def = skills[rel]
+        return _create_one({**skill_def, "reason": skill_def["reason"] + note}, research, latest_model, format_ref)
+
+    failed: set[str] = set()
+    pending = updated_files + created_files
+    for attempt in range(VALIDATION_RETRIES + 1):
+        failures = validate_changes(pending, originals)
+        for rel, problems in failures.items():
+            revert(rel, problems)
+        failed |= set(failures)
+        retry = [rel for rel in failures if rel in items or rel in skills]
+        if not retry or attempt == VALIDATION_RETRIES:
+            break
+        log(f"  ↻ Retrying {len(retry)} rejected files...")
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            redone = list(pool.map(lambda rel: redo(rel, failures[rel]), retry))
+        pending = [rel for rel, ok in zip(retry, redone) if ok]
+        failed -= set(pending)
+
+    if failed:
+        survivors = [rel for rel in updated_files + created_files if rel not in failed]
+        for rel, problems in validate_changes(survivors, originals).items():
+            revert(rel, problems)
+            failed.add(rel)
+        log(f"  ⚠️  {len(failed)} files failed validation and were reverted")
+    log(f"  ✓ {len(updated_files) + len(created_files) - len(failed)} changed files passed validation")
+    return ([rel for rel in updated_files if rel not in failed],
+            [rel for rel in created_files if rel not in failed])
 
 
 # ─── Phase 6: PR creation ────────────────────────────────────────────────────
 
+def sweep_stale_temp_files() -> None:
+    """Remove `.<name>.*.tmp` files a killed streamed update left in the repo."""
+    for dirpath, dirnames, filenames in os.walk(REPO_ROOT):
+        dirnames[:] = [d for d in dirnames if d not in (".git", "node_modules")]
+        for name in filenames:
+            if name.startswith(".") and name.endswith(".tmp"):
+                path = Path(dirpath) / name
+                log(f"  – Removing stale temp file {path.relative_to(REPO_ROOT)}")
+                path.unlink(missing_ok=True)
+
+
 def create_pr(updated_files: list[str], created_files: list[str], latest_model: str):
     """Commit all changes to a new branch and open a PR."""
     branch = f"chore/research-update-{TODAY}"
@@ -515,9 +4020,12 @@ def create_pr(updated_files: list[str], created_files: list[str], latest_model:
 
     run(["git", "config", "user.name",  "Research Agent"])
     run(["git", "config", "user.email", "agent@noreply.github.com"])
-    run(["git", "checkout", "-b", branch])
+    # -B and the staged-diff check let a resumed run redo this phase after a crash part way
+    run(["git", "checkout", "-B", branch])
+    sweep_stale_temp_files()
     run(["git", "add", "-A"])
-    run(["git", "commit", "-m", f"chore: daily research update {TODAY}"])
+    if subprocess.run(["git", "diff", "--cached", "--quiet"], cwd=REPO_ROOT).returncode:
+        run(["git", "commit", "-m", f"chore: daily research update {TODAY}"])
     run(["git", "push", "origin", branch])
 
     updated_list = "\n".join(f"- `{f}`" for f in updated_files) or "_None_"
@@ -576,96 +4084,588 @@ Automated update by the Daily Research Agent.
 
 # ─── Main ────────────────────────────────────────────────────────────────────
 
-def main():
-    log(f"\n🤖  Daily Research Agent — {TODAY}")
-    log("─" * 50)
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Daily AI research & documentation update agent")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=list(COMMANDS),
+        help="stage to run (default: run, the whole pipeline)",
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=Path,
+        default=None,
+        help="where subcommands read and write research/plan/changes JSON "
+             "(default: <cache-dir>/state-<date>)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_UPDATE_WORKERS,
+        help=f"concurrent Claude calls in Phase 4 (default: {DEFAULT_UPDATE_WORKERS})",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help=f"on-disk API response cache (default: {DEFAULT_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always call the APIs; neither read nor write the response cache",
+    )
+    parser.add_argument(
+        "--record",
+        type=Path,
+        metavar="DIR",
+        help="save every live API response to DIR as a replayable fixture",
+    )
+    parser.add_argument(
+        "--replay",
+        type=Path,
+        metavar="DIR",
+        help="serve API responses from fixtures in DIR instead of the network; "
+             "no API credentials are needed",
+    )
+    parser.add_argument(
+        "--replay-latency-scale",
+        type=float,
+        default=1.0,
+        help="multiply each fixture's recorded latency by this factor (default: 1.0)",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="simulate this fixed latency per call instead of the recorded one",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="do everything except create_pr(): no branch, commit, push or PR",
+    )
+    parser.add_argument(
+        "--triage-model",
+        default=TRIAGE_MODEL,
+        help=f"small model that decides whether each planned file needs changing (default: {TRIAGE_MODEL})",
+    )
+    parser.add_argument(
+        "--light-model",
+        default=LIGHT_MODEL,
+        help=f"model for edits triage classifies as trivial (default: {LIGHT_MODEL})",
+    )
+    parser.add_argument(
+        "--update-model",
+        default=CLAUDE_MODEL,
+        help=f"model for substantive edits (default: {CLAUDE_MODEL})",
+    )
+    parser.add_argument(
+        "--no-triage",
+        action="store_true",
+        help="send every planned file straight to --update-model",
+    )
+    parser.add_argument(
+        "--no-group",
+        action="store_true",
+        help="update translations and near-duplicate files independently instead of from one canonical diff",
+    )
+    parser.add_argument(
+        "--no-validate",
+        action="store_true",
+        help="skip the frontmatter, heading, truncation and link checks on changed files before the PR",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="overlap research, scanning, planning, updates and skill generation "
+             "instead of running the phases as strict barriers",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="submit Phase 4 updates and Phase 5 skills as Message Batches "
+             "(slower, cheaper; set ANTHROPIC_BASE_URL to point at a mock endpoint)",
+    )
+    parser.add_argument(
+        "--no-patch",
+        action="store_true",
+        help="regenerate whole files in Phase 4 instead of requesting SEARCH/REPLACE edits",
+    )
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="wait for full Phase 4 responses instead of streaming them to disk",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="file manifest from the last successful run (default: <cache-dir>/manifest.json)",
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=None,
+        help="persisted content index of eligible files (default: <cache-dir>/index.json)",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="plan from file names only, without the content index",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="checkpoint journal for `run` (default: <cache-dir>/journal.jsonl)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue today's unfinished run in the journal, skipping the steps it completed",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        default=None,
+        help="SQLite store of past research facts and citations (default: <cache-dir>/research.sqlite3)",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="never end a run early because the research has no new facts",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        help="where to write the JSON run report (default: run-report.json in --cache-dir)",
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.resume and args.command != "run":
+        parser.error("--resume only applies to `run`; the other commands keep their state in --state-dir")
+    if args.pipeline and args.batch:
+        parser.error("--pipeline and --batch cannot be combined")
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be combined")
+    return args
 
-    # Phase 1 — Research (parallel)
-    log("\n[1/6] Gathering research via Perplexity sonar-pro (parallel)...")
-    research, latest_model = gather_research()
-    log(f"  ✓ Research complete — {len(research)} chars gathered")
-    log(f"  ✓ Latest model detected: {latest_model}")
 
-    # Phase 2 — Discover files
-    log("\n[2/6] Scanning repo files...")
-    files = get_all_eligible_files()
+def discover_files(args: argparse.Namespace) -> tuple[list[Path], FileManifest, set[str] | None]:
+    """Phase 2: eligible files, the manifest, and what changed since the last run."""
+    files    = get_all_eligible_files()
+    manifest = FileManifest(args.manifest or args.cache_dir / "manifest.json")
+    changed  = manifest.refresh(files)
     log(f"  ✓ {len(files)} eligible files found")
+    if repo_index:
+        reread = repo_index.refresh(files)
+        repo_index.save()
+        log(f"  ✓ Index refreshed ({reread} of {len(files)} files re-read)")
+    if changed is None:
+        log("  – No previous manifest; every file is treated as new")
+    else:
+        log(f"  ✓ {len(changed)} new or changed since last successful run")
     for f in files:
         log(f"    - {f.relative_to(REPO_ROOT)}")
+    return files, manifest, changed
 
-    # Phase 3 — Plan
-    log("\n[3/6] Planning updates (Claude opus-4-6)...")
-    plan       = plan_all_updates(research, latest_model, files)
+
+def plan_phase(
+    research: str,
+    latest_model: str,
+    files: list[Path],
+    changed: set[str] | None,
+) -> tuple[list[dict], list[dict]]:
+    """Phase 3: returns (updates, new_skills) from the plan."""
+    plan       = plan_all_updates(research, latest_model, files, changed)
     updates    = plan.get("updates", [])
     new_skills = plan.get("new_skills", [])
     log(f"  ✓ {len(updates)} files queued for update")
     log(f"  ✓ {len(new_skills)} new skill files to create")
+    return updates, new_skills
+
+
+def load_format_reference() -> str:
+    ref_path = REPO_ROOT / "skills" / "examples" / "api-development-skill.md"
+    if ref_path.exists():
+        return ref_path.read_text(encoding="utf-8")[:3000]
+    return ""
+
+
+def _create_one(skill_def: dict, research: str, latest_model: str, format_ref: str) -> bool:
+    """Phase 5 worker: create one planned skill file, keeping its log lines together."""
+    fname = skill_def["filename"]
+    with grouped_log(), run_report.label(f"skills/examples/{fname}"):
+        run_report.clear_stop(f"skills/examples/{fname}")
+        log(f"  → {fname} ({skill_def['topic']})")
+        created = create_new_skill(
+            fname, skill_def["topic"], skill_def["reason"], research, latest_model, format_ref
+        )
+        if created:
+            log(f"     ✓ created")
+            if journal is not None:
+                journal.record_file(
+                    "skill", f"skills/examples/{fname}", None,
+                    (REPO_ROOT / "skills" / "examples" / fname).read_text(encoding="utf-8"),
+                )
+        return created
+
+
+def run_sequential(args: argparse.Namespace) -> tuple[str, FileManifest, list[str], list[str], list[dict]]:
+    """
+    Phases 1-5 with a hard barrier between each.
+    Returns (latest_model, manifest, updated_files, created_files, new_skills).
+    """
+    # Phase 1 — Research (parallel)
+    run_report.start_phase("research")
+    log("\n[1/6] Gathering research via Perplexity sonar-pro (parallel)...")
+    resumed  = journal.last("research") if journal is not None else None
+    material = True
+    if resumed is not None:
+        research, latest_model = resumed["research"], resumed["latest_model"]
+        log("  ↺ Research read back from the journal")
+    else:
+        research, latest_model = gather_research()
+        log(f"  ✓ Research complete — {len(research)} chars gathered")
+        material = research_changed(research)
+        if journal is not None:
+            journal.append("research", research=research, latest_model=latest_model)
+    log(f"  ✓ Latest model detected: {latest_model}")
+
+    # Phase 2 — Discover files
+    run_report.start_phase("scan")
+    log("\n[2/6] Scanning repo files...")
+    files, manifest, changed = discover_files(args)
+    early_changed = early_compat_pass(files, latest_model)
+    skip_quiet_day(material, None if changed is None else changed | set(early_changed))
+
+    # Phase 3 — Plan
+    run_report.start_phase("plan")
+    log("\n[3/6] Planning updates (Claude opus-4-6)...")
+    resumed = journal.last("plan") if journal is not None else None
+    if resumed is not None:
+        updates, new_skills = resumed["updates"], resumed["new_skills"]
+        log(f"  ↺ Plan read back from the journal ({len(updates)} updates, {len(new_skills)} new skills)")
+    else:
+        updates, new_skills = plan_phase(research, latest_model, files, changed)
+        if journal is not None:
+            journal.append("plan", updates=updates, new_skills=new_skills)
 
-    if not updates and not new_skills:
+    if not updates and not new_skills and not early_changed:
         log("\n✓ Repo is fully current. Nothing to do today.")
+        manifest.save()
+        if research_history is not None:
+            research_history.commit()
+        if journal is not None:
+            journal.append("end", outcome="current")
         sys.exit(0)
 
-    # Phase 4 — Update existing files
-    log("\n[4/6] Updating existing files...")
-    updated_files = []
-    for item in sorted(
-        updates,
-        key=lambda x: {"high": 0, "medium": 1, "low": 2}.get(x.get("priority", "low"), 2),
-    ):
-        fpath    = REPO_ROOT / item["file"]
-        priority = item.get("priority", "?")
-        log(f"  → {item['file']} [{priority}]")
-        log(f"     reason: {item['reason'][:80]}...")
+    updated_files, created_files = update_phase(args, research, latest_model, updates, new_skills, early_changed)
+    return latest_model, manifest, updated_files, created_files, new_skills
 
-        changed = update_existing_file(
-            fpath,
+
+def update_phase(
+    args: argparse.Namespace,
+    research: str,
+    latest_model: str,
+    updates: list[dict],
+    new_skills: list[dict],
+    early_changed: list[str] | None = None,
+) -> tuple[list[str], list[str]]:
+    """
+    Phases 4-5, online or as one Message Batch, then validate_phase().
+    Returns (updated_files, created_files); updated_files also lists the
+    files early_compat_pass() changed. Steps the journal already has are
+    not run again.
+    """
+    format_ref = load_format_reference()
+    planned_updates, planned_skills = updates, new_skills
+    done_updates, done_skills = [], []
+    if journal is not None:
+        pending = []
+        for item in updates:
+            done = journal.completed("update", item["file"])
+            if done is None:
+                pending.append(item)
+            elif done:
+                done_updates.append(item["file"])
+        skills = []
+        for skill_def in new_skills:
+            rel = f"skills/examples/{skill_def['filename']}"
+            if journal.completed("skill", rel):
+                done_skills.append(rel)
+            else:
+                skills.append(skill_def)
+        skipped = len(updates) - len(pending) + len(new_skills) - len(skills)
+        if skipped:
+            log(f"  ↺ {skipped} planned steps already done in the journal")
+        updates, new_skills = pending, skills
+
+    if args.batch:
+        # Phases 4 + 5 — one Message Batch for all updates and new skills
+        run_report.start_phase("update+skills (batch)")
+        log("\n[4-5/6] Updating files and creating skills via Message Batches...")
+        updated_files, created_files = batch_update_and_create(
+            updates,
+            new_skills,
             research,
             latest_model,
-            item["reason"],
-            item.get("update_compatibility", False),
+            format_ref,
+            args.workers,
+            patch=not args.no_patch,
+        )
+    else:
+        # Phase 4 — Update existing files
+        run_report.start_phase("update")
+        log(f"\n[4/6] Updating existing files ({args.workers} workers)...")
+        updated_files = update_all_files(
+            updates if args.no_group else group_updates(updates),
+            research,
+            latest_model,
+            args.workers,
+            stream=not args.no_stream,
+            patch=not args.no_patch,
         )
-        if changed:
-            updated_files.append(item["file"])
-            log(f"     ✓ updated")
-        else:
-            log(f"     – no changes needed")
-
-    # Phase 5 — Create new skill files
-    log("\n[5/6] Creating new skill files...")
-    created_files = []
 
-    format_ref = ""
-    ref_path = REPO_ROOT / "skills" / "examples" / "api-development-skill.md"
-    if ref_path.exists():
-        format_ref = ref_path.read_text(encoding="utf-8")[:3000]
+        # Phase 5 — Create new skill files
+        run_report.start_phase("skills")
+        log("\n[5/6] Creating new skill files...")
+        created_files = [
+            f"skills/examples/{skill_def['filename']}"
+            for skill_def in new_skills
+            if _create_one(skill_def, research, latest_model, format_ref)
+        ]
 
-    for skill_def in new_skills:
-        fname  = skill_def["filename"]
-        topic  = skill_def["topic"]
-        reason = skill_def["reason"]
-        log(f"  → {fname} ({topic})")
+    updated_files = done_updates + [f for f in updated_files if f not in done_updates]
+    updated_files = [f for f in early_changed or [] if f not in updated_files] + updated_files
+    created_files = done_skills + created_files
+    _index_new_skills(new_skills, latest_model, updated_files, created_files)
+    if args.no_validate:
+        return updated_files, created_files
+    return validate_phase(args, research, latest_model, planned_updates, planned_skills,
+                          updated_files, created_files)
 
-        created = create_new_skill(
-            fname, topic, reason, research, latest_model, format_ref
-        )
-        if created:
-            created_files.append(f"skills/examples/{fname}")
-            log(f"     ✓ created")
 
+def _index_new_skills(
+    new_skills: list[dict],
+    latest_model: str,
+    updated_files: list[str],
+    created_files: list[str],
+) -> None:
+    """List created skills in skills/README.md and count it as updated."""
     if created_files:
-        log("  → Updating skills/README.md...")
-        update_skills_readme(new_skills, latest_model)
+        readme = REPO_ROOT / "skills" / "README.md"
+        if journal is not None and journal.completed("index", "skills/README.md"):
+            log("  ↺ skills/README.md already indexed in the journal")
+        else:
+            log("  → Updating skills/README.md...")
+            before = readme.read_text(encoding="utf-8") if readme.exists() else None
+            with run_report.label("skills/README.md"):
+                update_skills_readme(new_skills, latest_model)
+            if journal is not None and before is not None and not run_report.failed("skills/README.md"):
+                journal.record_file("index", "skills/README.md", before, readme.read_text(encoding="utf-8"))
         if "skills/README.md" not in updated_files:
             updated_files.append("skills/README.md")
 
+
+def early_compat_pass(files: list[Path], latest_model: str) -> list[str]:
+    """
+    Local compat pre-pass for markdown files whose frontmatter
+    `compatibility:` still names an older Opus. It needs nothing but the
+    latest model name, so the pipelined mode runs it while the other
+    research queries are still in flight; the sequential mode runs it after
+    the scan, so both modes make the same edits. Each edit is journaled as
+    a "compat" step, which a resumed run counts as done. Returns the
+    changed paths.
+    """
+    changed = []
+    if journal is not None:
+        changed = [rel for rel in journal.files("compat") if journal.completed("compat", rel)]
+    for f in files:
+        if f.suffix != ".md" or str(f.relative_to(REPO_ROOT)) in changed:
+            continue
+        try:
+            text = f.read_text(encoding="utf-8")
+        except Exception:
+            continue
+        front = FRONTMATTER_RE.match(text)
+        if not front:
+            continue
+        compat = [line for line in front.group(1).splitlines() if line.startswith("compatibility:")]
+        if not compat or not compat_prepass(compat[0], latest_model)[2]:
+            continue
+        rewritten, substitutions, _ = compat_prepass(text, latest_model)
+        if substitutions:
+            f.write_text(rewritten, encoding="utf-8")
+            changed.append(str(f.relative_to(REPO_ROOT)))
+            if journal is not None:
+                journal.record_file("compat", changed[-1], text, rewritten)
+    log(f"  ✓ Early compatibility pass updated {len(changed)} files")
+    return changed
+
+
+async def run_pipelined(args: argparse.Namespace) -> tuple[str, FileManifest, list[str], list[str], list[dict]]:
+    """
+    Phases 1-5 overlapped on asyncio tasks and a shared work queue:
+      - the repo scan runs alongside the research queries
+      - as soon as latest_claude_model is in and the model name extracted,
+        early_compat_pass() runs while the other queries finish
+      - the plan streams in as JSON Lines and each item is queued the
+        moment it parses; args.workers workers drain one priority queue,
+        so file updates and skill generation start before planning ends
+        (high-priority updates first, then skills, then the rest)
+    Same return value as run_sequential().
+    """
+    run_report.start_phase("research+scan (pipelined)")
+    log("\n[1-2/6] Research and repo scan (pipelined)...")
+    deadline = time.monotonic() + RESEARCH_DEADLINE_SECONDS
+    queries = {
+        topic: asyncio.create_task(asyncio.to_thread(perplexity_query, topic, query, deadline))
+        for topic, query in RESEARCH_QUERIES
+    }
+    scan = asyncio.create_task(asyncio.to_thread(discover_files, args))
+
+    model_research = await queries["latest_claude_model"]
+    latest_model   = await asyncio.to_thread(extract_latest_model, model_research["content"])
+    log(f"  ✓ Latest model detected: {latest_model}")
+
+    files, manifest, changed = await scan
+    early = asyncio.create_task(asyncio.to_thread(early_compat_pass, files, latest_model))
+
+    results_map = {topic: await task for topic, task in queries.items()}
+    research    = assemble_research(results_map)
+    log(f"  ✓ Research complete — {len(research)} chars gathered")
+    material = research_changed(research)
+    if journal is not None:
+        journal.append("research", research=research, latest_model=latest_model)
+    # Finish the local pass before any Claude update can touch the same files
+    early_changed = await early
+    skip_quiet_day(material, None if changed is None else changed | set(early_changed))
+
+    run_report.start_phase("plan+update+skills (pipelined)")
+    log(f"\n[3-5/6] Planning, updating files and creating skills ({args.workers} workers)...")
+    format_ref = load_format_reference()
+    loop       = asyncio.get_running_loop()
+    work: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    seq        = itertools.count()   # tie-breaker so queue entries never compare dicts
+    updates: list[dict]    = []
+    new_skills: list[dict] = []
+
+    def plan() -> None:
+        # Worker thread: hand each plan item to the event loop the moment it parses
+        for key, item in iter_plan_items(research, latest_model, files, changed):
+            if key == "updates":
+                updates.append(item)
+                rank = PRIORITY_ORDER.get(item.get("priority", "low"), 2)
+                rank = 0 if rank == 0 else rank + 1   # skills run between high and medium
+            else:
+                new_skills.append(item)
+                rank = 1
+            loop.call_soon_threadsafe(work.put_nowait, (rank, next(seq), key, item))
+        log(f"  ✓ {len(updates)} files queued for update")
+        log(f"  ✓ {len(new_skills)} new skill files to create")
+        if journal is not None:
+            journal.append("plan", updates=updates, new_skills=new_skills)
+
+    async def planner() -> None:
+        try:
+            await asyncio.to_thread(plan)
+        finally:
+            for _ in range(args.workers):
+                work.put_nowait((len(PRIORITY_ORDER) + 1, next(seq), None, None))
+
+    updated: set[str] = set()
+    created: list[str] = []
+
+    async def worker() -> None:
+        while True:
+            _, _, key, item = await work.get()
+            if key is None:
+                return
+            try:
+                if key == "updates":
+                    if await asyncio.to_thread(
+                        _update_one, item, research, latest_model,
+                        not args.no_stream, not args.no_patch,
+                    ):
+                        updated.add(item["file"])
+                elif await asyncio.to_thread(_create_one, item, research, latest_model, format_ref):
+                    created.append(f"skills/examples/{item['filename']}")
+            except Exception as e:
+                log(f"  ⚠️  {item.get('file') or item.get('filename')} failed: {e}")
+
+    await asyncio.gather(planner(), *(worker() for _ in range(args.workers)))
+
+    ordered = sorted(
+        updates,
+        key=lambda x: PRIORITY_ORDER.get(x.get("priority", "low"), 2),
+    )
+    planned = {item["file"] for item in ordered}
+    updated_files = [f for f in early_changed if f not in planned]
+    updated_files += [item["file"] for item in ordered if item["file"] in updated or item["file"] in early_changed]
+    _index_new_skills(new_skills, latest_model, updated_files, created)
+    if not args.no_validate:
+        updated_files, created = validate_phase(args, research, latest_model, updates, new_skills,
+                                                updated_files, created)
+    return latest_model, manifest, updated_files, created, new_skills
+
+
+def run(args: argparse.Namespace) -> None:
+    log(f"\n🤖  Daily Research Agent — {TODAY}")
+    log("─" * 50)
+
+    if args.pipeline and journal is not None and journal.last("research") is not None:
+        # Research (and maybe the plan) are already known, leaving nothing to overlap
+        log("  ↺ Resuming from the journal in sequential mode")
+        result = run_sequential(args)
+    elif args.pipeline:
+        result = asyncio.run(run_pipelined(args))
+    else:
+        result = run_sequential(args)
+    latest_model, manifest, updated_files, created_files, new_skills = result
+    open_pr(args, manifest, updated_files, created_files, latest_model)
+
+
+def open_pr(
+    args: argparse.Namespace,
+    manifest: FileManifest,
+    updated_files: list[str],
+    created_files: list[str],
+    latest_model: str,
+) -> None:
+    """Phase 6, or the dry-run / nothing-changed exits; re-records and saves the manifest after a PR."""
     all_changed = updated_files + created_files
     if not all_changed:
         log("\n✓ No actual changes after processing. Repo is already current.")
+        if not args.dry_run:
+            manifest.refresh(get_all_eligible_files())
+            manifest.save()
+            if research_history is not None:
+                research_history.commit()
+        if journal is not None:
+            journal.append("end", outcome="current")
         sys.exit(0)
 
     # Phase 6 — Open PR
-    log(f"\n[6/6] Creating PR ({len(all_changed)} total changes)...")
-    create_pr(updated_files, created_files, latest_model)
+    if args.dry_run:
+        # The manifest is not saved either, so a real run still sees these files as changed
+        log(f"\n[6/6] Dry run — skipping PR ({len(all_changed)} changes left in the working tree)")
+    else:
+        run_report.start_phase("pr")
+        log(f"\n[6/6] Creating PR ({len(all_changed)} total changes)...")
+        create_pr(updated_files, created_files, latest_model)
+        # Record the tree the PR captures, so the agent's own edits do not
+        # count as changed next time (`run` and `pr` alike)
+        manifest.refresh(get_all_eligible_files())
+        manifest.save()
+        if research_history is not None:
+            research_history.commit()
+    if journal is not None:
+        journal.append("end", outcome="dry-run" if args.dry_run else "pr")
 
     log("\n" + "─" * 50)
     log("✅  Done.")
@@ -674,5 +4674,162 @@ def main():
     log(f"   Model   : {latest_model}")
 
 
+def _state_path(args: argparse.Namespace, name: str) -> Path:
+    return (args.state_dir or args.cache_dir / f"state-{TODAY}") / f"{name}.json"
+
+
+def save_state(args: argparse.Namespace, name: str, value: dict) -> None:
+    path = _state_path(args, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(value, indent=1, ensure_ascii=False) + "\n", encoding="utf-8")
+    log(f"  ✓ Wrote {path}")
+
+
+def load_state(args: argparse.Namespace, name: str) -> dict | None:
+    try:
+        return json.loads(_state_path(args, name).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def cmd_scan(args: argparse.Namespace) -> None:
+    run_report.start_phase("scan")
+    log("\n[2/6] Scanning repo files...")
+    discover_files(args)
+
+
+def cmd_research(args: argparse.Namespace) -> dict:
+    run_report.start_phase("research")
+    log("\n[1/6] Gathering research via Perplexity sonar-pro (parallel)...")
+    research, latest_model = gather_research()
+    log(f"  ✓ Research complete — {len(research)} chars gathered")
+    log(f"  ✓ Latest model detected: {latest_model}")
+    material = research_changed(research)
+    state = {"research": research, "latest_model": latest_model, "material": material}
+    save_state(args, "research", state)
+    return state
+
+
+def cmd_plan(args: argparse.Namespace) -> None:
+    state = load_state(args, "research")
+    if state is None:
+        if not args.replay and not PERPLEXITY_KEY:
+            sys.exit("Missing environment variables: PERPLEXITY_API_KEY "
+                     f"(no saved research in {_state_path(args, 'research').parent})")
+        state = cmd_research(args)
+    run_report.start_phase("scan")
+    log("\n[2/6] Scanning repo files...")
+    files, _, changed = discover_files(args)
+    if quiet_day(state.get("material", True), changed):
+        # Leave a marker so `update` and `pr` know there is nothing to do.
+        save_state(args, "plan", {"updates": [], "new_skills": [], "quiet": True})
+        return
+    run_report.start_phase("plan")
+    log("\n[3/6] Planning updates (Claude opus-4-6)...")
+    updates, new_skills = plan_phase(state["research"], state["latest_model"], files, changed)
+    save_state(args, "plan", {"updates": updates, "new_skills": new_skills})
+
+
+def cmd_update(args: argparse.Namespace) -> None:
+    state, plan = load_state(args, "research"), load_state(args, "plan")
+    if state is None or plan is None:
+        sys.exit(f"No research/plan state in {_state_path(args, 'plan').parent}; run `plan` first")
+    if plan.get("quiet"):
+        log("\n✓ Quiet day: nothing was planned, so there is nothing to update.")
+        save_state(args, "changes", {"quiet": True})
+        return
+    updated_files, created_files = update_phase(
+        args, state["research"], state["latest_model"], plan["updates"], plan["new_skills"]
+    )
+    save_state(args, "changes", {
+        "latest_model":  state["latest_model"],
+        "updated_files": updated_files,
+        "created_files": created_files,
+    })
+
+
+def cmd_pr(args: argparse.Namespace) -> None:
+    changes = load_state(args, "changes")
+    if changes is None:
+        sys.exit(f"No changes state in {_state_path(args, 'changes').parent}; run `update` first")
+    if changes.get("quiet"):
+        log("\n✓ Quiet day: no changes to open a PR for.")
+        return
+    manifest = FileManifest(args.manifest or args.cache_dir / "manifest.json")
+    open_pr(args, manifest, changes["updated_files"], changes["created_files"], changes["latest_model"])
+
+
+COMMANDS = {
+    "run":      run,
+    "scan":     cmd_scan,
+    "research": cmd_research,
+    "plan":     cmd_plan,
+    "update":   cmd_update,
+    "pr":       cmd_pr,
+}
+
+# Secrets each command needs; --replay needs no API keys, --dry-run no GitHub token.
+# `plan` checks PERPLEXITY_API_KEY itself, only when it has no saved research.
+REQUIRED_ENV = {
+    "PERPLEXITY_API_KEY": lambda args: not args.replay and args.command in ("run", "research"),
+    "ANTHROPIC_API_KEY":  lambda args: not args.replay and args.command not in ("scan", "pr"),
+    "GH_TOKEN":           lambda args: not args.dry_run and args.command in ("run", "pr"),
+}
+
+
+def main():
+    global response_cache, repo_index, model_tiers, fixtures, journal, research_history
+    args = parse_args()
+    run_report.startup_seconds = round(time.perf_counter() - _STARTED, 3)
+    missing = [name for name, needed in REQUIRED_ENV.items() if needed(args) and not os.environ.get(name)]
+    if missing:
+        sys.exit(f"Missing environment variables: {', '.join(missing)}")
+
+    if args.record or args.replay:
+        # Fixtures replace the cache: a cache hit would never be recorded
+        fixtures = FixtureStore(
+            args.record or args.replay, bool(args.replay),
+            args.replay_latency_scale, args.replay_latency,
+        )
+    elif not args.no_cache:
+        # A directory of its own: eviction must never touch manifest.json, index.json & co.
+        response_cache = ResponseCache(args.cache_dir / "responses")
+    if not args.no_index:
+        repo_index = RepoIndex(args.index or args.cache_dir / "index.json")
+    # Off with fixtures, like the cache: a moving baseline would change what a replay does
+    if not (args.no_history or args.record or args.replay) and args.command in ("run", "research", "plan", "pr"):
+        research_history = ResearchHistory(args.history or args.cache_dir / "research.sqlite3")
+    model_tiers = {
+        "triage":      None if args.no_triage else args.triage_model,
+        "trivial":     args.light_model,
+        "substantive": args.update_model,
+    }
+    if args.command == "run":
+        journal = RunJournal(args.journal or args.cache_dir / "journal.jsonl")
+        if not args.resume:
+            journal.start()
+        elif not journal.load():
+            log(f"  No unfinished run in {journal.path}, starting a new one")
+            journal.start()
+        elif journal.events[0].get("date") != TODAY:
+            # Its research, plan and PR branch belong to that day; redo them for today
+            log(f"  ⚠ The unfinished run in {journal.path} started {journal.events[0].get('date')}, "
+                f"not today; starting a new one")
+            journal.start()
+        else:
+            log(f"  ↺ Resuming the run started {TODAY} from {journal.path}")
+
+    # Next to the cache rather than in the checkout, so every subcommand can write one
+    report_path = args.report or args.cache_dir / "run-report.json"
+    try:
+        COMMANDS[args.command](args)
+    finally:
+        # Written on every exit, including sys.exit() and crashes, so slow or
+        # failed runs can be compared with good ones
+        run_report.write(report_path)
+        run_report.log_summary()
+        log(f"  Report written to {report_path}")
+
+
 if __name__ == "__main__":
     main()